@@ -0,0 +1,71 @@
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.OutputStreamWriter;
+import java.io.PrintStream;
+import java.io.Writer;
+import java.nio.charset.StandardCharsets;
+
+import org.apache.pdfbox.pdmodel.PDDocument;
+import org.apache.pdfbox.text.PDFTextStripper;
+
+/*
+ * Long-lived text extraction worker, see pdfbox.py
+ *
+ * Run with the single-file source launcher (java 11+), no build step needed:
+ *     java -cp pdfbox-app-2.0.21.jar PdfBoxServer.java
+ *
+ * Reads one request per line from stdin:
+ *     <pdf path> TAB <txt path>
+ * and answers each with one line on stdout:
+ *     OK TAB <milliseconds> TAB <page count>
+ *     ERR TAB <milliseconds> TAB <message>
+ * The output matches what "ExtractText <pdf> <txt>" writes with default options.
+ */
+public class PdfBoxServer {
+
+    public static void main(String[] args) throws Exception {
+        // Keep stdout reserved for the protocol
+        PrintStream out = new PrintStream(System.out, true, "UTF-8");
+        System.setOut(System.err);
+
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        PDFTextStripper stripper = new PDFTextStripper();
+        String line;
+        while ((line = in.readLine()) != null) {
+            if (line.isEmpty()) {
+                continue;
+            }
+            long start = System.nanoTime();
+            String[] parts = line.split("\t", 2);
+            if (parts.length != 2) {
+                out.println("ERR\t0\tmalformed request");
+                continue;
+            }
+            try {
+                int pages = extract(stripper, new File(parts[0]), new File(parts[1]));
+                long elapsed = (System.nanoTime() - start) / 1000000;
+                out.println("OK\t" + elapsed + "\t" + pages);
+            } catch (Throwable e) {
+                long elapsed = (System.nanoTime() - start) / 1000000;
+                String msg = String.valueOf(e).replace('\n', ' ').replace('\t', ' ');
+                out.println("ERR\t" + elapsed + "\t" + msg);
+            }
+        }
+    }
+
+    private static int extract(PDFTextStripper stripper, File pdf, File txt) throws Exception {
+        try (PDDocument document = PDDocument.load(pdf, "")) {
+            if (!document.getCurrentAccessPermission().canExtractContent()) {
+                throw new java.io.IOException("You do not have permission to extract text");
+            }
+            stripper.setStartPage(1);
+            stripper.setEndPage(Integer.MAX_VALUE);
+            try (Writer output = new OutputStreamWriter(new FileOutputStream(txt), StandardCharsets.UTF_8)) {
+                stripper.writeText(document, output);
+            }
+            return document.getNumberOfPages();
+        }
+    }
+}
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""
+Sentence alignment of the english and icelandic abstracts in AbstractsDb, with the
+length based method of Gale and Church (1993): a sentence and its translation have
+roughly proportional lengths in characters, and most sentences translate one to one.
+The best sequence of 1-1, 1-2, 2-1, 1-0 and 0-1 beads is found with dynamic programming.
+Aligned pairs go into the segmented table with the probability of their bead.
+"""
+
+import math
+import multiprocessing
+import signal
+import sys
+import traceback
+
+from extract_abstracts import AbstractsDb, segment_abstract, INSERT_BATCH_SIZE
+
+# (english sentences, icelandic sentences) -> prior probability, from Gale and Church,
+# 1-0 and 0-1 share the probability of a deletion and 2-1 and 1-2 that of a merge
+BEADS = {
+    (1, 1): 0.89,
+    (1, 0): 0.0099 / 2,
+    (0, 1): 0.0099 / 2,
+    (2, 1): 0.089 / 2,
+    (1, 2): 0.089 / 2,
+}
+# Variance of the icelandic length per english character
+VARIANCE = 6.8
+
+
+def length_cost(eng_len, isl_len, ratio=1.0, variance=VARIANCE):
+    """ -log of the probability that texts of these lengths (in characters) are translations,
+        ratio is the expected number of icelandic characters per english character """
+    if eng_len == 0 and isl_len == 0:
+        return 0.0
+    mean = (eng_len + isl_len / ratio) / 2
+    delta = (isl_len - eng_len * ratio) / math.sqrt(mean * variance)
+    # Two tailed probability of a deviation at least this large
+    prob = math.erfc(abs(delta) / math.sqrt(2))
+    return -math.log(prob) if prob > 0 else math.inf
+
+
+def align(eng_sents, isl_sents, ratio=1.0, variance=VARIANCE):
+    """ Best alignment of two lists of sentences, as [(eng sentences, isl sentences, cost)] in
+        order, where the cost of a bead is -log of its prior times its length probability """
+    n, m = len(eng_sents), len(isl_sents)
+    # Prefix sums, the length of eng_sents[i:j] is eng_lens[j] - eng_lens[i]
+    eng_lens = [0]
+    for s in eng_sents:
+        eng_lens.append(eng_lens[-1] + len(s))
+    isl_lens = [0]
+    for s in isl_sents:
+        isl_lens.append(isl_lens[-1] + len(s))
+    beads = [(de, di, -math.log(prior)) for ((de, di), prior) in BEADS.items()]
+
+    costs = [[math.inf] * (m + 1) for _ in range(n + 1)]
+    back = [[None] * (m + 1) for _ in range(n + 1)]
+    costs[0][0] = 0.0
+    for i in range(n + 1):
+        for j in range(m + 1):
+            if i == 0 and j == 0:
+                continue
+            best = math.inf
+            for (de, di, prior_cost) in beads:
+                if de > i or di > j:
+                    continue
+                prev = costs[i - de][j - di]
+                if prev == math.inf:
+                    continue
+                bead_cost = prior_cost + length_cost(
+                    eng_lens[i] - eng_lens[i - de], isl_lens[j] - isl_lens[j - di], ratio, variance
+                )
+                if prev + bead_cost < best:
+                    best = prev + bead_cost
+                    back[i][j] = (de, di, bead_cost)
+            costs[i][j] = best
+
+    alignment = []
+    (i, j) = (n, m)
+    while i > 0 or j > 0:
+        (de, di, bead_cost) = back[i][j]
+        alignment.append((eng_sents[i - de:i], isl_sents[j - di:j], bead_cost))
+        (i, j) = (i - de, j - di)
+    alignment.reverse()
+    return alignment
+
+
+def align_pairs(eng_sents, isl_sents, ratio=1.0):
+    """ [(eng, isl, score)] of the aligned beads that have sentences on both sides,
+        score is the probability of the bead (0 to 1) """
+    return [
+        (" ".join(eng), " ".join(isl), math.exp(-bead_cost))
+        for (eng, isl, bead_cost) in align(eng_sents, isl_sents, ratio)
+        if eng and isl
+    ]
+
+
+def split_sentences(abstract):
+    """ Sentences of an abstract, without its heading """
+    return [sent for sent in segment_abstract(abstract).split("\n") if sent.strip()]
+
+
+# Length ratio used by each pool worker, set by the parent
+_worker_ratio = 1.0
+
+
+def _init_worker(ratio):
+    global _worker_ratio
+    # Let the parent handle ctrl-c
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_ratio = ratio
+
+
+def _align_document(row):
+    (path, eng, isl) = row
+    try:
+        return path, align_pairs(split_sentences(eng), split_sentences(isl), _worker_ratio)
+    except Exception:
+        traceback.print_exc()
+        return path, None
+
+
+def align_all(workers=None, db=None, ratio=None, chunksize=50):
+    """ Sentence align every abstract pair in AbstractsDb that has not been aligned yet, in a pool
+        of worker processes, this process inserts the pairs. ratio is the expected number of
+        icelandic characters per english character, by default measured over all abstracts. """
+    db = db if db is not None else AbstractsDb()
+    items = db.get_all_items()
+    if ratio is None:
+        eng_chars = sum(len(eng) for (_, _, eng) in items)
+        ratio = sum(len(isl) for (_, isl, _) in items) / eng_chars if eng_chars else 1.0
+    done = db.get_segmented_paths()
+    rows = [(path, eng, isl) for (path, isl, eng) in items if path not in done]
+    print(f"{len(done)} abstracts aligned, {len(rows)} remaining, length ratio {ratio:.3f}")
+    workers = workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(ratio,))
+    documents = []
+    processed = inserted = 0
+
+    def flush():
+        nonlocal inserted, documents
+        if documents:
+            inserted += db.insert_aligned(documents)
+            documents = []
+
+    try:
+        for (path, pairs) in pool.imap_unordered(_align_document, rows, chunksize=chunksize):
+            processed += 1
+            if pairs is not None:
+                # Also the abstracts without pairs, so they are not aligned again
+                documents.append((path, pairs))
+            if len(documents) >= INSERT_BATCH_SIZE:
+                flush()
+            print(f"[{processed}/{len(rows)}] abstracts aligned", end="\r", flush=True)
+        pool.close()
+        print()
+    except KeyboardInterrupt:
+        print()
+        print(f"Exiting... {len(rows) - processed} remaining")
+        pool.terminate()
+    finally:
+        pool.join()
+        flush()
+    print(f"Inserted {inserted} sentence pairs")
+
+
+if __name__ == "__main__":
+    align_all()
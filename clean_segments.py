@@ -1,26 +1,99 @@
+import itertools
+import json
+import multiprocessing
+import multiprocessing.util
+import signal
 
 from segment_cleaner import *
 import segment_skemman
+from rule_cache import RuleCache
+from utils import imap_bounded
 
+# The cleaner of each pool worker and whether it records rule stats
+_worker_cleaner = None
+_worker_profile = False
 
-def clean_current_db():
-    seg_db = segment_skemman.SegmentDb()
-    max_docid = seg_db.get_max_docid()
 
-    cleaner = SegmentCleaner.default_cleaner()
-    
-    #for i in range(1, max_docid+1):
+def _init_worker(make_cleaner, profile=False, use_cache=False):
+    global _worker_cleaner, _worker_profile
+    # Let the parent handle ctrl-c
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_cleaner = make_cleaner()
+    if use_cache:
+        cache = RuleCache()
+        # Write back the last results read when the pool shuts the worker down
+        multiprocessing.util.Finalize(cache, cache.close, exitpriority=10)
+        _worker_cleaner.use_cache(cache)
+    _worker_profile = profile
 
-    import random
-    i = random.randint(1, max_docid) 
 
-    segs = seg_db.get_segments_for_document(i)
-    cleaner = SegmentCleaner.default_cleaner()
+def _clean_batch(batch):
+    """ [(segment id, document id, text)] holding whole documents ->
+        ([(document id, number of segments, [(segment id, text, metadata json)])],
+         [(document id, {rule name: RuleStats})] when profiling) """
+    documents = []
+    document_stats = []
+    for (document_id, rows) in itertools.groupby(batch, key=lambda row: row[1]):
+        segments = [Segment(text, id=segment_id) for (segment_id, _, text) in rows]
+        stats = {} if _worker_profile else None
+        cleaned = [
+            (s.id, s.text, json.dumps(s.metadata, ensure_ascii=False))
+            for s in _worker_cleaner.iter_clean(segments, stats=stats)
+        ]
+        documents.append((document_id, len(segments), cleaned))
+        if stats is not None:
+            document_stats.append((document_id, stats))
+    return documents, document_stats
 
-    cleaned = cleaner.clean_segments(segs)
-    #for s in cleaned:
-        #print(s)
 
-    #break
+def clean_current_db(
+    workers=None,
+    make_cleaner=SegmentCleaner.default_cleaner,
+    documents_per_batch=20,
+    profile_path=None,
+    use_cache=False,
+):
+    """ Clean every document in segment.db into cleaned_segments, skipping documents
+        already cleaned with the same rules. Each batch of documents is committed
+        together with its checkpoint, so an interrupted run picks up where it stopped.
+        With profile_path, stats for each rule are printed and saved there as json or csv.
+        With use_cache, results of pure rules are reused from earlier runs, see rule_cache. """
+    seg_db = segment_skemman.SegmentDb()
+    ruleset = make_cleaner().ruleset_hash()
+    document_ids = seg_db.get_uncleaned_documents(ruleset)
+    print(f"{len(document_ids)} documents to clean with ruleset {ruleset}")
+    # Documents without segments are checkpointed right away, they would never show up in a batch
+    empty = seg_db.get_documents_without_segments()
+    seg_db.insert_cleaned(ruleset, [(document_id, 0, []) for document_id in document_ids if document_id in empty])
+    document_ids = [document_id for document_id in document_ids if document_id not in empty]
+    profile = CleaningProfile(keep_documents=str(profile_path).endswith(".csv")) if profile_path else None
+    workers = workers or multiprocessing.cpu_count()
+    batches = seg_db.iter_document_segments(document_ids, documents_per_batch)
+    pool = multiprocessing.Pool(
+        workers, initializer=_init_worker, initargs=(make_cleaner, profile is not None, use_cache)
+    )
+    done = 0
+    try:
+        # A few batches per worker at a time, so the segments are not all read into memory
+        for (documents, document_stats) in imap_bounded(pool, _clean_batch, batches, 2 * workers):
+            seg_db.insert_cleaned(ruleset, documents)
+            for (document_id, stats) in document_stats:
+                profile.record(document_id, stats)
+            done += len(documents)
+            print(f"[{done}/{len(document_ids)}] documents cleaned", end="\r", flush=True)
+        pool.close()
+        print()
+    except KeyboardInterrupt:
+        print()
+        print(f"Exiting... {len(document_ids) - done} remaining")
+        pool.terminate()
+    finally:
+        pool.join()
+    if profile is not None:
+        profile.print_summary()
+        profile.save(profile_path)
+        print(f"Saved rule stats to {profile_path}")
 
 
+if __name__ == "__main__":
+    clean_current_db()
@@ -6,16 +6,51 @@ from pathlib import Path
 # (but maybe not in tests? bah.)
 data_dir = Path("./data/")
 scrape_delay = 1.0
+scrape_rate = None  # requests per second per host when scraping concurrently, None means 1 / scrape_delay
+http_pool_size = 10
+html_parser = None  # a BeautifulSoup parser name, None picks lxml if it is installed
+download_workers = 1
+bandwidth_limit = None  # bytes per second over all download workers, None for no limit
+http_cache_max_mb = 2000
+rule_cache_max_mb = 2000
+
+# Throttling of cpu heavy work, None disables the check
+max_load = None  # 1 minute load average
+max_cpu_temp = 80.0  # degrees celsius
 
 pdfbox_path = "/home/petur/Downloads/pdfbox-app-2.0.21.jar"
 
 
 
+def request_rate():
+    """ Requests per second per host, from scrape_rate or scrape_delay """
+    if scrape_rate is not None:
+        return scrape_rate
+    if scrape_delay > 0:
+        return 1.0 / scrape_delay
+    return float("inf")
+
+
 def db_dir():
     _d = data_dir / "db"
     os.makedirs(_d, exist_ok = True)
     return _d
 
+def http_cache_dir():
+    _d = data_dir / "http_cache"
+    os.makedirs(_d, exist_ok = True)
+    return _d
+
+def rule_cache_dir():
+    _d = data_dir / "rule_cache"
+    os.makedirs(_d, exist_ok = True)
+    return _d
+
+def text_store_dir():
+    _d = data_dir / "text_store"
+    os.makedirs(_d, exist_ok = True)
+    return _d
+
 def pdf_dir():
     _d = data_dir / "pdf"
     os.makedirs(_d, exist_ok = True)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+"""
+Export segments and cleaned_segments, joined with Skemman metadata, as zstd compressed
+parquet shards that training jobs can memory map or stream in parallel.
+
+    export/
+        manifest.json
+        segments/language=is/part-00000.parquet
+        cleaned_segments/language=is/part-00000.parquet
+        ...
+"""
+
+import datetime
+import json
+import os
+from pathlib import Path
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Only needed for exporting
+    pa = None
+    pq = None
+
+from segment_skemman import SegmentDb
+from skemman import Skemman
+from skemman_db import SkemmanDb
+from utils import transliterate_path
+
+ROW_GROUP_SIZE = 100_000
+SHARD_ROWS = 2_000_000
+PARTITION_COLUMNS = ("language", "year")
+
+# skemman_files.language holds the fastText labels (language_id.LANGUAGE_NAMES, or the bare
+# code for other languages) and skemman_metadata.language the lower cased name on the
+# document page, usually in icelandic, these map both to ISO 639-1 codes
+LANGUAGE_CODES = {
+    "icelandic": "is", "íslenska": "is",
+    "english": "en", "enska": "en",
+    "danish": "da", "danska": "da",
+    "norwegian": "no", "norska": "no",
+    "swedish": "sv", "sænska": "sv",
+    "finnish": "fi", "finnska": "fi",
+    "faroese": "fo", "færeyska": "fo",
+    "german": "de", "þýska": "de",
+    "french": "fr", "franska": "fr",
+    "spanish": "es", "spænska": "es",
+    "italian": "it", "ítalska": "it",
+    "portuguese": "pt", "portúgalska": "pt",
+    "polish": "pl", "pólska": "pl",
+    "russian": "ru", "rússneska": "ru",
+    "chinese": "zh", "kínverska": "zh",
+    "japanese": "ja", "japanska": "ja",
+    "latin": "la", "latína": "la",
+}
+
+_METADATA_FIELDS = [
+    ("skemman_id", "string"),
+    ("document_href", "string"),
+    ("taxonomy", "string"),
+    ("language", "string"),
+    ("year", "int32"),
+]
+
+TABLES = {
+    "segments": {
+        "sql": """
+            SELECT s.document_id, s.id, s.sentence_index, s.text, d.skemman_id
+            FROM segments AS s
+            INNER JOIN documents AS d ON d.id = s.document_id
+            ORDER BY s.document_id, s.id
+        """,
+        "fields": [
+            ("document_id", "int64"),
+            ("segment_id", "int64"),
+            ("sentence_index", "int32"),
+            ("text", "string"),
+        ],
+    },
+    "cleaned_segments": {
+        "sql": """
+            SELECT c.document_id, c.id, c.segment_index, c.text, c.metadata, d.skemman_id
+            FROM cleaned_segments AS c
+            INNER JOIN documents AS d ON d.id = c.document_id
+            ORDER BY c.document_id, c.id
+        """,
+        "fields": [
+            ("document_id", "int64"),
+            ("cleaned_segment_id", "int64"),
+            ("segment_index", "int64"),
+            ("text", "string"),
+            ("metadata", "string"),
+        ],
+    },
+}
+
+
+def _schema(fields):
+    return pa.schema([(name, getattr(pa, type_name)()) for (name, type_name) in fields])
+
+
+def get_skemman_metadata():
+    """ Map from segment.db skemman_id (the file url) to document metadata """
+    db = SkemmanDb.shared()
+    by_url = {}
+    for (file_href, document_href, taxonomy, language, year) in db.get_file_metadata():
+        by_url[Skemman.make_url(file_href)] = (document_href, taxonomy, language, year)
+    return by_url
+
+
+class _ShardWriter:
+    """ Buffers rows for one partition and writes row groups to rotating shard files """
+
+    def __init__(self, table_dir, partition_by, partition_value, schema):
+        self.dir = table_dir / f"{partition_by}={partition_value}"
+        self.partition = {partition_by: partition_value}
+        self.schema = schema
+        self.columns = [[] for _ in schema.names]
+        self.writer = None
+        self.shards = []
+        self.shard = None
+
+    def add(self, row):
+        for (column, value) in zip(self.columns, row):
+            column.append(value)
+        if len(self.columns[0]) >= ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.columns[0]:
+            return
+        if self.writer is None or self.shard["num_rows"] >= SHARD_ROWS:
+            self._next_shard()
+        batch = pa.Table.from_arrays(
+            [pa.array(column, type=field.type) for (column, field) in zip(self.columns, self.schema)],
+            schema=self.schema,
+        )
+        self.writer.write_table(batch, row_group_size=ROW_GROUP_SIZE)
+        document_ids = self.columns[0]
+        self.shard["num_rows"] += len(document_ids)
+        self.shard["num_row_groups"] += 1
+        if self.shard["min_document_id"] is None:
+            self.shard["min_document_id"] = document_ids[0]
+        self.shard["max_document_id"] = document_ids[-1]
+        self.columns = [[] for _ in self.schema.names]
+
+    def _next_shard(self):
+        self.close()
+        os.makedirs(self.dir, exist_ok=True)
+        path = self.dir / f"part-{len(self.shards):05d}.parquet"
+        self.writer = pq.ParquetWriter(str(path), self.schema, compression="zstd")
+        self.shard = {
+            "path": str(path),
+            "partition": self.partition,
+            "num_rows": 0,
+            "num_row_groups": 0,
+            "min_document_id": None,
+            "max_document_id": None,
+        }
+        self.shards.append(self.shard)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def language_code(language):
+    """ ISO 639-1 code of a language label or name, names without a code are transliterated """
+    if not language:
+        return None
+    language = language.strip().lower()
+    if language in LANGUAGE_CODES.values():
+        return language
+    return LANGUAGE_CODES.get(language, transliterate_path(language))
+
+
+def _partition_value(partition_by, language, year):
+    if partition_by == "year":
+        return str(year) if year is not None else "unknown"
+    return language or "unknown"
+
+
+def export_table(seg_db, name, out_dir, partition_by, metadata):
+    spec = TABLES[name]
+    fields = spec["fields"] + _METADATA_FIELDS
+    schema = _schema(fields)
+    table_dir = out_dir / name
+    writers = {}
+    num_rows = 0
+    with seg_db.engine.connect() as conn:
+        result = conn.execute(spec["sql"])
+        while True:
+            rows = result.fetchmany(ROW_GROUP_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                *values, skemman_id = row
+                document_href, taxonomy, language, year = metadata.get(skemman_id, (None,) * 4)
+                # The same code in the column and the partition directory
+                language = language_code(language)
+                value = _partition_value(partition_by, language, year)
+                writer = writers.get(value)
+                if writer is None:
+                    writer = writers[value] = _ShardWriter(table_dir, partition_by, value, schema)
+                writer.add((*values, skemman_id, document_href, taxonomy, language, year))
+            num_rows += len(rows)
+            print(f"{name}: {num_rows} rows", end="\r", flush=True)
+    print()
+    shards = []
+    for writer in writers.values():
+        writer.flush()
+        writer.close()
+        shards.extend(writer.shards)
+    for shard in shards:
+        shard["path"] = str(Path(shard["path"]).relative_to(out_dir))
+    return shards
+
+
+def export_corpus(out_dir, partition_by="language", tables=("segments", "cleaned_segments")):
+    if pa is None:
+        raise RuntimeError("Exporting needs pyarrow, pip install pyarrow")
+    if partition_by not in PARTITION_COLUMNS:
+        raise ValueError(f"Cannot partition by {partition_by}, use one of {PARTITION_COLUMNS}")
+    out_dir = Path(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    seg_db = SegmentDb()
+    metadata = get_skemman_metadata()
+    manifest = {
+        "created": str(datetime.datetime.now()),
+        "partition_by": partition_by,
+        "compression": "zstd",
+        "row_group_size": ROW_GROUP_SIZE,
+        "tables": {},
+    }
+    for name in tables:
+        manifest["tables"][name] = export_table(seg_db, name, out_dir, partition_by, metadata)
+    with open(out_dir / "manifest.json", "w") as fh:
+        json.dump(manifest, fh, ensure_ascii=False, indent=2)
+    print(f"Wrote manifest to {out_dir / 'manifest.json'}")
+    return manifest
+
+
+if __name__ == "__main__":
+    export_corpus(Path("export"))
@@ -1,12 +1,9 @@
 from pathlib import Path
 import sys, subprocess
 import traceback
-import tempfile
+import multiprocessing
 import random
 import re
-import time
-
-from alternative_extractions import extract_with_pdfbox
 
 try:
     from icecream import ic
@@ -18,7 +15,13 @@ import tokenizer
 
 import sqlalchemy
 import sqlalchemy.sql
-from sqlalchemy import Table, Column, Integer, String, MetaData, ForeignKey, Sequence
+from sqlalchemy import Table, Column, Integer, String, MetaData, ForeignKey, Sequence, UniqueConstraint
+
+import config
+from pattern_matcher import PatternMatcher
+from text_document import TextDocument
+from segment_skemman import extract_text, init_pdfbox_worker, pdfbox_worker_settings, worker_pdfbox
+from utils import get_open_access_article_pdfs, wait_for_cool_down
 
 """
 .mode lines
@@ -112,7 +115,19 @@ how does hunalign/gale-church/bleualign handle adjacent swapping e.g. true align
 
 """
 
-PATHS_FILE = config.data_dir / "both_abstracts.paths"
+PATHS_FILE_NAME = "both_abstracts.paths"
+
+# Abstracts are looked for on this many first pages, see "within 10 pages of start" above
+ABSTRACT_MAX_PAGES = 10
+# Pages read past ABSTRACT_MAX_PAGES, for abstracts that continue onto the following pages
+ABSTRACT_TAIL_PAGES = 2
+
+# Inserts into AbstractsDb are committed this many documents at a time
+INSERT_BATCH_SIZE = 100
+# Outcome of each document in the extracted table
+INSERTED = "inserted"
+NO_ABSTRACT = "no_abstract"
+DUPLICATE = "duplicate"
 
 
 def read_file(path):
@@ -123,9 +138,15 @@ def read_file(path):
     return lines
 
 
-PATHS = [config.data_dir / path for path in read_file(PATHS_FILE)]
-SAMPLE_INDEX = 1
-SAMPLE_PATH = PATHS[SAMPLE_INDEX]
+def read_paths(paths_file=None):
+    """ Documents to mine for abstracts, from both_abstracts.paths in the data dir (paths relative
+        to the data dir) if it exists, otherwise every main pdf that has been downloaded """
+    paths_file = paths_file if paths_file is not None else config.data_dir / PATHS_FILE_NAME
+    if Path(paths_file).is_file():
+        return [config.data_dir / path for path in read_file(paths_file)]
+    return [item.local_path for item in get_open_access_article_pdfs() if item.is_on_disk]
+
+
 ENG_START_PATS = ("Abstract", "ABSTRACT")
 ISL_START_PATS = ("Abstrakt", "ABSTRAKT", "Ágrip", "ÁGRIP", "Útdráttur", "ÚTDRÁTTUR")
 ISL_END_KWORDS = ("Lykilhugtök", "Lykil hugtök", "Lykilorð", "Lykil orð", "Efnisorð", "Efnis orð", ".....", "Formáli", "Efnisyfirlit")
@@ -134,6 +155,15 @@ ENG_END_KWORDS = ("Keywords", "Key words", ".....", "Table of contents", "Key te
 ISL_END_PATS = ISL_END_KWORDS + ENG_START_PATS
 ENG_END_PATS = ENG_START_PATS + ISL_START_PATS + ISL_END_PATS
 
+# All of the above in one scan of the text. Start patterns are case sensitive, end patterns are not.
+ABSTRACT_MATCHER = PatternMatcher(
+    [(pat, "eng_start", False) for pat in ENG_START_PATS]
+    + [(pat, "isl_start", False) for pat in ISL_START_PATS]
+    + [(pat, "isl_end", True) for pat in ISL_END_PATS]
+    + [(pat, "eng_end", True) for pat in ENG_END_PATS]
+)
+TOC_DOTS = "....."
+
 NUMERAL_RX = re.compile("^([iIvVxX0-9])+$")
 HLINE = 88 * "#"
 
@@ -145,7 +175,9 @@ def as_pages(stream):
             continue
         if page:
             yield page
-            page = [line.strip()]
+        page = [line.strip()]
+    if page:
+        yield page
 
 
 def render_file(path):
@@ -181,16 +213,26 @@ def paged_render(text):
         pass
 
 
+def abstract_lines(hits):
+    """ Sorted line numbers of ABSTRACT_MATCHER hits by label. Start patterns on lines
+        with ..... are left out, those are in the table of contents. """
+    dotted = set(hit.line for hit in hits if hit.pattern == TOC_DOTS)
+    lines = {"eng_start": set(), "isl_start": set(), "isl_end": set(), "eng_end": set()}
+    for hit in hits:
+        if hit.label.endswith("_start") and hit.line in dotted:
+            continue
+        lines[hit.label].add(hit.line)
+    return {label: sorted(line_idxs) for (label, line_idxs) in lines.items()}
+
+
 def get_abstracts_from_text(text):
     lines = text.split("\n")
-    def get_contiguous_text_at_pat(lines, patterns):
-        start_idx = None
-        for line_idx, line in enumerate(lines):
-            for substring in patterns:
-                if substring in line and not "....." in line:
-                    start_idx = line_idx
-        if start_idx == None:
+    starts = abstract_lines(ABSTRACT_MATCHER.scan(text))
+    def get_contiguous_text_at(start_idxs):
+        if not start_idxs:
             return None
+        # the last mention
+        start_idx = start_idxs[-1]
         return_lines = []
         for offset, line in enumerate(lines[start_idx:]):
             if line.strip():
@@ -198,8 +240,8 @@ def get_abstracts_from_text(text):
             else:
                 break
         return return_lines
-    eng = get_contiguous_text_at_pat(lines, ENG_START_PATS)
-    isl = get_contiguous_text_at_pat(lines, ISL_START_PATS)
+    eng = get_contiguous_text_at(starts["eng_start"])
+    isl = get_contiguous_text_at(starts["isl_start"])
     return eng, isl
 
 
@@ -207,42 +249,43 @@ class Document:
     def __init__(self, path):
         """docstring"""
         self.path = path
-        self.pages = None
+        self._text = None
 
-    def _maybe_get_pages(self):
-        if self.pages is None:
-            self.pages = list(as_pages(read_file(self.path)))
+    @property
+    def text(self):
+        """ The text file as a TextDocument, memory mapped on first use until close() """
+        if self._text is None:
+            self._text = TextDocument.open(self.path)
+        return self._text
 
-    def find_abstracts(self):
-        self._maybe_get_pages()
-        # (abstrakt|abstrakt|ágrip|ágrip|útdráttur|útdráttur)  -- 18603
-        # (abstract|abstract)
-        eng_occurr = set()
-        isl_occurr = set()
-        for page_idx, page in enumerate(self.pages):
-            for substring in ENG_START_PATS:
-                if any(substring in line for line in page):
-                    eng_occurr.add(page_idx)
-            for substring in ISL_START_PATS:
-                if any(substring in line for line in page):
-                    isl_occurr.add(page_idx)
-        return sorted(list(eng_occurr)), sorted(list(isl_occurr))
+    def close(self):
+        if self._text is not None:
+            self._text.close()
+            self._text = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def find_abstracts(self, max_pages=ABSTRACT_MAX_PAGES):
+        """ Indices of the pages mentioning an english and an icelandic abstract, among the first max_pages """
+        hits = ABSTRACT_MATCHER.scan(self.text.head(max_pages))
+        eng_occurr = set(hit.page for hit in hits if hit.label == "eng_start")
+        isl_occurr = set(hit.page for hit in hits if hit.label == "isl_start")
+        return sorted(eng_occurr), sorted(isl_occurr)
 
     def render_page(self, page_idx):
-        self._maybe_get_pages()
-        return "\n".join(self.pages[page_idx])
+        return self.text.page(page_idx)
 
     def draw(self):
-        self._maybe_get_pages()
         try:
             pager = subprocess.Popen(["less", "-F", "-R", "-S", "-X", "-K"], stdin=subprocess.PIPE, stdout=sys.stdout)
-            line_idx = -1
-            for idx, page in enumerate(self.pages):
+            for page in self.text.pages():
                 pager.stdin.write(b"----------------------------------------------------------------------------------------\n")
-                for line in page:
-                    line_idx += 1
-                    pager.stdin.write(line.encode("utf8"))
-                    pager.stdin.write(b"\n")
+                pager.stdin.write(page.encode("utf8"))
+                pager.stdin.write(b"\n")
             pager.stdin.flush()
             pager.stdin.close()
             pager.wait()
@@ -251,12 +294,11 @@ class Document:
         except BrokenPipeError:
             pass
 
-    def extract_pdfbox(self):
+    def extract_pdfbox(self, pdfbox=None):
+        """ Text of the pdf next to self.path, pdfbox is a running PdfBoxServer or None to start java once """
         if self.path is not None:
-            tfile = tempfile.NamedTemporaryFile(suffix="txt")
-            extract_with_pdfbox(self.path.with_suffix(".pdf"), tfile.name)
-            text = tfile.read().decode("utf8")
-            return text
+            text = extract_text(Path(self.path).with_suffix(".pdf"), pdfbox)
+            return text if text is not None else ""
         raise ValueError
 
 
@@ -276,8 +318,12 @@ def line_has_pat(line, pats):
 
 
 class PdfBoxOutput:
-    def __init__(self, pdfbox_output):
-        """docstring"""
+    def __init__(self, pdfbox_output, max_pages=None):
+        """ With max_pages, only abstracts starting on the first max_pages pages are found,
+            and only a few pages past those are read at all """
+        self.max_pages = max_pages
+        if max_pages is not None:
+            pdfbox_output = TextDocument(pdfbox_output).head(max_pages + ABSTRACT_TAIL_PAGES)
         self.text = pdfbox_output
         self.lines = self.text.split("\n")
         if self.lines == [""]:
@@ -286,6 +332,21 @@ class PdfBoxOutput:
         self.isl_offsets = []
         self.max_abstract_len = 100  # lines
         self.max_num_empty = 2  # lines
+        self._abstract_lines = None
+        self._end_lines = None
+
+    def _scan(self):
+        """ Pattern hits by line, from one scan of the text """
+        if self._abstract_lines is None:
+            hits = ABSTRACT_MATCHER.scan(self.text)
+            if self.max_pages is not None:
+                hits = [hit for hit in hits if hit.page < self.max_pages or not hit.label.endswith("_start")]
+            self._abstract_lines = abstract_lines(hits)
+            self._end_lines = {
+                "isl": set(self._abstract_lines["isl_end"]),
+                "eng": set(self._abstract_lines["eng_end"]),
+            }
+        return self._abstract_lines
 
     def has_text(self):
         return not not self.lines
@@ -296,18 +357,11 @@ class PdfBoxOutput:
     def find_abstracts_starts(self):
         # (abstrakt|abstrakt|ágrip|ágrip|útdráttur|útdráttur)  -- 18603
         # (abstract|abstract)
-        def find_pattern_occurrences(lines, patterns):
-            idxs = []
-            for line_idx, line in enumerate(lines):
-                for substring in patterns:
-                    if substring in line and not "....." in line:
-                        idxs.append(line_idx)
-            return idxs
-
-        eng = find_pattern_occurrences(self.lines, ENG_START_PATS)
+        lines = self._scan()
+        eng = lines["eng_start"]
         if not eng:
             return None
-        isl = find_pattern_occurrences(self.lines, ISL_START_PATS)
+        isl = lines["isl_start"]
         if not isl:
             return None
         self.eng_offsets = eng
@@ -335,7 +389,9 @@ class PdfBoxOutput:
             raise ValueError("")
         num_empty = 0
         start = self.isl_offsets[0]
-        end = min(start + self.max_abstract_len, len(self.lines) - start)
+        self._scan()
+        isl_end_lines = self._end_lines["isl"]
+        end = min(start + self.max_abstract_len, len(self.lines))
         # ic(end)
         for line_idx, line in enumerate(self.lines[start + 1: end], start + 1):
             # ic(line)
@@ -344,7 +400,7 @@ class PdfBoxOutput:
             num_empty = num_empty + 1 if line.strip() == "" else 0
             # if NUMERAL_RX.match(line.strip()):
             #     num_empty = 0
-            if (num_empty >= self.max_num_empty) or line_has_pat(line, ISL_END_PATS):
+            if (num_empty >= self.max_num_empty) or line_idx in isl_end_lines:
                 end = line_idx
                 break
         # ic(end)
@@ -354,8 +410,10 @@ class PdfBoxOutput:
         if not self.eng_offsets:
             raise ValueError("")
         start = self.eng_offsets[0]
-        end = min(start + self.max_abstract_len, len(self.lines) - start)
+        end = min(start + self.max_abstract_len, len(self.lines))
         num_empty = 0
+        self._scan()
+        eng_end_lines = self._end_lines["eng"]
         # ic(end)
         for line_idx, line in enumerate(self.lines[start + 1: end], start + 1):
             # ic(line)
@@ -363,7 +421,7 @@ class PdfBoxOutput:
             num_empty = num_empty + 1 if line.strip() == "" else 0
             # if NUMERAL_RX.match(line.strip()):
             #     num_empty = 0
-            if (num_empty >= self.max_num_empty) or line_has_pat(line, ENG_END_PATS):
+            if (num_empty >= self.max_num_empty) or line_idx in eng_end_lines:
                 end = line_idx
                 break
         # ic(end)
@@ -417,16 +475,43 @@ class AbstractsDb:
             Column("isl", sqlalchemy.String, unique=True, nullable=False),
             Column("eng", sqlalchemy.String, unique=True, nullable=False),
         )
+        # Sentence pairs of each abstract, see align.py
         self.segmented = sqlalchemy.Table(
             "segmented",
             metadata,
             Column("id", sqlalchemy.Integer, autoincrement=True, primary_key=True),
-            Column("path", sqlalchemy.String, unique=True, nullable=False),
-            Column("eng", sqlalchemy.String, unique=True, nullable=False),
-            Column("isl", sqlalchemy.String, unique=True, nullable=False),
+            Column("path", sqlalchemy.String, nullable=False),
+            Column("pair_index", sqlalchemy.Integer, nullable=False),
+            Column("eng", sqlalchemy.String, nullable=False),
+            Column("isl", sqlalchemy.String, nullable=False),
+            Column("score", sqlalchemy.Float, nullable=False),
+            UniqueConstraint("path", "pair_index"),
+        )
+        # Checkpoint of do_extract_all, every document that was read, with the outcome,
+        # one of INSERTED, NO_ABSTRACT or DUPLICATE
+        self.extracted = sqlalchemy.Table(
+            "extracted",
+            metadata,
+            Column("path", sqlalchemy.String, primary_key=True),
+            Column("status", sqlalchemy.String, nullable=False),
         )
+        # Checkpoint of align.align_all, abstracts that gave no pairs are in here too
+        self.aligned = sqlalchemy.Table(
+            "aligned",
+            metadata,
+            Column("path", sqlalchemy.String, primary_key=True),
+            Column("num_pairs", sqlalchemy.Integer, nullable=False),
+        )
+        self._migrate()
         metadata.create_all(self.engine)
 
+    def _migrate(self):
+        """ segmented used to hold one row per document, that table is kept as segmented_legacy """
+        with self.engine.begin() as conn:
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(segmented)")]
+            if columns and "pair_index" not in columns:
+                conn.execute("ALTER TABLE segmented RENAME TO segmented_legacy")
+
     def insert(self, path, eng=None, isl=None):
         if eng is None or isl is None:
             raise ValueError("Value eng or isl cannot be None")
@@ -439,17 +524,79 @@ class AbstractsDb:
                 eng=eng,
             )
 
-    def insert_segmented(self, path, eng=None, isl=None):
-        if eng is None or isl is None:
-            raise ValueError("Value eng or isl cannot be None")
-        path = str(path)
+    def insert_aligned(self, documents):
+        """ documents of (path, [(eng, isl, score)]) in one transaction, replacing the pairs
+            already stored for those paths. Returns the number of pairs inserted. """
+        pairs = [
+            (str(path), pair_index, eng, isl, score)
+            for (path, doc_pairs) in documents
+            for (pair_index, (eng, isl, score)) in enumerate(doc_pairs)
+        ]
         with self.engine.begin() as connection:
-            result = connection.execute(
-                self.segmented.insert(),
-                path=path,
-                isl=isl,
-                eng=eng,
+            cursor = connection.connection.cursor()
+            cursor.executemany("DELETE FROM segmented WHERE path = ?", [(str(path),) for (path, _) in documents])
+            cursor.executemany(
+                "INSERT INTO segmented (path, pair_index, eng, isl, score) VALUES (?, ?, ?, ?, ?)", pairs
+            )
+            cursor.executemany(
+                "INSERT OR REPLACE INTO aligned (path, num_pairs) VALUES (?, ?)",
+                [(str(path), len(doc_pairs)) for (path, doc_pairs) in documents],
+            )
+            cursor.close()
+        return len(pairs)
+
+    def get_segmented_paths(self):
+        """ Paths of abstracts that have been aligned, whether or not they gave any pairs """
+        with self.engine.begin() as connection:
+            result = connection.execute("SELECT path FROM aligned UNION SELECT path FROM segmented")
+            return set(row[0] for row in result)
+
+    def insert_many(self, rows):
+        """ rows of (path, eng, isl) in one transaction. Abstracts that are already stored,
+            under this path or as the abstract of another document, are skipped.
+            Returns the number of rows inserted. """
+        sql = "INSERT OR IGNORE INTO abstracts (path, isl, eng) VALUES (?, ?, ?)"
+        with self.engine.begin() as connection:
+            cursor = connection.connection.cursor()
+            before = connection.connection.total_changes
+            cursor.executemany(sql, [(str(path), isl, eng) for (path, eng, isl) in rows])
+            inserted = connection.connection.total_changes - before
+            cursor.close()
+            return inserted
+
+    def insert_extracted(self, documents):
+        """ documents of (path, (eng, isl) or None) in one transaction, each is recorded in
+            extracted. Returns the status of each document. """
+        statuses = []
+        with self.engine.begin() as connection:
+            cursor = connection.connection.cursor()
+            for (path, abstracts) in documents:
+                if abstracts is None:
+                    statuses.append(NO_ABSTRACT)
+                    continue
+                (eng, isl) = abstracts
+                cursor.execute(
+                    "INSERT OR IGNORE INTO abstracts (path, isl, eng) VALUES (?, ?, ?)", (str(path), isl, eng)
+                )
+                # Ignored when the path or either abstract is stored already
+                statuses.append(INSERTED if cursor.rowcount == 1 else DUPLICATE)
+            cursor.executemany(
+                "INSERT OR REPLACE INTO extracted (path, status) VALUES (?, ?)",
+                [(str(path), status) for ((path, _), status) in zip(documents, statuses)],
             )
+            cursor.close()
+        return statuses
+
+    def get_extracted_paths(self):
+        """ Paths of documents that abstracts have been looked for in, whether or not any were stored """
+        with self.engine.begin() as connection:
+            result = connection.execute("SELECT path FROM extracted UNION SELECT path FROM abstracts")
+            return set(row[0] for row in result)
+
+    def get_paths(self):
+        with self.engine.begin() as connection:
+            result = connection.execute(sqlalchemy.sql.select([self.abstracts.c.path]))
+            return set(row[0] for row in result)
 
     def contains_path(self, path):
         path = str(path)
@@ -495,119 +642,130 @@ def segment_abstract(text):
     return text
 
 
-# doc.draw()
-# res = doc.extract_pdfbox()
-# paged_render(res)
-
-db = AbstractsDb()
-items = db.get_all_items()
-random.seed(12345)
-random.shuffle(items)
-no_punct = 0
-eng_out = open("debug.eng", "w")
-isl_out = open("debug.isl", "w")
-for (path, isl, eng) in items:
-    if len(isl) < 50 or len(eng) < 50:
-        print("skipped chars")
-        # no abstract under 50 chars allowed
-        continue
-    isl = segment_abstract(isl)
-    eng = segment_abstract(eng)
-    if not isl.strip() or not eng.strip():
-        continue
-    isl_line_count = isl.count("\n")
-    eng_line_count = eng.count("\n")
-    if (isl_line_count < 3 or 150 < isl_line_count) or (eng_line_count < 3 or 150 < eng_line_count):
-        print("skipped line count")
-        continue
-    PUNCTS = "!?."
-    last_isl = isl.split("\n")[-1]
-    last_eng = eng.split("\n")[-1]
-    last = no_punct
-    if last_isl[-1] not in PUNCTS and not (len(last_isl.split(" ")) < 3):
-        # ic(path)
-        # ic(last_isl)
-        # no_punct += 1
-        print("isl punct")
-        continue
-    elif last_eng[-1] not in PUNCTS and not (len(last_eng.split(" ")) < 3):
-        # ic(path)
-        # ic(last_eng)
-        # no_punct += 1
-        print("eng punct")
-        continue
-    # ic(no_punct)
-
-    eng_out.write(eng)
-    eng_out.write("\n\n")
-    isl_out.write(isl)
-    isl_out.write("\n\n")
-
-    # output = [path]
-    # output.extend([HLINE] * 3)
-    # output.extend([isl])
-    # output.extend([HLINE] * 3)
-    # output.extend([eng])
-    # paged_render("\n".join(output))
-
-    # input("Next?")
-
-    # if last != no_punct:
-    #     ic(no_punct)
-    #     input("Next?")
-
-    # break
-    # pass
-eng_out.close()
-isl_out.close()
-
-# try:
-#     db.insert("mypath", "myisl", "myeng")
-# except sqlalchemy.exc.IntegrityError as e:
-#     pass
-# print(db.contains_path("mypath"))
-# print(db.contains_path("mypath1"))
-# sys.exit(0)
-
-def do_extract_all():
-    random.seed(1234567)
-    paths = list(PATHS)
-    random.shuffle(paths)
-    for sample_idx, doc_path in enumerate(paths):
-        if db.contains_path(doc_path):
-            ic("skipping:", doc_path)
+def write_debug_abstracts(db, eng_path="debug.eng", isl_path="debug.isl"):
+    """ Segment every stored abstract that passes the sanity checks into paragraph aligned files """
+    items = db.get_all_items()
+    random.seed(12345)
+    random.shuffle(items)
+    no_punct = 0
+    eng_out = open(eng_path, "w")
+    isl_out = open(isl_path, "w")
+    for (path, isl, eng) in items:
+        if len(isl) < 50 or len(eng) < 50:
+            print("skipped chars")
+            # no abstract under 50 chars allowed
             continue
-        ic("processing:", doc_path)
-        doc = Document(doc_path)
-        text_pdfbox = doc.extract_pdfbox()
-        obj = PdfBoxOutput(text_pdfbox)
-        found = obj.find_abstracts_starts()
-
-        if not obj.has_text() or not found:
-            ic("could not find text or abstract")
+        isl = segment_abstract(isl)
+        eng = segment_abstract(eng)
+        if not isl.strip() or not eng.strip():
             continue
-
-        # # if not found:
-        # #     with open("not_found_log.txt", "a") as fp:
-        # #         fp.write(f"could not find abstracts but has text '{docpath}'\n")
-        # #     print()
-        # #     input(f"Abstract not found: rendering {len(obj.lines)} lines")
-        # #     import pdb; pdb.set_trace()
-        # #     obj.render_all()
-        # obj.render_abstracts_v1()
-
-        eng_abs, isl_abs = obj.get_abstracts()
-        try:
-            db.insert(doc_path, eng=eng_abs, isl=isl_abs)
-        except sqlalchemy.exc.IntegrityError as e:
-            print(e)
+        isl_line_count = isl.count("\n")
+        eng_line_count = eng.count("\n")
+        if (isl_line_count < 3 or 150 < isl_line_count) or (eng_line_count < 3 or 150 < eng_line_count):
+            print("skipped line count")
             continue
-
+        PUNCTS = "!?."
+        last_isl = isl.split("\n")[-1]
+        last_eng = eng.split("\n")[-1]
+        if last_isl[-1] not in PUNCTS and not (len(last_isl.split(" ")) < 3):
+            # ic(path)
+            # ic(last_isl)
+            # no_punct += 1
+            print("isl punct")
+            continue
+        elif last_eng[-1] not in PUNCTS and not (len(last_eng.split(" ")) < 3):
+            # ic(path)
+            # ic(last_eng)
+            # no_punct += 1
+            print("eng punct")
+            continue
+        # ic(no_punct)
+
+        eng_out.write(eng)
+        eng_out.write("\n\n")
+        isl_out.write(isl)
+        isl_out.write("\n\n")
+
+        # output = [path]
+        # output.extend([HLINE] * 3)
+        # output.extend([isl])
+        # output.extend([HLINE] * 3)
+        # output.extend([eng])
+        # paged_render("\n".join(output))
+    eng_out.close()
+    isl_out.close()
+
+
+def extract_document_abstracts(doc_path, pdfbox=None):
+    """ (eng, isl) abstracts of a document, None if either is missing """
+    with Document(doc_path) as doc:
+        obj = PdfBoxOutput(doc.extract_pdfbox(pdfbox), max_pages=ABSTRACT_MAX_PAGES)
+    if not obj.has_text() or not obj.find_abstracts_starts():
+        return None
+    return obj.get_abstracts()
+
+
+def _extract_abstracts(doc_path):
+    """ (doc_path, abstracts or None, whether extraction failed) """
+    try:
+        wait_for_cool_down(verbose=False)
+        return doc_path, extract_document_abstracts(doc_path, worker_pdfbox()), False
+    except Exception:
+        traceback.print_exc()
+        return doc_path, None, True
+
+
+def do_extract_all(workers=None, paths=None, db=None):
+    """ Extract abstracts of every document not already in AbstractsDb in a pool of worker
+        processes, this process inserts them in batches """
+    db = db if db is not None else AbstractsDb()
+    paths = paths if paths is not None else read_paths()
+    done = db.get_extracted_paths()
+    paths = [path for path in paths if str(path) not in done]
+    random.seed(1234567)
+    random.shuffle(paths)
+    print(f"{len(done)} documents done, {len(paths)} remaining")
+    workers = workers or multiprocessing.cpu_count()
+    settings = pdfbox_worker_settings(verbose=False)
+    pool = multiprocessing.Pool(workers, initializer=init_pdfbox_worker, initargs=settings)
+    documents = []
+    processed = inserted = found = 0
+
+    def flush():
+        nonlocal inserted, documents
+        if not documents:
+            return
+        statuses = db.insert_extracted(documents)
+        inserted += statuses.count(INSERTED)
         with open("extraction_abstracts.log", "a") as fp:
-            ic("inserted")
-            fp.write(f"inserted: '{doc_path}'\n")
-
-        # input()
-        # prevent overheating
-        time.sleep(3)
+            for ((doc_path, _), status) in zip(documents, statuses):
+                fp.write(f"{status}: '{doc_path}'\n")
+        documents = []
 
+    try:
+        for (doc_path, abstracts, failed) in pool.imap_unordered(_extract_abstracts, paths):
+            processed += 1
+            if not failed:
+                # Also the documents without abstracts, so they are not extracted again
+                documents.append((doc_path, abstracts))
+                found += abstracts is not None
+            if len(documents) >= INSERT_BATCH_SIZE:
+                flush()
+            print(f"[{processed}/{len(paths)}] {found} abstracts found", end="\r", flush=True)
+        pool.close()
+        print()
+    except KeyboardInterrupt:
+        print()
+        print(f"Exiting... {len(paths) - processed} remaining")
+        pool.terminate()
+    finally:
+        pool.join()
+        flush()
+    print(f"Inserted {inserted} abstracts")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["debug"]:
+        write_debug_abstracts(AbstractsDb())
+    else:
+        do_extract_all()
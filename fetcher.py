@@ -1,20 +1,87 @@
 #!/usr/bin/env python
 
 import os
+import re
 import time
+from collections import namedtuple
 import requests
+import requests.adapters
 import shutil
 
+import config
+from http_cache import CacheMiss
+
+
+# Stands in for a requests.Response when the body comes from the cache
+CachedResponse = namedtuple("CachedResponse", "url content status_code")
+
 
 TIME_TIL_RETRY = 0.01
 MAX_RETRY = 5
 
+DEFAULT_HEADERS = {
+    "Accept-Encoding": "gzip, deflate",
+    "Connection": "keep-alive",
+}
+
 
 class Fetcher:
 
     _wait_before_next = True
     _time_last_fetched = time.time() - TIME_TIL_RETRY
 
+    _pool_size = config.http_pool_size
+    _headers = dict(DEFAULT_HEADERS)
+    _session = None
+    _session_pid = None
+    _cache = None
+    # Requests sent to a server, pages served from the offline cache are not counted
+    requests_made = 0
+
+    @classmethod
+    def configure(cls, pool_size=None, keep_alive=True, gzip=True):
+        """ Set connection pool options, takes effect on the next request """
+        if pool_size is not None:
+            cls._pool_size = pool_size
+        headers = dict(DEFAULT_HEADERS)
+        headers["Connection"] = "keep-alive" if keep_alive else "close"
+        headers["Accept-Encoding"] = "gzip, deflate" if gzip else "identity"
+        cls._headers = headers
+        cls.close()
+
+    @classmethod
+    def session(cls):
+        """ Shared session so connections to the same host are reused """
+        # A forked child must not share sockets with its parent
+        if cls._session is None or cls._session_pid != os.getpid():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=cls._pool_size,
+                pool_maxsize=cls._pool_size,
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update(cls._headers)
+            cls._session = session
+            cls._session_pid = os.getpid()
+        return cls._session
+
+    @classmethod
+    def use_cache(cls, cache):
+        """ Serve fetch from an http_cache.HttpCache, None disables caching """
+        cls._cache = cache
+
+    @classmethod
+    def is_offline(cls):
+        return cls._cache is not None and cls._cache.offline
+
+    @classmethod
+    def close(cls):
+        if cls._session is not None and cls._session_pid == os.getpid():
+            cls._session.close()
+        cls._session = None
+        cls._session_pid = None
+
     @classmethod
     def fetch_maybe(cls, url, path, save=False):
         """ Fetch from url or from file if it has been
@@ -43,6 +110,7 @@ class Fetcher:
         """ Fetch with retry """
         # print("Fetching with retry...", url)
         for c in range(MAX_RETRY + 1):
+            # CacheMiss is not retried, the cache will not change
             resp = cls.fetch(url)
             if resp:
                 return resp.content
@@ -53,29 +121,110 @@ class Fetcher:
 
     @classmethod
     def fetch(cls, url):
-        """ Fetch a single url """
+        """ Fetch a single url, revalidating against the cache if there is one """
+        cache = cls._cache
+        entry = cache.lookup(url) if cache is not None else None
+        if cache is not None and cache.offline:
+            if entry is None:
+                raise CacheMiss(url)
+            return CachedResponse(url, cache.read(entry), 200)
+
         delta = time.time() - cls._time_last_fetched
         wait_time = TIME_TIL_RETRY - delta
         if wait_time > 0:
             time.sleep(wait_time)
-        resp = requests.get(url)
+        cls.requests_made += 1
+        resp = cls.session().get(url, headers=cache.conditional_headers(entry) if cache else None)
         cls._time_last_fetched = time.time()
+        if entry is not None and resp.status_code == 304:
+            return CachedResponse(url, cache.read(entry), 200)
         resp.raise_for_status()
+        if cache is not None:
+            cache.store(
+                url,
+                resp.content,
+                etag=resp.headers.get("ETag"),
+                last_modified=resp.headers.get("Last-Modified"),
+            )
         return resp
 
 
-def download_file(url, path, tmp_path, make_dirs=False):
+# bytes 100-199/1000, or bytes */1000 on a 416
+CONTENT_RANGE_RX = re.compile(r"bytes\s+(?:(\d+)-\d+|\*)/(\d+|\*)")
+
+
+def parse_content_range(value):
+    """ (first byte, total size) from a Content-Range header, either may be None """
+    match = CONTENT_RANGE_RX.match(value or "")
+    if match is None:
+        return None, None
+    (start, total) = match.groups()
+    return (
+        int(start) if start is not None else None,
+        int(total) if total != "*" else None,
+    )
+
+
+def remote_size(url, response=None):
+    """ Size of the file at url, from the Content-Range of response if it has one,
+        otherwise from a HEAD request. None if the server does not say. """
+    if response is not None:
+        (_, total) = parse_content_range(response.headers.get("Content-Range"))
+        if total is not None:
+            return total
+    r = Fetcher.session().head(url, headers={"Accept-Encoding": "identity"}, allow_redirects=True)
+    if not r.ok or "Content-Length" not in r.headers:
+        return None
+    return int(r.headers["Content-Length"])
+
+
+class DownloadStopped(Exception):
+    """ Download was stopped before finishing, the partial file is kept for resuming """
+
+
+def download_file(url, path, tmp_path, make_dirs=False, resume=False, bandwidth=None, stop=None):
+    """ Download url to path through tmp_path.
+        resume: continue a partial tmp_path with a Range request
+        bandwidth: a rate_limit.TokenBucket counting bytes, may be shared between threads
+        stop: a threading.Event, when set the download stops and raises DownloadStopped """
     if make_dirs:
         os.makedirs(path.parent, exist_ok=True)
 
+    # Byte ranges must refer to the file itself, not a compressed encoding of it
+    headers = {"Accept-Encoding": "identity"}
+    offset = os.path.getsize(tmp_path) if resume and os.path.isfile(tmp_path) else 0
+    if offset > 0:
+        headers["Range"] = f"bytes={offset}-"
+
     # https://stackoverflow.com/questions/16694907/download-large-file-in-python-with-requests 
     # TODO: compare shutil.copyfileobj(r.raw, f) to chunk streaming
-    with requests.get(url, stream=True) as r:
+    with Fetcher.session().get(url, stream=True, headers=headers) as r:
+        if offset > 0 and r.status_code == 416:
+            # Range not satisfiable, usually because tmp_path already has the whole file
+            if remote_size(url, r) == offset:
+                os.rename(tmp_path, path)
+                return path
+            # The partial file is not a prefix of this file
+            os.remove(tmp_path)
+            return download_file(url, path, tmp_path, bandwidth=bandwidth, stop=stop)
+        if offset > 0 and r.status_code == 206:
+            (start, _) = parse_content_range(r.headers.get("Content-Range"))
+            if start != offset:
+                # Not the range that was asked for, appending it would corrupt the file
+                os.remove(tmp_path)
+                return download_file(url, path, tmp_path, bandwidth=bandwidth, stop=stop)
         r.raise_for_status()
-        with open(tmp_path, 'wb') as f:
+        # The server may ignore the range and send the whole file
+        mode = "ab" if r.status_code == 206 else "wb"
+        with open(tmp_path, mode) as f:
             for chunk in r.iter_content(chunk_size=8192): 
+                if stop is not None and stop.is_set():
+                    raise DownloadStopped(url)
                 if chunk:  # filter out keep-alive new chunks
+                    if bandwidth is not None:
+                        bandwidth.acquire(len(chunk))
                     f.write(chunk)
+            f.flush()
             os.fsync(f)
 
     os.rename(tmp_path, path)
@@ -0,0 +1,120 @@
+"""
+Decide whether a file listed on a Skemman document page is the main pdf of the thesis.
+Used when files are inserted into skemman.db, so the result can be queried directly.
+"""
+
+import re
+
+B_IN_KB = 10 ** 3
+B_IN_MB = 10 ** 6
+B_IN_GB = 10 ** 9
+
+UNITS = {" B": 1, "kB": B_IN_KB, "MB": B_IN_MB, "GB": B_IN_GB}
+UNIT_NAMES = list(UNITS.keys())
+
+MAX_SIZE_IN_MB = 75
+
+# Reason codes stored in skemman_files.class_reason
+MAIN = "main"
+CLOSED = "closed"
+NOT_PDF = "not_pdf"
+BLACKLIST = "blacklist"
+NO_DESCR = "no_descr"
+UNFILTERED = "unfiltered"
+BAD_SIZE = "bad_size"
+
+DESCR_BLACKLIST = (
+    "forsíða",
+    "forsida",
+    "útdráttur",
+    "úrdráttur",
+    "ágrip",
+    "efnisyfirlit",
+    "efnisskrá",
+    "heimildaskrá",
+    "heimildarskrá",
+    "heimildir",
+    # "samantekt",
+    "yfirlýsing",
+    "viðtal",
+    "kápa",
+    "titilsíða",
+    "abstract",
+    "beiðni um lokun",
+    "samþykki",
+    "leyfisbr",
+    "teikning",
+    # handle maybe
+    "þakkir",
+    "þakkar",
+    "thakkir",
+    "thakkar",
+    # handle later
+    "fylgiskjal",
+    "fylgiskjöl",
+    "fylgirit",
+    "viðauki",
+    "viðaukar",
+    "lokun",
+)
+WHITELIST = (
+    "heild",
+    "ritgerð",
+    "ritgerd",
+    "greinagerð",
+    "greinargerð",
+    "lokaverkefni",
+    "handrit",
+    "handbok",
+    "handbók",
+    "lokaverkefni",
+    "bækling",
+    "skýrsla",
+    "skyrsla",
+    "meginmál",
+    "meginmal",
+)
+LNAME_PAT = re.compile(  # lower name pattern
+    r"""
+    (\b|_)
+    (ba|b\.a|bs|b\.s|bsc|b\.sc|b\.ed|ma|m\.a|ms|m\.s|msc|m\.sc)
+    (\b|_)
+""",
+    re.VERBOSE,
+)
+
+
+def size_to_bytes(size_str):
+    """ Sizes on the Icelandic pages have a decimal comma, e.g. "3,41 MB" """
+    unit = list(filter(lambda key: key in size_str, UNIT_NAMES)).pop()
+    factor = UNITS[unit]
+    return float(size_str.replace(unit, "").strip().replace(",", ".")) * factor
+
+
+def classify_file(fname, size, access, descr):
+    """ Returns (size in bytes, is main pdf, reason code) """
+    lname = fname.lower()
+    ldescr = descr.lower().strip()
+    size_in_b = size_to_bytes(size)
+
+    if (
+        ".pdf" in lname
+        and "Opinn" in access
+        and (
+            any(word in ldescr for word in WHITELIST)
+            or any(word in lname for word in WHITELIST)
+            or LNAME_PAT.search(lname)
+        )
+    ):
+        reason = MAIN
+    elif "Opinn" not in access:
+        reason = CLOSED
+    elif ".pdf" not in lname:
+        reason = NOT_PDF
+    elif any(word in ldescr for word in DESCR_BLACKLIST):
+        reason = BLACKLIST
+    elif not ldescr:
+        reason = NO_DESCR
+    else:
+        reason = UNFILTERED
+    return int(round(size_in_b)), reason == MAIN, reason
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""
+On-disk cache of http responses for Fetcher.
+
+Bodies are stored by the sha256 of their content, so identical pages share a file,
+and an sqlite index maps urls to bodies along with their ETag and Last-Modified
+headers for conditional revalidation. The cache is bounded in size and evicts the
+least recently used urls first. In offline mode nothing is fetched, urls that are
+not cached raise CacheMiss.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import namedtuple
+from pathlib import Path
+
+import config
+
+
+CacheEntry = namedtuple("CacheEntry", "url digest etag last_modified")
+
+
+class CacheMiss(Exception):
+    """ Url is not in the cache and the cache is offline """
+
+
+# Eviction stops once a cache is this far below its maximum size
+EVICT_TO = 0.9
+
+
+def evict_lru(conn, select_sql, remove, total, max_bytes, batch_size=10000):
+    """ Size bounded least recently used eviction, shared with rule_cache. select_sql selects
+        the cached items in order of last use, up to LIMIT ? of them. remove(conn, row) deletes
+        the item of a row and returns the number of bytes that freed. Items are removed until
+        total is within EVICT_TO of max_bytes, returns the new total. """
+    target = int(max_bytes * EVICT_TO)
+    while total > target:
+        rows = conn.execute(select_sql, (batch_size,)).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            if total <= target:
+                break
+            total -= remove(conn, row)
+    return total
+
+
+class HttpCache:
+
+    _SQL_CREATE_ENTRIES = """CREATE TABLE IF NOT EXISTS entries (
+            url TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            fetched REAL,
+            last_used REAL
+    )"""
+
+    _SQL_CREATE_BLOBS = """CREATE TABLE IF NOT EXISTS blobs (
+            digest TEXT PRIMARY KEY,
+            size INTEGER NOT NULL
+    )"""
+
+    _SQL_CREATE_LAST_USED_INDEX = """CREATE INDEX IF NOT EXISTS
+        entries_last_used ON entries (last_used)"""
+
+    def __init__(self, cache_dir=None, max_bytes=None, offline=False):
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else config.http_cache_dir()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_bytes = config.http_cache_max_mb * 10 ** 6 if max_bytes is None else max_bytes
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        # Fetcher may be called from several threads
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.cache_dir / "index.db"), check_same_thread=False)
+        with self.conn as c:
+            c.execute(self._SQL_CREATE_ENTRIES)
+            c.execute(self._SQL_CREATE_BLOBS)
+            c.execute(self._SQL_CREATE_LAST_USED_INDEX)
+            self._total_bytes = c.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def _blob_path(self, digest):
+        return self.cache_dir / digest[:2] / digest
+
+    def lookup(self, url):
+        sql = """SELECT url, digest, etag, last_modified FROM entries WHERE url = ?"""
+        with self._lock:
+            row = self.conn.execute(sql, (url,)).fetchone()
+        if row is None or not self._blob_path(row[1]).is_file():
+            self.misses += 1
+            return None
+        return CacheEntry(*row)
+
+    def read(self, entry):
+        """ Body of a cached entry, marks it as recently used """
+        with open(self._blob_path(entry.digest), "rb") as fh:
+            content = fh.read()
+        with self._lock, self.conn as c:
+            c.execute("UPDATE entries SET last_used = ? WHERE url = ?", (time.time(), entry.url))
+        self.hits += 1
+        return content
+
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def store(self, url, content, etag=None, last_modified=None):
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._blob_path(digest)
+        if not path.is_file():
+            os.makedirs(path.parent, exist_ok=True)
+            tmp_path = path.with_name(f"{digest}.{uuid.uuid4()}.tmp")
+            with open(tmp_path, "wb") as fh:
+                fh.write(content)
+            os.replace(tmp_path, path)
+        now = time.time()
+        with self._lock:
+            with self.conn as c:
+                cursor = c.execute(
+                    "INSERT OR IGNORE INTO blobs (digest, size) VALUES (?, ?)",
+                    (digest, len(content)),
+                )
+                self._total_bytes += len(content) if cursor.rowcount == 1 else 0
+                c.execute(
+                    """INSERT OR REPLACE INTO
+                    entries (url, digest, etag, last_modified, fetched, last_used)
+                    VALUES (?, ?, ?, ?, ?, ?)""",
+                    (url, digest, etag, last_modified, now, now),
+                )
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """ Drop least recently used urls, see evict_lru, caller holds the lock """
+        with self.conn as c:
+            self._total_bytes = evict_lru(
+                c,
+                "SELECT url, digest FROM entries ORDER BY last_used LIMIT ?",
+                self._remove_entry,
+                self._total_bytes,
+                self.max_bytes,
+            )
+
+    def _remove_entry(self, conn, row):
+        """ Delete the entry of a url, and its body unless another url has the same one """
+        (url, digest) = row
+        conn.execute("DELETE FROM entries WHERE url = ?", (url,))
+        if conn.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone():
+            return 0
+        size = conn.execute("SELECT size FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+        try:
+            os.remove(self._blob_path(digest))
+        except FileNotFoundError:
+            pass
+        return size[0] if size else 0
+
+    def print_summary(self):
+        print(
+            f"http cache: {self.hits} hits, {self.misses} misses, "
+            f"{self._total_bytes / 10 ** 6:.1f} MB in {self.cache_dir}"
+        )
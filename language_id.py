@@ -1,11 +1,30 @@
 #!/usr/bin/env python3
 
+import functools
+import hashlib
+import itertools
+import multiprocessing
+import signal
+from collections import Counter, defaultdict
+from pathlib import Path
+
 import fasttext
+import numpy as np
 
 import segment_skemman
 import sqlalchemy
+from skemman import Skemman
+from skemman_db import SkemmanDb
+from utils import imap_bounded
 
 _model = None
+_model_file = "fasttext-language-identification.small.176.ftz"
+_model_version = None
+
+_LABEL_PREFIX = "__label__"
+
+# Names stored in skemman_files.language, e.g. for get_open_access_article_pdfs(language="icelandic")
+LANGUAGE_NAMES = {"is": "icelandic", "en": "english"}
 
 # Only actually load the model file if we're going to use it.
 def load_model():
@@ -15,7 +34,6 @@ def load_model():
     #   https://medium.com/@c.chaitanya/language-identification-in-python-using-fasttext-60359dc30ed0
     global _model
     if not _model:
-        _model_file = "fasttext-language-identification.small.176.ftz"
         _model = fasttext.load_model(_model_file)
 
 
@@ -23,25 +41,211 @@ def predict_lang(text):
     load_model()
     return _model.predict(text, k=2) # returns top 2 matching languages
 
-def predict_all():
+
+def predict_langs(texts, k=1):
+    """ Classify many texts in one call to fastText.
+        Returns (labels, probabilities), numpy arrays of shape (len(texts), k),
+        labels are language codes without the __label__ prefix, e.g. 'is' or 'en'. """
+    load_model()
+    # fastText predicts one line per string and rejects strings containing newlines
+    texts = [text.replace("\n", " ") for text in texts]
+    if not texts:
+        return np.empty((0, k), dtype=object), np.empty((0, k), dtype=np.float32)
+    labels, probs = _model.predict(texts, k=k)
+    labels = np.array(
+        [[label[len(_LABEL_PREFIX):] for label in row] for row in labels], dtype=object
+    ).reshape(len(texts), k)
+    probs = np.array(probs, dtype=np.float32).reshape(len(texts), k)
+    return labels, probs
+
+
+def _init_worker():
+    # Let the parent handle ctrl-c
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    load_model()
+
+
+def _predict_batch(batch):
+    """ [(segment id, document id, text)] holding whole documents ->
+        ([(segment id, language, confidence)], [(document id, language, confidence, number of segments)]) """
+    labels, probs = predict_langs([text for (_, _, text) in batch])
+    labels = labels[:, 0].tolist()
+    segment_rows = list(zip([segment_id for (segment_id, _, _) in batch], labels, probs[:, 0].tolist()))
+    chars = defaultdict(Counter)
+    num_segments = Counter()
+    for ((_, document_id, text), label) in zip(batch, labels):
+        chars[document_id][label] += len(text)
+        num_segments[document_id] += 1
+    document_rows = []
+    for (document_id, counts) in chars.items():
+        (language, count) = counts.most_common(1)[0]
+        total = sum(counts.values())
+        document_rows.append((document_id, language, count / total if total else 0.0, num_segments[document_id]))
+    return segment_rows, document_rows
+
+
+def model_version():
+    """ Short hash of the model file, stored with the labels so a new model relabels everything """
+    global _model_version
+    if _model_version is None:
+        with open(_model_file, "rb") as fh:
+            digest = hashlib.sha1(fh.read()).hexdigest()
+        _model_version = f"{Path(_model_file).stem}-{digest[:12]}"
+    return _model_version
+
+
+def _run_batches(task, batches, write, total, workers, what):
+    """ Run task on each batch in a pool of worker processes, writing the results here.
+        Returns the number of documents done. """
+    pool = multiprocessing.Pool(workers, initializer=_init_worker)
+    done = 0
+    try:
+        # A few batches per worker at a time, so the segments are not all read into memory
+        for result in imap_bounded(pool, task, batches, 2 * workers):
+            done += write(result)
+            print(f"[{done}/{total}] documents {what}", end="\r", flush=True)
+        pool.close()
+        print()
+    except KeyboardInterrupt:
+        print()
+        print(f"Exiting... {total - done} remaining")
+        pool.terminate()
+    finally:
+        pool.join()
+    return done
+
+
+def predict_all(workers=None, documents_per_batch=20):
+    """ Label the segments of every new or changed document in segment.db. Batches of
+        documents are classified in a pool of worker processes and the labels written
+        to segment_languages and document_languages here, then copied to skemman_files """
     seg_db = segment_skemman.SegmentDb()
-    max_docid = seg_db.get_max_docid()
+    model = model_version()
+    document_ids = seg_db.get_unlabelled_documents(model)
+    print(f"{len(document_ids)} documents to label with {model}")
+    # Documents without segments get a label row without a language, so they count as done
+    empty = seg_db.get_documents_without_segments()
+    seg_db.insert_languages(model, [], [(document_id, None, 0.0, 0) for document_id in document_ids if document_id in empty])
+    document_ids = [document_id for document_id in document_ids if document_id not in empty]
+
+    def write(result):
+        (segment_rows, document_rows) = result
+        seg_db.insert_languages(model, segment_rows, document_rows)
+        return len(document_rows)
+
+    batches = seg_db.iter_document_segments(document_ids, documents_per_batch)
+    workers = workers or multiprocessing.cpu_count()
+    _run_batches(_predict_batch, batches, write, len(document_ids), workers, "labelled")
+    update_skemman_languages(seg_db, model)
+
+
+def update_skemman_languages(seg_db, model):
+    """ Fill skemman_files.language from the document labels, documents without segments
+        have no label and keep the language from their page """
+    db = SkemmanDb.shared()
+    # Closed files have no href
+    hrefs = {Skemman.make_url(row[0]): row[0] for row in db.get_file_metadata() if row[0] is not None}
+    rows = [
+        (LANGUAGE_NAMES.get(language, language), hrefs[skemman_id])
+        for (skemman_id, language, confidence) in seg_db.get_document_languages(model)
+        if skemman_id in hrefs and language is not None
+    ]
+    db.update_file_languages(rows)
+    print(f"Updated language of {len(rows)} files in skemman.db")
+
+
+# Many theses mix Icelandic and English passages, e.g. an English abstract or quotes,
+# so documents are also split into spans of one language.
+SPAN_WINDOW = 5  # segments per classified window, centered on each segment
+SPAN_MIN_SEGMENTS = 3  # shorter runs are merged into a neighbouring run
+
+
+def window_texts(texts, window=SPAN_WINDOW):
+    """ For each text, the text joined with its neighbours, window texts in total """
+    half = window // 2
+    return [" ".join(texts[max(0, i - half):i + half + 1]) for i in range(len(texts))]
+
+
+def smooth_runs(labels, min_length=SPAN_MIN_SEGMENTS):
+    """ Run-length smoothing of a label sequence into [(label, start, end)], end exclusive.
+        The shortest run below min_length is merged into its longer neighbour until none are left. """
+    runs = []
+    for (i, label) in enumerate(labels):
+        if runs and runs[-1][0] == label:
+            runs[-1][2] = i + 1
+        else:
+            runs.append([label, i, i + 1])
+    while len(runs) > 1:
+        length = lambda run: run[2] - run[1]
+        idx = min(range(len(runs)), key=lambda i: length(runs[i]))
+        if length(runs[idx]) >= min_length:
+            break
+        if idx == 0:
+            neighbour = 1
+        elif idx == len(runs) - 1:
+            neighbour = idx - 1
+        else:
+            neighbour = idx - 1 if length(runs[idx - 1]) >= length(runs[idx + 1]) else idx + 1
+        (lo, hi) = sorted((idx, neighbour))
+        runs[lo:hi + 1] = [[runs[neighbour][0], runs[lo][1], runs[hi][2]]]
+        merged = []
+        for run in runs:
+            if merged and merged[-1][0] == run[0]:
+                merged[-1][2] = run[2]
+            else:
+                merged.append(run)
+        runs = merged
+    return [tuple(run) for run in runs]
+
+
+def _predict_spans_batch(batch, window=SPAN_WINDOW, min_length=SPAN_MIN_SEGMENTS):
+    """ [(segment id, document id, text)] holding whole documents ->
+        [(document id, language, first segment id, last segment id, confidence)] """
+    documents = [(document_id, list(rows)) for (document_id, rows) in itertools.groupby(batch, key=lambda row: row[1])]
+    windows = [window_texts([text for (_, _, text) in rows], window) for (_, rows) in documents]
+    labels, probs = predict_langs(list(itertools.chain.from_iterable(windows)))
+    (labels, probs) = (labels[:, 0], probs[:, 0])
+    spans = []
+    offset = 0
+    for (document_id, rows) in documents:
+        doc_labels = labels[offset:offset + len(rows)]
+        doc_probs = probs[offset:offset + len(rows)]
+        offset += len(rows)
+        for (language, start, end) in smooth_runs(doc_labels.tolist(), min_length):
+            # Windows that disagree with the span count as zero confidence
+            agree = doc_labels[start:end] == language
+            confidence = float(np.where(agree, doc_probs[start:end], 0.0).mean())
+            spans.append((document_id, language, rows[start][0], rows[end - 1][0], confidence))
+    return spans
+
+
+def predict_spans(workers=None, window=SPAN_WINDOW, min_length=SPAN_MIN_SEGMENTS, documents_per_batch=20):
+    """ Split every document without spans into contiguous language spans stored as
+        segment id ranges in language_spans, see SegmentDb.iter_span_segments """
+    seg_db = segment_skemman.SegmentDb()
+    model = f"{model_version()}-w{window}-m{min_length}"
+    document_ids = seg_db.get_documents_without_spans(model)
+    print(f"{len(document_ids)} documents to split into language spans with {model}")
+    # Documents without segments get one span without a language or segments, so they count as done
+    empty = seg_db.get_documents_without_segments()
+    seg_db.insert_spans(model, [(document_id, None, None, None, None) for document_id in document_ids if document_id in empty])
+    document_ids = [document_id for document_id in document_ids if document_id not in empty]
+
+    def write(spans):
+        seg_db.insert_spans(model, spans)
+        return len(set(span[0] for span in spans))
 
-    for i in range(1, max_docid+1):
-        pred = predict_lang(''.join(seg_db.get_segments_for_document(i)))
-        if pred[0][0] != '__label__is' and pred[0][0] != '__label__en':
-            print("predicted non is/en", i, pred)
-        if pred[1][0] < 0.9:
-            print("low certainty", i, pred)
-        #TODO: save results.
-        # Some documents contain passages in both Icelandic and English.
-        # Need to mark the language separately for these passages.
-    
+    task = functools.partial(_predict_spans_batch, window=window, min_length=min_length)
+    batches = seg_db.iter_document_segments(document_ids, documents_per_batch)
+    workers = workers or multiprocessing.cpu_count()
+    _run_batches(task, batches, write, len(document_ids), workers, "split")
 
 
 if __name__ == '__main__':
     #print(predict_lang("i should buy a boat"))
     #print(predict_lang("ég ætti að kaupa bát"))
+    #print(predict_langs(["i should buy a boat", "ég ætti að kaupa bát"], k=2))
+    #print(smooth_runs(["is"] * 10 + ["en"] + ["is"] * 4 + ["en"] * 6))
 
     #seg_db = segment_skemman.SegmentDb()
     #print(predict_lang(''.join(seg_db.get_segments_for_document(3))))
@@ -8,13 +8,14 @@ from bs4 import BeautifulSoup as bs
 from pathlib import Path
 import os
 import time
-import subprocess
 
 from reynir import bintokenizer
 from tokenizer import paragraphs, mark_paragraphs, correct_spaces
 from collections import namedtuple
 
 import fetcher
+from pdfbox import PdfBoxServer
+from text_store import TextStore
 
 
 """
@@ -167,21 +168,26 @@ def extract_text_from_pdf():
     for (dirpath, dirnames, filenames) in os.walk(_pdf_dir):
         pdf_files.extend([str(Path(dirpath) / fn) for fn in filenames if fn.endswith(".pdf")])
 
+    def run_pdfbox(pdf_path):
+        if not pdfbox.extract(pdf_path, pdf_path + '.txt').ok:
+            return None
+        with open(pdf_path + '.txt') as fh:
+            return fh.read()
+
+    store = TextStore(_data_dir / 'text_store')
     count = 0
-    for f in pdf_files:
-        print(f)
-        subprocess.run([
-                'java',
-                '-jar',
-                _pdfbox_location,
-                'ExtractText',
-                f,
-                f + '.txt'
-        ])
+    with PdfBoxServer(_pdfbox_location) as pdfbox:
+        for f in pdf_files:
+            print(f)
+            text = store.get_or_extract(f, run_pdfbox)
+            # fancify_text reads the text next to the pdf
+            if text is not None and not os.path.exists(f + '.txt'):
+                with open(f + '.txt', 'w') as fh:
+                    fh.write(text)
 
-        count += 1
-        if count % 10 == 0:
-            print(count)
+            count += 1
+            if count % 10 == 0:
+                print(count)
 
 
 def fancify_text():
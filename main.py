@@ -5,10 +5,17 @@ import sys
 from pathlib import Path
 
 import thesis_scraper
+from fetcher import Fetcher
+from http_cache import HttpCache
+from skemman_db import SkemmanDb
 import config
 import sync
 import segment_skemman
 import clean_segments
+import export_corpus
+import extract_abstracts
+import align
+import language_id
 
 
 def print_status():
@@ -29,6 +36,14 @@ if __name__ == "__main__":
         help = "Print some info about what's currently in the database."
     )
 
+    parser.add_argument(
+        "--search",
+        dest = "search",
+        required = False,
+        default = None,
+        help = "Full-text search the extracted segments and print the best matches, e.g. 'ágrip OR abstract'."
+    )
+
     parser.add_argument(
         "--data-dir",
         dest = "data_dir",
@@ -56,41 +71,213 @@ if __name__ == "__main__":
         help = "Number of seconds to wait between concurrent requests when scraping data."
     )
 
+    parser.add_argument(
+        "--http-cache",
+        dest = "http_cache",
+        action = "store_true",
+        required = False,
+        help = "Keep fetched pages in an on-disk cache and revalidate them with conditional requests."
+    )
+
+    parser.add_argument(
+        "--offline",
+        dest = "offline",
+        action = "store_true",
+        required = False,
+        help = "Only serve pages from the http cache, never touch the network."
+    )
+
+    parser.add_argument(
+        "--reparse",
+        dest = "reparse",
+        action = "store_true",
+        required = False,
+        help = "With --offline, scrape parses every cached results and document page again, also those already in the database, and updates what was stored from them."
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        dest = "concurrency",
+        required = False,
+        default = 1,
+        type = int,
+        help = "Number of document pages to fetch at the same time when scraping. Values above 1 use the asyncio scraper."
+    )
+
+    parser.add_argument(
+        "--scrape-rate",
+        dest = "scrape_rate",
+        required = False,
+        default = None,
+        type = float,
+        help = "Requests per second per host when scraping concurrently. Default is 1 / scrape-delay."
+    )
+
+    parser.add_argument(
+        "--download-workers",
+        dest = "download_workers",
+        required = False,
+        default = config.download_workers,
+        type = int,
+        help = "Number of files to download at the same time."
+    )
+
+    parser.add_argument(
+        "--bandwidth-limit",
+        dest = "bandwidth_limit",
+        required = False,
+        default = None,
+        type = float,
+        help = "Maximum total download speed in MB/s."
+    )
+
+    parser.add_argument(
+        "--workers",
+        dest = "workers",
+        required = False,
+        default = 1,
+        type = int,
+        help = "Number of worker processes for the extract, languages, spans, clean, abstracts and align actions."
+    )
+
+    parser.add_argument(
+        "--defer-indexes",
+        dest = "defer_indexes",
+        action = "store_true",
+        required = False,
+        help = "Drop segment indexes while extracting and rebuild them at the end. Faster for large initial loads."
+    )
+
+    parser.add_argument(
+        "--max-load",
+        dest = "max_load",
+        required = False,
+        default = None,
+        type = float,
+        help = "Pause cpu heavy work while the 1 minute load average is above this."
+    )
+
+    parser.add_argument(
+        "--max-cpu-temp",
+        dest = "max_cpu_temp",
+        required = False,
+        default = config.max_cpu_temp,
+        type = float,
+        help = "Pause cpu heavy work while the cpu temperature (celsius) is above this."
+    )
+
+    parser.add_argument(
+        "--http-pool-size",
+        dest = "http_pool_size",
+        required = False,
+        default = config.http_pool_size,
+        type = int,
+        help = "Number of keep-alive connections to keep open per host."
+    )
+
+    parser.add_argument(
+        "--rule-cache",
+        dest = "rule_cache",
+        action = "store_true",
+        required = False,
+        help = "Keep results of pure cleaning rules in an on-disk cache, so rerunning the clean action only computes changed rules."
+    )
+
+    parser.add_argument(
+        "--profile-rules",
+        dest = "profile_rules",
+        required = False,
+        default = None,
+        type = Path,
+        help = "Record time and drop rates of each cleaning rule, print a summary and save the stats to this .json or .csv file (per document in csv)."
+    )
+
+    parser.add_argument(
+        "--export-dir",
+        dest = "export_dir",
+        required = False,
+        default = None,
+        type = Path,
+        help = "Where the export action writes parquet shards. Default is export/ in the data directory."
+    )
+
+    parser.add_argument(
+        "--partition-by",
+        dest = "partition_by",
+        required = False,
+        default = "language",
+        choices = export_corpus.PARTITION_COLUMNS,
+        help = "Column used to partition the exported shards."
+    )
+
     parser.add_argument(
         "--actions",
         dest = "actions",
         required = False,
         default = None,
         nargs = '*',
-        choices = ['scrape', 'download', 'extract', 'clean', 'abstracts'],
-        help = "What actions to perform. Default is to run all actions. Be aware that some action combinations may not make sense depending on what has been done before."
+        choices = ['classify', 'scrape', 'download', 'extract', 'languages', 'spans', 'clean', 'abstracts', 'align', 'export'],
+        help = "What actions to perform. Default is to run all actions except classify, spans and export, which only run when asked for. Be aware that some action combinations may not make sense depending on what has been done before."
     )
 
     args = parser.parse_args()
+    if args.reparse and not args.offline:
+        parser.error("--reparse only works with --offline")
     print(args)
 
     config.data_dir = args.data_dir
     config.scrape_delay = args.scrape_delay
+    config.scrape_rate = args.scrape_rate
+    config.max_load = args.max_load
+    config.max_cpu_temp = args.max_cpu_temp
+    config.download_workers = args.download_workers
+    if args.bandwidth_limit:
+        config.bandwidth_limit = args.bandwidth_limit * 10 ** 6
+    config.http_pool_size = args.http_pool_size
+
+    Fetcher.configure(pool_size=config.http_pool_size)
+    if args.http_cache or args.offline:
+        Fetcher.use_cache(HttpCache(offline=args.offline))
 
     if args.status:
         print_status()
         sys.exit(0)
 
+    if args.search:
+        for hit in segment_skemman.SegmentDb().search(args.search):
+            print(f"{hit.document_id:>6} {hit.sentence_index:>5}  {hit.snippet}")
+        sys.exit(0)
+
     do_all = args.actions is None
 
+    if not do_all and 'classify' in args.actions:
+        SkemmanDb.shared().classify_files()
+
     if do_all or 'scrape' in args.actions:
-        thesis_scraper.scrape_skemman(args.max_docs)
+        thesis_scraper.scrape_skemman(args.max_docs, concurrency=args.concurrency, reparse=args.reparse)
 
     if do_all or  'download' in args.actions:
         sync.download_files()
 
     if do_all or  'extract' in args.actions:
-        segment_skemman.gen_pdf()
+        segment_skemman.gen_pdf(workers=args.workers, defer_indexes=args.defer_indexes)
+
+    if do_all or  'languages' in args.actions:
+        language_id.predict_all(workers=args.workers)
+
+    if not do_all and 'spans' in args.actions:
+        language_id.predict_spans(workers=args.workers)
 
     if do_all or  'clean' in args.actions:
-       clean_segments.clean_current_db()
+        clean_segments.clean_current_db(workers=args.workers, profile_path=args.profile_rules, use_cache=args.rule_cache)
 
     if do_all or  'abstracts' in args.actions:
-        # TODO
-        pass
+        extract_abstracts.do_extract_all(workers=args.workers)
+
+    if do_all or  'align' in args.actions:
+        align.align_all(workers=args.workers)
+
+    if not do_all and 'export' in args.actions:
+        export_dir = args.export_dir if args.export_dir is not None else config.data_dir / "export"
+        export_corpus.export_corpus(export_dir, partition_by=args.partition_by)
 
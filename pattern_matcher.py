@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""
+Find every occurrence of many substrings in a text with one regex scan, with the line
+and page (form feed separated, as in pdfbox output) of each hit.
+"""
+
+import bisect
+import re
+from collections import namedtuple
+
+Hit = namedtuple("Hit", "label pattern offset line page")
+
+
+def newline_offsets(text, char="\n"):
+    """ Sorted offsets of char in text, line n starts after the n-th newline and page n after the n-th form feed """
+    return [m.start() for m in re.finditer(re.escape(char), text)]
+
+
+class PatternMatcher:
+    """ patterns is a list of (pattern, label, ignore_case). All patterns are compiled into
+        a single case-insensitive alternation inside a lookahead, so hits may overlap, and
+        each hit is checked against the case of the patterns that match at its offset. """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        # lower cased pattern -> [(pattern, label, ignore_case)]
+        self._by_lower = {}
+        for (pattern, label, ignore_case) in self.patterns:
+            self._by_lower.setdefault(pattern.lower(), []).append((pattern, label, ignore_case))
+        # Longest first, so the alternation prefers the longest pattern at an offset,
+        # the shorter ones that are its prefixes are checked from _prefixes
+        lowers = sorted(self._by_lower, key=len, reverse=True)
+        self._prefixes = {
+            lower: [other for other in lowers if lower.startswith(other)] for lower in lowers
+        }
+        alternation = "|".join(re.escape(lower) for lower in lowers)
+        self.regex = re.compile(f"(?=({alternation}))", re.IGNORECASE)
+
+    def scan(self, text, line_offsets=None, page_offsets=None):
+        """ All hits in text, in order of offset """
+        line_offsets = newline_offsets(text) if line_offsets is None else line_offsets
+        page_offsets = newline_offsets(text, "\x0c") if page_offsets is None else page_offsets
+        hits = []
+        for m in self.regex.finditer(text):
+            offset = m.start()
+            line = bisect.bisect_right(line_offsets, offset - 1)
+            page = bisect.bisect_right(page_offsets, offset - 1)
+            for lower in self._prefixes.get(m.group(1).lower(), ()):
+                found = text[offset:offset + len(lower)]
+                if found.lower() != lower:
+                    continue
+                for (pattern, label, ignore_case) in self._by_lower[lower]:
+                    if ignore_case or found == pattern:
+                        hits.append(Hit(label, pattern, offset, line, page))
+        return hits
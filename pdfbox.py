@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""
+Long-lived pdfbox text extraction.
+
+Starting a new JVM for every pdf costs more than extracting the text, so instead
+PdfBoxServer.java is started once (with the single-file source launcher, java 11+)
+and pdf files are streamed through it over stdin/stdout.
+
+    with PdfBoxServer() as server:
+        for pdf_path in paths:
+            result = server.extract(pdf_path, pdf_path.with_suffix(".txt"))
+"""
+
+import subprocess
+from collections import namedtuple
+from pathlib import Path
+
+import config
+
+
+SERVER_SOURCE = Path(__file__).resolve().parent / "PdfBoxServer.java"
+
+ExtractResult = namedtuple("ExtractResult", "ok seconds pages message")
+
+
+class PdfBoxServer:
+    def __init__(self, jar_path=None, java_opts=(), verbose=True):
+        self.jar_path = config.pdfbox_path if jar_path is None else jar_path
+        self.java_opts = list(java_opts)
+        self.verbose = verbose
+        self.proc = None
+        self.num_files = 0
+        self.num_failed = 0
+        self.total_seconds = 0.0
+
+    def start(self):
+        if self.proc is not None and self.proc.poll() is None:
+            return
+        cmd = ["java"] + self.java_opts + ["-cp", str(self.jar_path), str(SERVER_SOURCE)]
+        self.proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            encoding="utf8",
+            bufsize=1,
+        )
+
+    def stop(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=10)
+        except Exception:
+            self.proc.kill()
+        self.proc = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        if self.verbose:
+            self.print_summary()
+        return False
+
+    def extract(self, pdf_path, txt_path):
+        """ Extract text from pdf_path into txt_path, same as 'ExtractText pdf_path txt_path' """
+        self.start()
+        if self.verbose:
+            print("trying to extract text with pdfbox:", pdf_path, flush=True)
+        request = f"{pdf_path}\t{txt_path}\n"
+        try:
+            self.proc.stdin.write(request)
+            self.proc.stdin.flush()
+            reply = self.proc.stdout.readline()
+        except BrokenPipeError:
+            reply = ""
+        if not reply:
+            # The JVM died (e.g. out of memory on a huge file), next call restarts it
+            self.stop()
+            result = ExtractResult(False, 0.0, 0, "pdfbox server exited")
+        else:
+            status, millis, info = reply.rstrip("\n").split("\t", 2)
+            if status == "OK":
+                result = ExtractResult(True, int(millis) / 1000, int(info), "")
+            else:
+                result = ExtractResult(False, int(millis) / 1000, 0, info)
+
+        self.num_files += 1
+        self.num_failed += 0 if result.ok else 1
+        self.total_seconds += result.seconds
+        if self.verbose:
+            if result.ok:
+                print(f"    extracted {result.pages} pages in {result.seconds:.2f}s", flush=True)
+            else:
+                print(f"    extraction failed after {result.seconds:.2f}s: {result.message}", flush=True)
+        return result
+
+    def print_summary(self):
+        if not self.num_files:
+            return
+        mean = self.total_seconds / self.num_files
+        print(
+            f"pdfbox: {self.num_files} files ({self.num_failed} failed) "
+            f"in {self.total_seconds:.1f}s, {mean:.2f}s per file"
+        )
+
+
+if __name__ == "__main__":
+    import sys
+
+    with PdfBoxServer() as server:
+        for path in sys.argv[1:]:
+            server.extract(path, path + ".txt")
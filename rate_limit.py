@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import asyncio
+import threading
+import time
+import urllib.parse
+
+
+class TokenBucket:
+    """ Token bucket rate limiter, refilled at `rate` tokens per second up to `capacity`.
+        Safe to share between threads, and usable from asyncio with acquire_async. """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(rate if capacity is None else capacity)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, amount):
+        """ Take amount tokens, returns how long the caller must wait before using them """
+        if self.rate == float("inf"):
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Going into debt lets requests larger than the capacity through eventually
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self, amount=1):
+        wait_time = self._reserve(amount)
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    async def acquire_async(self, amount=1):
+        wait_time = self._reserve(amount)
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+
+
+class HostRateLimiter:
+    """ One token bucket per host """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.capacity)
+            return self._buckets[host]
+
+    def acquire(self, url):
+        self.bucket(url).acquire()
+
+    async def acquire_async(self, url):
+        await self.bucket(url).acquire_async()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""
+On-disk memoization of pure cleaning rules, see Rule(pure=True) in segment_cleaner.
+
+A pure rule's result for a segment only depends on the segment text, so it is stored
+under sha1(rule name, rule version, text). Filter results are stored as true/false,
+map and batch results as null for a dropped segment or [new text or null if unchanged,
+changed metadata]. The cache is bounded in size and evicts the least recently used
+results first, see http_cache.evict_lru. Every process opens its own RuleCache, writes
+are buffered and flushed in batches, and close() writes what is left.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+import config
+from http_cache import evict_lru
+
+FILTER = "filter"
+MAP = "map"
+BATCH = "batch"
+
+_MISSING = object()
+
+
+class RuleCache:
+
+    _SQL_CREATE_RESULTS = """CREATE TABLE IF NOT EXISTS results (
+            key BLOB PRIMARY KEY,
+            value TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_used REAL
+    ) WITHOUT ROWID"""
+
+    _SQL_CREATE_LAST_USED_INDEX = """CREATE INDEX IF NOT EXISTS
+        results_last_used ON results (last_used)"""
+
+    _SQL_CREATE_META = """CREATE TABLE IF NOT EXISTS meta (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_bytes INTEGER NOT NULL
+    )"""
+
+    # Buffered writes and last_used updates are flushed at this many
+    FLUSH_SIZE = 1000
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else config.rule_cache_dir()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_bytes = config.rule_cache_max_mb * 10 ** 6 if max_bytes is None else max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._pending = {}
+        self._used = []
+        # Clean workers share the file, wait for each other's writes
+        self.conn = sqlite3.connect(str(self.cache_dir / "rule_cache.db"), timeout=60)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        with self.conn as c:
+            c.execute(self._SQL_CREATE_RESULTS)
+            c.execute(self._SQL_CREATE_LAST_USED_INDEX)
+            c.execute(self._SQL_CREATE_META)
+            c.execute("INSERT OR IGNORE INTO meta (id, total_bytes) VALUES (1, 0)")
+
+    @staticmethod
+    def key(rule, text):
+        h = hashlib.sha1(f"{rule.name}\0{rule.version}\0".encode("utf-8"))
+        h.update(text.encode("utf-8"))
+        return h.digest()
+
+    def get_many(self, keys):
+        """ Map from the keys that are cached to their decoded values """
+        found = {}
+        missing = []
+        for key in keys:
+            if key in self._pending:
+                found[key] = self._pending[key]
+            else:
+                missing.append(key)
+        # Stay below sqlite's limit on query parameters
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+            sql = f"SELECT key, value FROM results WHERE key IN ({', '.join('?' * len(chunk))})"
+            for (key, value) in self.conn.execute(sql, chunk):
+                found[key] = json.loads(value)
+                self._used.append(key)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key, _MISSING)
+
+    def put(self, key, value):
+        self._pending[key] = value
+        if len(self._pending) >= self.FLUSH_SIZE:
+            self.flush()
+
+    def flush(self, final=False):
+        """ Write the buffered results, and the last use of the results that were read once
+            FLUSH_SIZE of them are buffered. final writes them all, so eviction knows they are in use. """
+        if not self._pending and not self._used:
+            return
+        if not self._pending and len(self._used) < self.FLUSH_SIZE and not final:
+            return
+        now = time.time()
+        added = 0
+        with self.conn as c:
+            for (key, value) in self._pending.items():
+                value = json.dumps(value, ensure_ascii=False)
+                size = len(key) + len(value.encode("utf-8"))
+                cursor = c.execute(
+                    "INSERT OR IGNORE INTO results (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                    (key, value, size, now),
+                )
+                added += size if cursor.rowcount == 1 else 0
+            c.executemany("UPDATE results SET last_used = ? WHERE key = ?", ((now, key) for key in self._used))
+            c.execute("UPDATE meta SET total_bytes = total_bytes + ?", (added,))
+            total = c.execute("SELECT total_bytes FROM meta").fetchone()[0]
+            if total > self.max_bytes:
+                self._evict(c, total)
+        self._pending = {}
+        self._used = []
+
+    def close(self):
+        self.flush(final=True)
+        self.conn.close()
+
+    def _evict(self, conn, total):
+        """ Drop least recently used results, see http_cache.evict_lru """
+        def remove(conn, row):
+            (key, size) = row
+            conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            return size
+
+        new_total = evict_lru(
+            conn, "SELECT key, size FROM results ORDER BY last_used LIMIT ?", remove, total, self.max_bytes
+        )
+        conn.execute("UPDATE meta SET total_bytes = total_bytes - ?", (total - new_total,))
+
+    def wrap(self, rule):
+        """ A function with the signature of rule.fn that answers from the cache where it can """
+        if rule.kind == FILTER:
+            return self._wrap_filter(rule)
+        if rule.kind == MAP:
+            return self._wrap_map(rule)
+        if rule.kind == BATCH:
+            return self._wrap_batch(rule)
+        raise ValueError(f"{rule} cannot be cached, only filter, map and batch rules can be pure")
+
+    def _wrap_filter(self, rule):
+        def cached_filter(s):
+            key = self.key(rule, s.text)
+            keep = self.get(key)
+            if keep is _MISSING:
+                keep = bool(rule.fn(s))
+                self.put(key, keep)
+            return keep
+        return cached_filter
+
+    def _wrap_map(self, rule):
+        def cached_map(s):
+            key = self.key(rule, s.text)
+            value = self.get(key)
+            if value is not _MISSING:
+                return _apply(s, value)
+            (text, metadata) = (s.text, dict(s.metadata))
+            out = rule.fn(s)
+            self.put(key, _result(text, metadata, out))
+            return out
+        return cached_map
+
+    def _wrap_batch(self, rule):
+        # Pure batch rules return a subset of the segments they get, in order, each
+        # possibly changed in place, so each result is stored with its input
+        def cached_batch(segments):
+            keys = [self.key(rule, s.text) for s in segments]
+            found = self.get_many(keys)
+            misses = [(s, key, s.text, dict(s.metadata)) for (s, key) in zip(segments, keys) if key not in found]
+            kept = set(id(s) for s in rule.fn([s for (s, _, _, _) in misses])) if misses else set()
+            for (s, key, text, metadata) in misses:
+                self.put(key, _result(text, metadata, s if id(s) in kept else None))
+            out = []
+            for (s, key) in zip(segments, keys):
+                if key in found:
+                    s = _apply(s, found[key])
+                elif id(s) not in kept:
+                    s = None
+                if s is not None:
+                    out.append(s)
+            return out
+        return cached_batch
+
+    def print_summary(self):
+        total = self.conn.execute("SELECT total_bytes FROM meta").fetchone()[0]
+        print(
+            f"rule cache: {self.hits} hits, {self.misses} misses, "
+            f"{total / 10 ** 6:.1f} MB in {self.cache_dir}"
+        )
+
+
+def _result(text, metadata, out):
+    """ Cached value of a map or batch rule that turned (text, metadata) into segment out """
+    if out is None:
+        return None
+    changed = {k: v for (k, v) in out.metadata.items() if metadata.get(k, _MISSING) != v}
+    return [out.text if out.text != text else None, changed]
+
+
+def _apply(s, value):
+    if value is None:
+        return None
+    (text, changed) = value
+    if text is not None:
+        s.text = text
+    s.metadata.update(changed)
+    return s
@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 
 from __future__ import annotations
-from typing import Callable, Iterable, Type, Dict, Any, List
+from collections import deque
+import csv
+import hashlib
+import itertools
+import json
+import time
+from typing import Callable, Iterable, Iterator, Optional, Type, Dict, Any, List, Tuple
 from segment_skemman import Segment
 import language_id
 
@@ -9,28 +15,364 @@ import language_id
 SegmentCollection = List[Segment]
 SegmentCleaningRule = Callable[[SegmentCollection], SegmentCollection]
 
+# How a rule is applied to the stream of segments
+FILTER = "filter"  # fn(segment) -> bool, keep the segment if true
+MAP = "map"  # fn(segment) -> segment
+BATCH = "batch"  # fn(list of up to size segments) -> list of segments, for vectorized rules
+WINDOW = "window"  # fn(tuple of size segments centered on the current one) -> segment or None to drop it
+STREAM = "stream"  # fn(iterator of segments) -> iterator of segments
+COLLECTION = "collection"  # fn(list of segments) -> list of segments, the whole document at once
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+class Rule:
+    """ A cleaning rule with the way it is applied to the segment stream. Filter and map
+        rules look at one segment at a time and adjacent ones are run in a single pass.
+        Calling a rule on a list of segments returns the cleaned list. """
+
+    def __init__(
+        self,
+        fn: Callable,
+        kind: str,
+        size: Optional[int] = None,
+        name: Optional[str] = None,
+        version: int = 1,
+        pure: bool = False,
+    ):
+        self.fn = fn
+        self.kind = kind
+        self.size = size
+        self.name = name or getattr(fn, "__name__", type(fn).__name__)
+        # Bump when the rule's output changes, so documents cleaned with it are cleaned again
+        self.version = version
+        # The result for a segment only depends on its text, so it can be kept in a RuleCache.
+        # Pure batch rules return a subset of their input segments, in order.
+        self.pure = pure
+        if pure and kind not in (FILTER, MAP, BATCH):
+            raise ValueError(f"{kind} rules cannot be pure")
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}:{self.kind}:{self.size}:{self.version}"
+
+    def __repr__(self):
+        return f"<{self.kind} rule {self.name}>"
+
+    def __call__(self, segments: Iterable[Segment]) -> SegmentCollection:
+        return list(self.apply(iter(segments)))
+
+    def apply(self, segments: Iterator[Segment]) -> Iterator[Segment]:
+        if self.kind == FILTER:
+            return (s for s in segments if self.fn(s))
+        if self.kind == MAP:
+            return (self.fn(s) for s in segments)
+        if self.kind == BATCH:
+            return self._apply_batches(segments)
+        if self.kind == WINDOW:
+            return self._apply_windows(segments)
+        if self.kind == STREAM:
+            return self._apply_stream(segments)
+        return self._apply_collection(segments)
+
+    # Generators, so that no segment is read before the first one is asked for
+    def _apply_stream(self, segments):
+        yield from self.fn(segments)
+
+    def _apply_collection(self, segments):
+        yield from self.fn(list(segments))
+
+    def _apply_batches(self, segments):
+        while True:
+            batch = list(itertools.islice(segments, self.size))
+            if not batch:
+                return
+            yield from self.fn(batch)
+
+    def _apply_windows(self, segments):
+        # Windows hold the incoming segments, padded with None at the document edges
+        half = self.size // 2
+        window = deque(maxlen=self.size)
+        for s in itertools.chain([None] * half, segments, [None] * half):
+            window.append(s)
+            if len(window) == self.size:
+                out = self.fn(tuple(window))
+                if out is not None:
+                    yield out
+
+
+def _rule_decorator(kind: str, size: Optional[int] = None, version: int = 1, pure: bool = False):
+    def decorator(fn: Callable) -> Rule:
+        return Rule(fn, kind, size=size, version=version, pure=pure)
+    return decorator
+
+
+def filter_rule(fn: Optional[Callable[[Segment], bool]] = None, version: int = 1, pure: bool = False):
+    """ @filter_rule or @filter_rule(version=2, pure=True) """
+    decorator = _rule_decorator(FILTER, version=version, pure=pure)
+    return decorator(fn) if fn is not None else decorator
+
+
+def map_rule(fn: Optional[Callable[[Segment], Segment]] = None, version: int = 1, pure: bool = False):
+    decorator = _rule_decorator(MAP, version=version, pure=pure)
+    return decorator(fn) if fn is not None else decorator
+
+
+def stream_rule(fn: Optional[Callable[[Iterator[Segment]], Iterator[Segment]]] = None, version: int = 1):
+    decorator = _rule_decorator(STREAM, version=version)
+    return decorator(fn) if fn is not None else decorator
+
+
+def batch_rule(size: int = DEFAULT_BATCH_SIZE, version: int = 1, pure: bool = False):
+    return _rule_decorator(BATCH, size=size, version=version, pure=pure)
+
+
+def window_rule(size: int = 3, version: int = 1):
+    """ size is odd, the current segment is window[size // 2] """
+    return _rule_decorator(WINDOW, size=size, version=version)
+
+
+def _fused_pass(rules: List[Rule], segments: Iterator[Segment]) -> Iterator[Segment]:
+    """ Run adjacent filter and map rules on each segment in turn, in one pass """
+    for s in segments:
+        for rule in rules:
+            if rule.kind == FILTER:
+                if not rule.fn(s):
+                    break
+            else:
+                s = rule.fn(s)
+        else:
+            yield s
+
+
+def _profiled_fused_pass(
+    rules: List[Rule], segments: Iterator[Segment], stats: Dict[str, RuleStats]
+) -> Iterator[Segment]:
+    """ _fused_pass that times every rule call """
+    rule_stats = [stats[rule.name] for rule in rules]
+    for s in segments:
+        for (rule, st) in zip(rules, rule_stats):
+            chars = len(s.text)
+            wall, cpu = time.perf_counter(), time.process_time()
+            if rule.kind == FILTER:
+                keep = rule.fn(s)
+            else:
+                keep = True
+                s = rule.fn(s)
+            st.wall += time.perf_counter() - wall
+            st.cpu += time.process_time() - cpu
+            st.segments_in += 1
+            st.chars_in += chars
+            if not keep:
+                break
+            st.segments_out += 1
+            st.chars_out += len(s.text)
+        else:
+            yield s
+
+
+class _Counted:
+    """ Iterator of segments that counts them, their characters and the time spent producing them """
+
+    def __init__(self, segments: Iterator[Segment]):
+        self.segments = segments
+        self.count = 0
+        self.chars = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Segment:
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            s = next(self.segments)
+        finally:
+            self.wall += time.perf_counter() - wall
+            self.cpu += time.process_time() - cpu
+        self.count += 1
+        self.chars += len(s.text)
+        return s
+
+
+class RuleStats:
+    """ Time spent in a rule and what it let through """
+
+    FIELDS = ("wall", "cpu", "segments_in", "segments_out", "chars_in", "chars_out")
+    __slots__ = FIELDS
+
+    def __init__(self, wall=0.0, cpu=0.0, segments_in=0, segments_out=0, chars_in=0, chars_out=0):
+        self.wall = wall
+        self.cpu = cpu
+        self.segments_in = segments_in
+        self.segments_out = segments_out
+        self.chars_in = chars_in
+        self.chars_out = chars_out
+
+    def add(self, other: RuleStats):
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+class CleaningProfile:
+    """ Per rule stats aggregated over a run, optionally kept per document as well """
+
+    def __init__(self, keep_documents: bool = False):
+        self.rules: Dict[str, RuleStats] = {}
+        self.keep_documents = keep_documents
+        self.documents: List[Tuple[Any, str, RuleStats]] = []
+        self.num_documents = 0
+
+    def record(self, document_id, stats: Dict[str, RuleStats]):
+        self.num_documents += 1
+        for (name, st) in stats.items():
+            self.rules.setdefault(name, RuleStats()).add(st)
+            if self.keep_documents:
+                self.documents.append((document_id, name, st))
+
+    def to_json(self, path):
+        out = {
+            "documents": self.num_documents,
+            "rules": [dict(rule=name, **st.as_dict()) for (name, st) in self.rules.items()],
+        }
+        if self.keep_documents:
+            out["per_document"] = [
+                dict(document_id=document_id, rule=name, **st.as_dict()) for (document_id, name, st) in self.documents
+            ]
+        with open(path, "w") as fh:
+            json.dump(out, fh, indent=2)
+
+    def to_csv(self, path):
+        """ One row per rule, or per document and rule if keep_documents """
+        with open(path, "w", newline="") as fh:
+            writer = csv.writer(fh)
+            writer.writerow(("document_id", "rule") + RuleStats.FIELDS)
+            if self.keep_documents:
+                rows = self.documents
+            else:
+                rows = [("", name, st) for (name, st) in self.rules.items()]
+            for (document_id, name, st) in rows:
+                writer.writerow((document_id, name) + tuple(getattr(st, field) for field in RuleStats.FIELDS))
+
+    def save(self, path):
+        """ csv or json, by the file suffix """
+        if str(path).endswith(".csv"):
+            self.to_csv(path)
+        else:
+            self.to_json(path)
+
+    def print_summary(self):
+        total_wall = sum(st.wall for st in self.rules.values()) or 1.0
+        print(f"Rule stats over {self.num_documents} documents")
+        print(
+            f"{'rule':<32} {'wall s':>9} {'cpu s':>9} {'wall %':>7} {'us/seg':>8}"
+            f" {'segs in':>11} {'segs out':>11} {'seg drop %':>10} {'chars drop %':>12}"
+        )
+        for (name, st) in self.rules.items():
+            per_segment = st.wall / st.segments_in * 10 ** 6 if st.segments_in else 0.0
+            segment_drop = 100 * (1 - st.segments_out / st.segments_in) if st.segments_in else 0.0
+            char_drop = 100 * (1 - st.chars_out / st.chars_in) if st.chars_in else 0.0
+            print(
+                f"{name[:32]:<32} {st.wall:>9.2f} {st.cpu:>9.2f} {100 * st.wall / total_wall:>7.1f} {per_segment:>8.1f}"
+                f" {st.segments_in:>11} {st.segments_out:>11} {segment_drop:>10.1f} {char_drop:>12.1f}"
+            )
+
 
 class SegmentCleaner:
     def __init__(self):
-        self.rules: List[SegmentCleaningRule] = []
+        self.rules: List[Rule] = []
+        self.cache = None
+
+    def use_cache(self, cache):
+        """ Answer pure rules from a rule_cache.RuleCache """
+        self.cache = cache
 
-    def add_rule(self, rule: SegmentCleaningRule):
+    def add_rule(self, rule):
+        """ Plain callables are collection rules that get the whole document as a list """
+        if not isinstance(rule, Rule):
+            rule = Rule(rule, COLLECTION)
         self.rules.append(rule)
 
-    def clean_segments(self, segments: SegmentCollection) -> SegmentCollection:
-        out = segments
+    def stages(self) -> List[List[Rule]]:
+        """ Rules grouped into the passes that are run, adjacent per segment rules share a pass """
+        stages: List[List[Rule]] = []
         for rule in self.rules:
-            print(" applying rule:", rule)
-            out = rule(out)
+            if rule.pure and self.cache is not None:
+                rule = Rule(self.cache.wrap(rule), rule.kind, size=rule.size, name=rule.name, version=rule.version)
+            per_segment = rule.kind in (FILTER, MAP)
+            if per_segment and stages and stages[-1][0].kind in (FILTER, MAP):
+                stages[-1].append(rule)
+            else:
+                stages.append([rule])
+        return stages
+
+    def iter_clean(self, segments: Iterable[Segment], stats: Optional[Dict[str, RuleStats]] = None) -> Iterator[Segment]:
+        """ Lazily clean a stream of segments, only collection rules hold a whole document.
+            With a stats dict, the RuleStats of each rule are added to it by rule name,
+            they are complete once the returned iterator is exhausted. """
+        if stats is not None:
+            out = self._iter_clean_profiled(segments, stats)
+        else:
+            out = iter(segments)
+            for stage in self.stages():
+                if stage[0].kind in (FILTER, MAP):
+                    out = _fused_pass(stage, out)
+                else:
+                    out = stage[0].apply(out)
+        if self.cache is not None:
+            out = self._flush_cache_after(out)
         return out
 
+    def _flush_cache_after(self, segments):
+        yield from segments
+        self.cache.flush()
+
+    def _iter_clean_profiled(self, segments, stats):
+        for rule in self.rules:
+            stats.setdefault(rule.name, RuleStats())
+        # Every stage reads from the counted output of the one before, the time of a
+        # stage is the time spent producing its output minus the time spent on its input
+        out = _Counted(iter(segments))
+        counted = []
+        for stage in self.stages():
+            inp = out
+            if stage[0].kind in (FILTER, MAP):
+                out = _Counted(_profiled_fused_pass(stage, inp, stats))
+            else:
+                out = _Counted(stage[0].apply(inp))
+                counted.append((stage[0], inp, out))
+        yield from out
+        for (rule, inp, out) in counted:
+            stats[rule.name].add(RuleStats(
+                wall=out.wall - inp.wall,
+                cpu=out.cpu - inp.cpu,
+                segments_in=inp.count,
+                segments_out=out.count,
+                chars_in=inp.chars,
+                chars_out=out.chars,
+            ))
+
+    def clean_segments(self, segments: Iterable[Segment]) -> SegmentCollection:
+        return list(self.iter_clean(segments))
+
+    def ruleset_hash(self) -> str:
+        """ Identifies the rules, their order and versions """
+        keys = "\n".join(rule.key for rule in self.rules)
+        return hashlib.sha1(keys.encode("utf-8")).hexdigest()[:16]
+
     @staticmethod
     def default_cleaner() -> SegmentCleaner:
-        # TODO: some sensible default rules
         c = SegmentCleaner()
-        #c.add_rule(kill_short_lines)
+        c.add_rule(strip_whitespace)
+        c.add_rule(kill_short_lines)
+        c.add_rule(drop_repeated_segments)
+        c.add_rule(tag_language)
         #c.add_rule(print_rule)
-        c.add_rule(fasttext_confidence_filter)
+        #c.add_rule(fasttext_confidence_filter)
         return c
 
 
@@ -38,53 +380,75 @@ def nop_rule(segments: SegmentCollection) -> SegmentCollection:
     print("Applying the NOP rule. This does nothing.")
     return segments
 
+@stream_rule
 def drop_rule(segments):
-    return [x for i, x in enumerate(segments) if i%2 == 0]
+    return itertools.islice(segments, 0, None, 2)
 
-def print_rule(segments):
-    for s in segments:
-        print(s)
-    return segments
+@map_rule
+def print_rule(s):
+    print(s)
+    return s
 
-class save_to_file_rule():
+class save_to_file_rule(Rule):
     def __init__(self, filename: str):
+        super().__init__(self._write, STREAM, name=f"save_to_file_rule({filename})")
         self.filename = filename
 
-    def __call__(self, segments: SegmentCollection) -> SegmentCollection:
+    def _write(self, segments):
         with open(self.filename, 'w') as logfile:
             for s in segments:
                 logfile.write(s.text)
                 logfile.write("\n")
+                yield s
 
-        return segments
-
-def strip_whitespace(segments: SegmentCollection) -> SegmentCollection:
-    return [Segment(s.text.strip(), s.metadata) for s in segments]
+@map_rule
+def strip_whitespace(s):
+    s.text = s.text.strip()
+    return s
 
+@batch_rule()
 def identify_language(segments):
-    for s in segments:
-        s.metadata['language'] = language_id.predict_lang(s.text)[0][0][9:]
-        print("id", s, s.text, s.metadata)
+    labels, _ = language_id.predict_langs([s.text for s in segments])
+    for (s, label) in zip(segments, labels[:, 0]):
+        s.metadata['language'] = label
+
+    return segments
 
+@batch_rule(pure=True)
+def tag_language(segments):
+    """ Store the fastText language and its probability in the segment metadata """
+    labels, probs = language_id.predict_langs([s.text for s in segments])
+    for (s, label, prob) in zip(segments, labels[:, 0], probs[:, 0]):
+        s.metadata['language'] = str(label)
+        s.metadata['language_confidence'] = round(float(prob), 4)
     return segments
 
-def kill_short_lines(segments):
-    return [s for s in segments if len(s) > 10]
+@filter_rule
+def kill_short_lines(s):
+    return len(s.text) > 10
 
+@window_rule(3)
+def drop_repeated_segments(window):
+    """ Running headers and footers often come out as the same line twice in a row """
+    (prev, s, _) = window
+    if prev is not None and prev.text == s.text:
+        return None
+    return s
+
+@batch_rule()
 def fasttext_confidence_filter(segments: SegmentCollection) -> SegmentCollection:
     RED = '\033[91m'
     GREEN = '\033[92m'
     YELLOW = '\033[93m'
     RESET = '\033[0m'
-    for s in segments:
-        lang_id = language_id.predict_lang(s.text)
-        confidence = lang_id[1][0]
+    _, probs = language_id.predict_langs([s.text for s in segments])
+    for (s, confidence) in zip(segments, probs[:, 0]):
         color = RED
         if confidence > 0.8:
             color = GREEN
         elif confidence > 0.4:
             color = YELLOW
-        
+
         print(color, confidence, RESET, s.text)
 
     return segments
@@ -110,4 +474,3 @@ if __name__ == "__main__":
     #sc2 = SegmentCleaner.default_cleaner()
     #clean2 = sc2.clean_segments(segs)
     #print(clean2)
-
@@ -1,6 +1,9 @@
 import os
-import time
 import random
+import itertools
+from contextlib import contextmanager, nullcontext
+import multiprocessing
+import signal
 from pathlib import Path
 from collections import Counter, namedtuple
 import subprocess
@@ -15,17 +18,23 @@ try:
 except ImportError:  # Silently ignore if IceCream isn't installed.
     ic = lambda *a: None if not a else (a[0] if len(a) == 1 else a)  # noqa
 
+import sqlite3
+
 import sqlalchemy
+import sqlalchemy.event
+import sqlalchemy.exc
 import sqlalchemy.sql
 from sqlalchemy import Table, Column, Integer, String, MetaData, ForeignKey, Sequence, func
 
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
 from reynir import bintokenizer
 from tokenizer import paragraphs, mark_paragraphs, correct_spaces
 
+from pdfbox import PdfBoxServer
 from skemman_db import SkemmanDb
-from utils import get_open_access_article_pdfs
+from text_store import TextStore
+from utils import get_open_access_article_pdfs, wait_for_cool_down
 
 import config
 
@@ -56,20 +65,74 @@ SimpleSegment = namedtuple("Segment", "index text")
 
 
 class Segment:
-    def __init__(self, text: str, metadata: Dict[str, Any] = {}):
+    def __init__(self, text: str, metadata: Optional[Dict[str, Any]] = None, id: Optional[int] = None):
         self.text: str = text
-        self.metadata: Dict[str, Any] = metadata
+        # Row id in segments, for segments read from SegmentDb
+        self.id: Optional[int] = id
+        # A shared default dict would leak metadata between segments
+        self.metadata: Dict[str, Any] = metadata if metadata is not None else {}
 
     def __repr__(self):
         return self.text
 
 
+SearchHit = namedtuple("SearchHit", "document_id skemman_id sentence_index snippet")
+
+
 class SegmentDb:
+
+    # Full-text index over segments.text, kept up to date by triggers.
+    # unicode61 folds accents (á -> a, ö -> o) and case, while ð, þ and æ
+    # stay letters of their own as they are in Icelandic.
+    _SQL_CREATE_SEARCH = (
+        """CREATE VIRTUAL TABLE IF NOT EXISTS segments_fts USING fts5(
+            text,
+            content='segments',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics {remove_diacritics}'
+        )""",
+        """CREATE TRIGGER IF NOT EXISTS segments_fts_insert AFTER INSERT ON segments BEGIN
+            INSERT INTO segments_fts (rowid, text) VALUES (new.id, new.text);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS segments_fts_delete AFTER DELETE ON segments BEGIN
+            INSERT INTO segments_fts (segments_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS segments_fts_update AFTER UPDATE ON segments BEGIN
+            INSERT INTO segments_fts (segments_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO segments_fts (rowid, text) VALUES (new.id, new.text);
+        END""",
+    )
+
+    _PRAGMAS = (
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA cache_size = -262144",  # in KiB, 256 MB
+        "PRAGMA temp_store = MEMORY",
+    )
+
+    # Secondary indexes, dropped while loading with deferred_indexes
+    _SQL_CREATE_INDEXES = (
+        "CREATE INDEX IF NOT EXISTS segments_document_id ON segments (document_id)",
+        "CREATE INDEX IF NOT EXISTS document_languages_language ON document_languages (language, confidence)",
+        "CREATE INDEX IF NOT EXISTS language_spans_language ON language_spans (language, confidence)",
+        "CREATE INDEX IF NOT EXISTS language_spans_document_id ON language_spans (document_id)",
+        "CREATE INDEX IF NOT EXISTS cleaned_segments_document_id ON cleaned_segments (document_id)",
+    )
+    _INDEX_NAMES = ("segments_document_id",)
+
+    _SQL_INSERT_SEGMENT = """INSERT INTO
+        segments (sentence_index, text, document_id)
+        VALUES (?, ?, ?)"""
+
+    # insert_segments consumes the segment generator this many rows at a time
+    INSERT_CHUNK_SIZE = 10000
+
     def __init__(self):
         self.db_file = config.db_dir() / "segment.db"
         self.db_url = "sqlite:///" + str(self.db_file)
 
         self.engine = sqlalchemy.create_engine(self.db_url)
+        sqlalchemy.event.listen(self.engine, "connect", self._on_connect)
         metadata = sqlalchemy.MetaData()
         self.documents = sqlalchemy.Table(
             "documents",
@@ -94,19 +157,140 @@ class SegmentDb:
             Column("document_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("documents.id")),
             Column("metadata", sqlalchemy.String),
         )
+        # Language labels filled by language_id.predict_all, model is the version of the
+        # fastText model that produced them. The document label is the language with the
+        # most characters and confidence is its share of the characters.
+        self.segment_languages = Table(
+            "segment_languages",
+            metadata,
+            Column("segment_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("segments.id"), primary_key=True),
+            Column("language", sqlalchemy.String),
+            Column("confidence", sqlalchemy.Float),
+            Column("model", sqlalchemy.String),
+        )
+        self.document_languages = Table(
+            "document_languages",
+            metadata,
+            Column("document_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("documents.id"), primary_key=True),
+            Column("language", sqlalchemy.String),
+            Column("confidence", sqlalchemy.Float),
+            Column("num_segments", sqlalchemy.Integer),
+            Column("model", sqlalchemy.String),
+        )
+        # Contiguous runs of one language within a document, from language_id.predict_spans.
+        # Segment ids of a document are consecutive, so a span is a range of segment ids.
+        self.language_spans = Table(
+            "language_spans",
+            metadata,
+            Column("id", sqlalchemy.Integer, autoincrement=True, primary_key=True),
+            Column("document_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("documents.id")),
+            Column("language", sqlalchemy.String),
+            Column("first_segment_id", sqlalchemy.Integer),
+            Column("last_segment_id", sqlalchemy.Integer),
+            Column("confidence", sqlalchemy.Float),
+            Column("model", sqlalchemy.String),
+        )
+        # Checkpoint of clean_segments.clean_current_db, ruleset is SegmentCleaner.ruleset_hash
+        self.cleaned_documents = Table(
+            "cleaned_documents",
+            metadata,
+            Column("document_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("documents.id"), primary_key=True),
+            Column("ruleset", sqlalchemy.String),
+            Column("num_segments", sqlalchemy.Integer),
+            Column("num_cleaned", sqlalchemy.Integer),
+        )
         metadata.create_all(self.engine)
+        self._migrate()
+        self._create_indexes()
+        self.has_search = self._create_search_index()
+
+    @classmethod
+    def _on_connect(cls, dbapi_conn, connection_record):
+        for pragma in cls._PRAGMAS:
+            dbapi_conn.execute(pragma)
+
+    def _migrate(self):
+        with self.engine.begin() as conn:
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(segment_languages)")]
+            if "model" not in columns:
+                conn.execute("ALTER TABLE segment_languages ADD COLUMN model TEXT")
+
+    def _create_indexes(self):
+        with self.engine.begin() as conn:
+            for sql in self._SQL_CREATE_INDEXES:
+                conn.execute(sql)
+
+    @contextmanager
+    def deferred_indexes(self):
+        """ For large initial loads: drop the secondary indexes and the full-text index
+            while inserting and build them once at the end. If the load is interrupted
+            they are rebuilt the next time SegmentDb is opened. """
+        with self.engine.begin() as conn:
+            for name in self._INDEX_NAMES:
+                conn.execute(f"DROP INDEX IF EXISTS {name}")
+            for name in ("segments_fts_insert", "segments_fts_delete", "segments_fts_update"):
+                conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+            conn.execute("DROP TABLE IF EXISTS segments_fts")
+        try:
+            yield self
+        finally:
+            print("Building indexes")
+            self._create_indexes()
+            self.has_search = self._create_search_index()
+
+    def _create_search_index(self):
+        # remove_diacritics 2 also folds letters with several accents, needs sqlite 3.27
+        remove_diacritics = 2 if sqlite3.sqlite_version_info >= (3, 27, 0) else 1
+        exists_sql = "SELECT 1 FROM sqlite_master WHERE name = 'segments_fts'"
+        try:
+            with self.engine.begin() as conn:
+                existed = conn.execute(exists_sql).first() is not None
+                for sql in self._SQL_CREATE_SEARCH:
+                    conn.execute(sql.format(remove_diacritics=remove_diacritics))
+                if not existed and conn.execute("SELECT 1 FROM segments LIMIT 1").first():
+                    print("Building full-text index over existing segments, this takes a while")
+                    conn.execute("INSERT INTO segments_fts (segments_fts) VALUES ('rebuild')")
+        except sqlalchemy.exc.OperationalError as e:
+            print(e)
+            print("Full-text search is not available (sqlite without fts5?)")
+            return False
+        return True
+
+    def search(self, query, limit=20):
+        """ Full-text search over segments using fts5 query syntax, best matches first """
+        if not self.has_search:
+            raise RuntimeError("Full-text search is not available")
+        q = sqlalchemy.text("""
+            SELECT s.document_id, d.skemman_id, s.sentence_index,
+                snippet(segments_fts, 0, '[', ']', '...', 16)
+            FROM segments_fts
+            INNER JOIN segments AS s ON s.id = segments_fts.rowid
+            INNER JOIN documents AS d ON d.id = s.document_id
+            WHERE segments_fts MATCH :query
+            ORDER BY rank
+            LIMIT :limit
+        """)
+        with self.engine.begin() as conn:
+            res = conn.execute(q, query=query, limit=limit)
+            return [SearchHit(*row) for row in res]
 
     def insert_segments(self, segments, skemman_id):
+        """ Insert a document and stream its segments into the db in one transaction """
         with self.engine.begin() as connection:
             result = connection.execute(
                 self.documents.insert(), skemman_id=skemman_id
             )
             key = result.inserted_primary_key[0]
-            segs = [
-                {"sentence_index": segment.index, "text": segment.text, "document_id": key}
-                    for segment in segments
-            ]
-            connection.execute(self.segments.insert(), segs)
+            # Use the sqlite cursor directly, skipping sqlalchemy's per row processing.
+            # It shares the transaction that engine.begin() commits.
+            cursor = connection.connection.cursor()
+            rows = ((segment.index, segment.text, key) for segment in segments)
+            while True:
+                chunk = list(itertools.islice(rows, self.INSERT_CHUNK_SIZE))
+                if not chunk:
+                    break
+                cursor.executemany(self._SQL_INSERT_SEGMENT, chunk)
+            cursor.close()
 
     def get_completed(self):
         with self.engine.begin() as connection:
@@ -121,7 +305,143 @@ class SegmentDb:
 
         with self.engine.begin() as conn:
             res = conn.execute(q)
-            return [Segment(r[2]) for r in res]
+            return [Segment(r[2], id=r[0]) for r in res]
+
+    def get_unlabelled_documents(self, model):
+        """ Ids of documents without language labels from this model,
+            or whose segments changed since they were labelled """
+        q = sqlalchemy.text("""
+            SELECT d.id FROM documents AS d
+            LEFT JOIN document_languages AS l ON l.document_id = d.id
+            WHERE l.document_id IS NULL
+                OR l.model IS NOT :model
+                OR l.num_segments != (SELECT COUNT(*) FROM segments AS s WHERE s.document_id = d.id)
+            ORDER BY d.id
+        """)
+        with self.engine.connect() as conn:
+            return [row[0] for row in conn.execute(q, model=model)]
+
+    def get_documents_without_segments(self):
+        """ Ids of documents that have no segments, e.g. pdfs without a text layer """
+        q = sqlalchemy.text("""
+            SELECT d.id FROM documents AS d
+            WHERE NOT EXISTS (SELECT 1 FROM segments AS s WHERE s.document_id = d.id)
+        """)
+        with self.engine.connect() as conn:
+            return set(row[0] for row in conn.execute(q))
+
+    def iter_document_segments(self, document_ids, documents_per_batch=20):
+        """ Lists of (segment id, document id, text) holding every segment of a few documents,
+            each batch is its own short query so the db stays writable meanwhile """
+        for start in range(0, len(document_ids), documents_per_batch):
+            chunk = document_ids[start:start + documents_per_batch]
+            q = sqlalchemy.select(
+                [self.segments.c.id, self.segments.c.document_id, self.segments.c.text]
+            ).where(self.segments.c.document_id.in_(chunk)) \
+                .order_by(self.segments.c.document_id, self.segments.c.id)
+            with self.engine.connect() as conn:
+                yield [tuple(row) for row in conn.execute(q)]
+
+    def insert_languages(self, model, segment_rows, document_rows):
+        """ segment_rows of (segment id, language, confidence),
+            document_rows of (document id, language, confidence, number of segments) """
+        segment_sql = """INSERT OR REPLACE INTO
+            segment_languages (segment_id, language, confidence, model)
+            VALUES (?, ?, ?, ?)"""
+        document_sql = """INSERT OR REPLACE INTO
+            document_languages (document_id, language, confidence, num_segments, model)
+            VALUES (?, ?, ?, ?, ?)"""
+        with self.engine.begin() as connection:
+            cursor = connection.connection.cursor()
+            cursor.executemany(segment_sql, (row + (model,) for row in segment_rows))
+            cursor.executemany(document_sql, (row + (model,) for row in document_rows))
+            cursor.close()
+
+    def get_document_languages(self, model=None):
+        """ (skemman id, language, confidence) of labelled documents """
+        q = sqlalchemy.select(
+            [self.documents.c.skemman_id, self.document_languages.c.language, self.document_languages.c.confidence]
+        ).select_from(self.documents.join(self.document_languages))
+        if model is not None:
+            q = q.where(self.document_languages.c.model == model)
+        with self.engine.connect() as conn:
+            return [tuple(row) for row in conn.execute(q)]
+
+    def get_document_ids_by_language(self, language, min_confidence=0.0):
+        q = sqlalchemy.select([self.document_languages.c.document_id]) \
+            .where(self.document_languages.c.language == language) \
+            .where(self.document_languages.c.confidence >= min_confidence)
+        with self.engine.connect() as conn:
+            return [row[0] for row in conn.execute(q)]
+
+    def get_documents_without_spans(self, model):
+        q = sqlalchemy.text("""
+            SELECT d.id FROM documents AS d
+            WHERE NOT EXISTS (
+                SELECT 1 FROM language_spans AS l WHERE l.document_id = d.id AND l.model = :model
+            )
+            ORDER BY d.id
+        """)
+        with self.engine.connect() as conn:
+            return [row[0] for row in conn.execute(q, model=model)]
+
+    def insert_spans(self, model, spans):
+        """ spans of (document id, language, first segment id, last segment id, confidence),
+            replacing earlier spans of the same documents """
+        delete_sql = "DELETE FROM language_spans WHERE document_id = ?"
+        insert_sql = """INSERT INTO
+            language_spans (document_id, language, first_segment_id, last_segment_id, confidence, model)
+            VALUES (?, ?, ?, ?, ?, ?)"""
+        with self.engine.begin() as connection:
+            cursor = connection.connection.cursor()
+            cursor.executemany(delete_sql, [(document_id,) for document_id in set(span[0] for span in spans)])
+            cursor.executemany(insert_sql, (span + (model,) for span in spans))
+            cursor.close()
+
+    def iter_span_segments(self, language, min_confidence=0.0):
+        """ (document id, segment id, text) of every segment inside a span of language """
+        q = sqlalchemy.text("""
+            SELECT s.document_id, s.id, s.text
+            FROM language_spans AS l
+            INNER JOIN segments AS s ON s.id BETWEEN l.first_segment_id AND l.last_segment_id
+            WHERE l.language = :language AND l.confidence >= :min_confidence
+            ORDER BY s.id
+        """)
+        with self.engine.connect() as conn:
+            for row in conn.execute(q, language=language, min_confidence=min_confidence):
+                yield tuple(row)
+
+    def get_uncleaned_documents(self, ruleset):
+        """ Ids of documents not yet cleaned with this ruleset """
+        q = sqlalchemy.text("""
+            SELECT d.id FROM documents AS d
+            LEFT JOIN cleaned_documents AS c ON c.document_id = d.id
+            WHERE c.document_id IS NULL OR c.ruleset IS NOT :ruleset
+            ORDER BY d.id
+        """)
+        with self.engine.connect() as conn:
+            return [row[0] for row in conn.execute(q, ruleset=ruleset)]
+
+    def insert_cleaned(self, ruleset, documents):
+        """ documents of (document id, number of segments, [(segment id, text, metadata json)]),
+            replacing earlier cleaned segments of the same documents """
+        delete_sql = "DELETE FROM cleaned_segments WHERE document_id = ?"
+        insert_sql = """INSERT INTO
+            cleaned_segments (segment_index, text, document_id, metadata)
+            VALUES (?, ?, ?, ?)"""
+        checkpoint_sql = """INSERT OR REPLACE INTO
+            cleaned_documents (document_id, ruleset, num_segments, num_cleaned)
+            VALUES (?, ?, ?, ?)"""
+        with self.engine.begin() as connection:
+            cursor = connection.connection.cursor()
+            for (document_id, num_segments, rows) in documents:
+                cursor.execute(delete_sql, (document_id,))
+                cursor.executemany(
+                    insert_sql,
+                    ((segment_id, text, document_id, metadata) for (segment_id, text, metadata) in rows),
+                )
+                cursor.execute(checkpoint_sql, (document_id, ruleset, num_segments, len(rows)))
+            cursor.close()
 
     def get_max_docid(self):
         q = sqlalchemy.sql.select([func.max(self.documents.c.id)])
@@ -130,7 +450,7 @@ class SegmentDb:
             return res.first()[0]
 
 
-def gen_pdf():
+def gen_pdf(workers=1, defer_indexes=False):
     segment_db = SegmentDb()
     completed_files = segment_db.get_completed()
     print("total files", len(get_open_access_article_pdfs()))
@@ -144,32 +464,118 @@ def gen_pdf():
     ]
     #print(rem_files)
     print("remaining files", len(rem_files))
-    for (idx, item) in enumerate(rem_files):
-        try:
-            skemman_id = item.url
-            process_pdf(segment_db, item)
-            time.sleep(3)
-        except KeyboardInterrupt:
-            remain = len(rem_files) - idx - 1
-            print()
-            print(f"Exiting... {remain} remaining")
-            return
-        except Exception:
-            print("boop")
-            continue
-
-
-def process_pdf(db, item):
+    with segment_db.deferred_indexes() if defer_indexes else nullcontext():
+        if workers > 1:
+            gen_pdf_parallel(segment_db, rem_files, workers)
+        else:
+            gen_pdf_serial(segment_db, rem_files)
+
+
+def gen_pdf_serial(segment_db, rem_files):
+    with PdfBoxServer() as pdfbox:
+        for (idx, item) in enumerate(rem_files):
+            try:
+                skemman_id = item.url
+                process_pdf(segment_db, item, pdfbox)
+                wait_for_cool_down()
+            except KeyboardInterrupt:
+                remain = len(rem_files) - idx - 1
+                print()
+                print(f"Exiting... {remain} remaining")
+                return
+            except Exception:
+                print("boop")
+                continue
+
+
+def gen_pdf_parallel(segment_db, rem_files, workers):
+    """ Extract and segment in a pool of worker processes,
+        while this process is the only one writing to segment_db """
+    tasks = [(item.url, item.local_path) for item in rem_files]
+    pool = multiprocessing.Pool(workers, initializer=init_pdfbox_worker, initargs=pdfbox_worker_settings())
+    done = 0
+    try:
+        for (skemman_id, segments) in pool.imap_unordered(_extract_and_segment, tasks):
+            done += 1
+            if segments is None:
+                print(f"[{done}/{len(tasks)}] could not extract {skemman_id}", flush=True)
+                continue
+            segment_db.insert_segments((SimpleSegment(*seg) for seg in segments), skemman_id)
+            print(f"[{done}/{len(tasks)}] inserted {len(segments)} segments from {skemman_id}", flush=True)
+        pool.close()
+    except KeyboardInterrupt:
+        print()
+        print(f"Exiting... {len(tasks) - done} remaining")
+        pool.terminate()
+    finally:
+        pool.join()
+
+
+# Each pool worker streams its files through its own pdfbox server
+_worker_pdfbox = None
+
+
+def pdfbox_worker_settings(verbose=True):
+    """ initargs for init_pdfbox_worker, the settings of this process """
+    return (config.pdfbox_path, config.max_load, config.max_cpu_temp, verbose)
+
+
+def init_pdfbox_worker(pdfbox_path, max_load, max_cpu_temp, verbose=True):
+    """ Pool initializer that starts a pdfbox server in the worker, see worker_pdfbox """
+    global _worker_pdfbox
+    # Let the parent handle ctrl-c, this is inherited by the pdfbox JVM as well
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    config.pdfbox_path = pdfbox_path
+    config.max_load = max_load
+    config.max_cpu_temp = max_cpu_temp
+    _worker_pdfbox = PdfBoxServer(verbose=verbose)
+
+
+def worker_pdfbox():
+    """ The pdfbox server of this pool worker """
+    return _worker_pdfbox
+
+
+def _extract_and_segment(task):
+    skemman_id, pdf_path = task
+    try:
+        wait_for_cool_down()
+        text = extract_text(pdf_path, worker_pdfbox())
+        if text is None:
+            return skemman_id, None
+        # namedtuples defined under another name do not pickle, send plain tuples
+        return skemman_id, [tuple(seg) for seg in segment_text(text)]
+    except Exception:
+        traceback.print_exc()
+        return skemman_id, None
+
+
+def process_pdf(db, item, pdfbox=None):
+    text = extract_text(item.local_path, pdfbox)
+    if text is not None:
+        segments = segment_text(text)
+        db.insert_segments(segments, item.url)
+
+
+def extract_text(pdf_path, pdfbox=None):
+    """ Text of a pdf, pdfbox only runs if the text store does not have it yet """
+    return TextStore.shared().get_or_extract(pdf_path, lambda path: run_pdfbox(path, pdfbox))
+
+
+def run_pdfbox(pdf_path, pdfbox=None):
     tmp_fname = str(uuid.uuid4())
     tmp_path = config.tmp_dir() / tmp_fname
-    success = pdfbox_to_text(item.local_path, tmp_path)
+    text = None
+    if pdfbox is not None:
+        success = pdfbox.extract(pdf_path, tmp_path).ok
+    else:
+        success = pdfbox_to_text(pdf_path, tmp_path)
     if success:
         with open(tmp_path, "r") as fh:
             text = fh.read()
-        segments = segment_text(text)
-        db.insert_segments(segments, item.url)
     if tmp_path.exists():
         os.remove(tmp_path)
+    return text
 
 
 def toks_to_text(tokstream):
@@ -192,9 +598,8 @@ def segment_text(text):
 
 
 def test_segment():
-    files_on_disk = get_open_access_article_pdfs()
+    files_on_disk = get_open_access_article_pdfs(language="icelandic")
     files_on_disk = [item for item in files_on_disk if item.is_on_disk]
-    files_on_disk = [item for item in files_on_disk if item.language == "icelandic"]
     random.seed(1337)
     random.shuffle(files_on_disk)
     sample = files_on_disk[0]
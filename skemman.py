@@ -8,7 +8,14 @@ import unicodedata
 import base64
 from pathlib import Path
 
-from bs4 import BeautifulSoup as bs
+from bs4 import BeautifulSoup as bs, SoupStrainer
+
+try:
+    import lxml  # noqa
+
+    DEFAULT_HTML_PARSER = "lxml"
+except ImportError:  # Fall back to the slower pure python parser
+    DEFAULT_HTML_PARSER = "html.parser"
 
 try:
     from icecream import ic
@@ -79,6 +86,18 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+# Only build a tree for the parts of the pages that are actually read
+DOCUMENT_PAGE_STRAINER = SoupStrainer("div", id="index_page")
+RESULTS_PAGE_STRAINER = SoupStrainer("table")
+RESULTS_CAPTION = "Niðurstöður"
+
+
+def make_soup(html, parse_only=None, parser=None):
+    if parser is None:
+        parser = config.html_parser or DEFAULT_HTML_PARSER
+    return bs(html, parser, parse_only=parse_only)
+
+
 def breadcrumbs_to_path(breadcrumbs):
     breadcrumbs = [item.replace("/", "-") for item in breadcrumbs]
     #return utils.transliterate_path("/".join(breadcrumbs)).lower()
@@ -96,17 +115,21 @@ class SkemmanDocument:
         self.filelist = None
         self.document_id = None
 
-    def fetch(self):
-        logger.info(f"Getting document page for {self.href}")
+    @property
+    def url(self):
         query_str, fragment = "", ""
         url_tup = (Skemman._scheme, Skemman._netloc, self.href, query_str, fragment)
-        url = urllib.parse.urlunsplit(url_tup)
+        return urllib.parse.urlunsplit(url_tup)
 
-        self.html = Fetcher.fetch_with_retry(url)
+    def fetch(self):
+        logger.info(f"Getting document page for {self.href}")
+        self.html = Fetcher.fetch_with_retry(self.url)
 
-    def parse(self):
+    def parse(self, parser=None, strain=True):
+        """ With strain=False the whole page is parsed, as before targeted parsing """
         logger.info(f"Parsing document page {self.href}")
-        soup = bs(self.html, "html.parser")
+        parse_only = DOCUMENT_PAGE_STRAINER if strain else None
+        soup = make_soup(self.html, parse_only=parse_only, parser=parser)
         main_content = soup.find("div", id="index_page")
         header = main_content.find("h1")
 
@@ -191,21 +214,24 @@ class SkemmanDocument:
             cursor = db.insert_document(self)
             self.document_id = cursor.lastrowid
 
-    def store_filelist(self, db):
+    def store_filelist(self, db, replace=False):
         if self.document_id is not None:
             self.get_id_or_store_document(db)
         rel_dir = breadcrumbs_to_path(json.loads(self.attrs["taxonomy"]))
-        cursor = db.insert_filelist(self.filelist, rel_dir, self.document_id)
+        cursor = db.insert_filelist(self.filelist, rel_dir, self.document_id, replace=replace)
 
-    def store_attrs(self, db):
+    def store_attrs(self, db, replace=False):
         if self.document_id is not None:
             self.get_id_or_store_document(db)
-        cursor = db.insert_map(self.attrs, self.document_id)
+        cursor = db.insert_map(self.attrs, self.document_id, replace=replace)
 
-    def store_all(self, db):
+    def store_all(self, db, replace=False):
+        """ replace: the document may be stored already, overwrite what was parsed from its pages """
         self.get_id_or_store_document(db)
-        self.store_filelist(db)
-        self.store_attrs(db)
+        if replace:
+            db.update_document(self)
+        self.store_filelist(db, replace=replace)
+        self.store_attrs(db, replace=replace)
 
 
 class SkemmanFile:
@@ -253,17 +279,38 @@ class SkemmanFile:
             if verbose:
                 print(f"Already synced file: {self.href}", flush=True)
             return self.local_path
-        suffixes = self.local_path.suffixes + [".tmp"]
-        tmp_path = self.local_path.with_suffix("".join(suffixes))
-        if verbose:
-            print(f"Downloading file ({self.size} MB): {self.href}", flush=True)
-        fpath = download_file(self.url, self.local_path, tmp_path, make_dirs=True)
+        fpath = self.download(verbose=verbose)
 
         db.update_file_status(self.href, True)
+        return fpath
+
+    def download(self, resume=True, bandwidth=None, stop=None, verbose=False):
+        """ Download to local_path without touching the db, so it can run in any thread """
+        tmp_path = self.tmp_path
+        if verbose:
+            if resume and tmp_path.is_file():
+                partial_mb = tmp_path.stat().st_size / 10 ** 6
+                print(f"Resuming file ({partial_mb:.1f}/{self.size} MB): {self.href}", flush=True)
+            else:
+                print(f"Downloading file ({self.size} MB): {self.href}", flush=True)
+        fpath = download_file(
+            self.url,
+            self.local_path,
+            tmp_path,
+            make_dirs=True,
+            resume=resume,
+            bandwidth=bandwidth,
+            stop=stop,
+        )
         if verbose:
             print(f"Saved file to {self.relative_path}", flush=True)
         return fpath
 
+    @property
+    def tmp_path(self):
+        suffixes = self.local_path.suffixes + [".tmp"]
+        return self.local_path.with_suffix("".join(suffixes))
+
     @property
     def local_path(self):
         path = self.base_dir / self.rel_dir / self.local_filename
@@ -330,16 +377,16 @@ class Skemman:
         return results
 
     @classmethod
-    def parse_results_page(cls, html):
+    def parse_results_page(cls, html, parser=None):
         """Parse search results page, extracting links to new document pages"""
         logger.info("Attempting to parse results page")
-        soup = bs(html, "html.parser")
+        soup = make_soup(html, parse_only=RESULTS_PAGE_STRAINER, parser=parser)
         logger.info("Soup is made")
         results = []
-        for table in soup.find_all("table"):
-            caption = table.find("caption")
-            if not caption or caption.text != "Niðurstöður":
+        for caption in soup.find_all("caption"):
+            if caption.text != RESULTS_CAPTION:
                 continue
+            table = caption.find_parent("table")
             for row in table.find_all("tr"):
                 data = []
                 for col in row.find_all("td"):
@@ -1,7 +1,11 @@
+import os
+import re
 import sqlite3
 import datetime
+from contextlib import contextmanager
 
 import config
+import file_classifier
 
 
 class SkemmanDb:
@@ -29,6 +33,9 @@ class SkemmanDb:
             inserted TEXT,
             document_id INTEGER,
             language TEXT,
+            size_bytes INTEGER,
+            is_main_pdf BOOL,
+            class_reason TEXT,
             UNIQUE(fname, document_id),
             FOREIGN KEY (document_id) REFERENCES skemman_documents (id)
     )"""
@@ -46,6 +53,58 @@ class SkemmanDb:
             UNIQUE(page)
     )"""
 
+    # Persistent download queue, status is one of pending, done, failed
+    _SQL_CREATE_SKEMMAN_DOWNLOADS = """CREATE TABLE IF NOT EXISTS skemman_downloads (
+            id INTEGER PRIMARY KEY,
+            href TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            updated TEXT,
+            UNIQUE(href)
+    )"""
+
+    # One row per document with the attributes used for filtering the corpus,
+    # kept in sync with skemman_maps by insert_map
+    _SQL_CREATE_SKEMMAN_METADATA = """CREATE TABLE IF NOT EXISTS skemman_metadata (
+            document_id INTEGER PRIMARY KEY,
+            language TEXT,
+            degree TEXT,
+            year INTEGER,
+            taxonomy TEXT,
+            FOREIGN KEY (document_id) REFERENCES skemman_documents (id)
+    )"""
+
+    _SQL_CREATE_INDEXES = (
+        "CREATE INDEX IF NOT EXISTS skemman_maps_document_id ON skemman_maps (document_id)",
+        "CREATE INDEX IF NOT EXISTS skemman_maps_key_value ON skemman_maps (key, value)",
+        "CREATE INDEX IF NOT EXISTS skemman_files_document_id ON skemman_files (document_id)",
+        "CREATE INDEX IF NOT EXISTS skemman_metadata_language ON skemman_metadata (language)",
+        "CREATE INDEX IF NOT EXISTS skemman_metadata_degree ON skemman_metadata (degree)",
+        "CREATE INDEX IF NOT EXISTS skemman_metadata_year ON skemman_metadata (year)",
+        "CREATE INDEX IF NOT EXISTS skemman_files_main_pdf ON skemman_files (is_main_pdf, size_bytes)",
+        "CREATE INDEX IF NOT EXISTS skemman_files_language ON skemman_files (language)",
+    )
+
+    # Columns added to skemman_files after its first release, see _migrate
+    _FILES_CLASS_COLUMNS = (
+        ("size_bytes", "INTEGER"),
+        ("is_main_pdf", "BOOL"),
+        ("class_reason", "TEXT"),
+    )
+
+    # Attribute labels on document pages that fill the skemman_metadata columns, first match wins.
+    # The labels are stored as shown on the page, with a trailing colon, e.g. "Tungumál:"
+    METADATA_KEYS = {
+        "language": ("Tungumál", "Language"),
+        "degree": ("Námsstig", "Level", "Gráða", "Degree"),
+        "year": ("Samþykkt", "Útgáfudagur", "Accepted", "Date issued", "Útgáfa", "Issue Date"),
+    }
+
+    _YEAR_RX = re.compile(r"\b(1[89]\d\d|2\d\d\d)\b")
+
+    # Bumped when a migration is added to _migrate, stored in PRAGMA user_version
+    _SCHEMA_VERSION = 3
+
     _SQL_CREATE_VIEW_OPEN_ACCESS_PDFS = """
     CREATE VIEW IF NOT EXISTS open_access_pdfs AS
         SELECT
@@ -62,10 +121,27 @@ class SkemmanDb:
         WHERE access = "Opinn" AND ftype = "PDF"
     """
 
+    _PRAGMAS = (
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA cache_size = -65536",  # in KiB, 64 MB
+        "PRAGMA temp_store = MEMORY",
+    )
+
+    # Statements are compiled once and reused from the connection's cache
+    _CACHED_STATEMENTS = 256
+
+    # One instance per process and database file, see SkemmanDb.shared
+    _shared = {}
+
     def __init__(self):
         self._DB_NAME = config.db_dir() / "skemman.db"
-        conn = sqlite3.connect(self._DB_NAME)
+        self._in_transaction = False
+        self._savepoints = 0
+        conn = sqlite3.connect(self._DB_NAME, cached_statements=self._CACHED_STATEMENTS)
         try:
+            for pragma in self._PRAGMAS:
+                conn.execute(pragma)
             SkemmanDb._create_tables_views(conn)
         except Exception as e:
             print(e)
@@ -73,6 +149,58 @@ class SkemmanDb:
             return
         self.conn = conn
 
+    @classmethod
+    def shared(cls):
+        """ The process wide connection to skemman.db in the current data dir """
+        key = (os.getpid(), str(config.db_dir() / "skemman.db"))
+        db = cls._shared.get(key)
+        if db is None:
+            db = cls()
+            cls._shared[key] = db
+        return db
+
+    @contextmanager
+    def transaction(self):
+        """ Commit all writes inside the block at once, instead of one commit per call.
+            A failed write inside the block raises and rolls the block back. Nested blocks
+            are savepoints, so the outer block can carry on when one of them fails. """
+        if self._in_transaction:
+            self._savepoints += 1
+            savepoint = f"savepoint_{self._savepoints}"
+            self.conn.execute(f"SAVEPOINT {savepoint}")
+            try:
+                yield self
+            except BaseException:
+                self.conn.execute(f"ROLLBACK TO {savepoint}")
+                raise
+            finally:
+                self.conn.execute(f"RELEASE {savepoint}")
+                self._savepoints -= 1
+            return
+        self._in_transaction = True
+        try:
+            with self.conn:
+                yield self
+        finally:
+            self._in_transaction = False
+
+    @contextmanager
+    def _connection(self, error_message=None):
+        """ Commits on exit, unless inside transaction(). Errors are printed and the block
+            is skipped, inside transaction() they are raised so the transaction rolls back. """
+        try:
+            if self._in_transaction:
+                yield self.conn
+            else:
+                with self.conn as c:
+                    yield c
+        except Exception as e:
+            print(e)
+            if error_message:
+                print(error_message)
+            if self._in_transaction:
+                raise
+
     @classmethod
     def _create_tables_views(cls, conn):
         with conn as c:
@@ -80,7 +208,80 @@ class SkemmanDb:
             c.execute(cls._SQL_CREATE_SKEMMAN_MAP)
             c.execute(cls._SQL_CREATE_SKEMMAN_FILES)
             c.execute(cls._SQL_CREATE_SKEMMAN_PAGES)
+            c.execute(cls._SQL_CREATE_SKEMMAN_DOWNLOADS)
+            c.execute(cls._SQL_CREATE_SKEMMAN_METADATA)
             c.execute(cls._SQL_CREATE_VIEW_OPEN_ACCESS_PDFS)
+            cls._migrate(c)
+            for sql in cls._SQL_CREATE_INDEXES:
+                c.execute(sql)
+
+    @classmethod
+    def _migrate(cls, conn):
+        """ Bring data in an older database up to date, runs inside the create transaction """
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 2:
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(skemman_files)")]
+            for (name, col_type) in cls._FILES_CLASS_COLUMNS:
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE skemman_files ADD COLUMN {name} {col_type}")
+            # New rows are classified when they are inserted, the old ones once here
+            cls._classify_rows(conn, only_missing=True)
+        if version < 3:
+            # Before version 3 the labels were looked up without their colon, so
+            # language and degree were never filled
+            cls._backfill_metadata(conn)
+        if version < cls._SCHEMA_VERSION:
+            conn.execute(f"PRAGMA user_version = {cls._SCHEMA_VERSION}")
+
+    @classmethod
+    def _backfill_metadata(cls, conn):
+        accepted = dict(conn.execute("SELECT id, accepted FROM skemman_documents"))
+        rows = conn.execute(
+            "SELECT document_id, key, value FROM skemman_maps ORDER BY document_id"
+        )
+        params = []
+        attr_map, current_id = {}, None
+        for (document_id, key, value) in rows:
+            if document_id != current_id and current_id is not None:
+                params.append(cls._metadata_row(current_id, attr_map, accepted.get(current_id)))
+                attr_map = {}
+            current_id = document_id
+            attr_map[key] = value
+        if current_id is not None:
+            params.append(cls._metadata_row(current_id, attr_map, accepted.get(current_id)))
+        if params:
+            print(f"Migrating skemman.db: filling skemman_metadata for {len(params)} documents")
+        conn.executemany(cls._SQL_REPLACE_METADATA, params)
+
+    _SQL_REPLACE_METADATA = """INSERT OR REPLACE INTO
+        skemman_metadata (document_id, language, degree, year, taxonomy)
+        VALUES (?, ?, ?, ?, ?)"""
+
+    @classmethod
+    def _metadata_row(cls, document_id, attr_map, accepted=None):
+        labels = {key.rstrip(":").strip(): value for (key, value) in attr_map.items()}
+
+        def first_value(column):
+            for key in cls.METADATA_KEYS[column]:
+                if labels.get(key):
+                    return labels[key].strip()
+            return None
+
+        year = None
+        for text in (first_value("year"), accepted):
+            match = cls._YEAR_RX.search(text or "")
+            if match:
+                year = int(match.group(1))
+                break
+        language = first_value("language")
+        degree = first_value("degree")
+        return (
+            document_id,
+            language.lower() if language else None,
+            degree.lower() if degree else None,
+            year,
+            attr_map.get("taxonomy"),
+        )
 
     def insert_document(self, doc):
         sql = """INSERT INTO
@@ -88,35 +289,87 @@ class SkemmanDb:
             VALUES (?, ?, ?, ?, ?)"""
         date_inserted = str(datetime.date.today())
         params = (doc.href, doc.title, doc.author, doc.accepted, date_inserted)
-        try:
-            with self.conn as c:
-                return c.execute(sql, params)
-        except Exception as e:
-            print(e)
-            print(f"Could not insert document {doc.href}")
+        with self._connection(f"Could not insert document {doc.href}") as c:
+            return c.execute(sql, params)
+
+    def update_document(self, doc):
+        """ Title, author and accepted date of a stored document, from a re-parse """
+        sql = """UPDATE skemman_documents
+            SET title = ?, author = ?, accepted = ? WHERE href = ?"""
+        params = (doc.title, doc.author, doc.accepted, doc.href)
+        with self._connection(f"Could not update document {doc.href}") as c:
+            return c.execute(sql, params)
 
-    def insert_map(self, attr_map, document_id):
+    def insert_map(self, attr_map, document_id, replace=False):
+        """ replace: drop the attributes already stored for the document first """
         sql = """INSERT INTO
             skemman_maps (key, value, document_id)
             VALUES (?, ?, ?)"""
         params = [(key, val, document_id) for (key, val) in attr_map.items()]
+        with self._connection(f"Could not insert map for {document_id}") as c:
+            if replace:
+                c.execute("DELETE FROM skemman_maps WHERE document_id = ?", (document_id,))
+            cursor = c.executemany(sql, params)
+            self._update_metadata(c, document_id)
+            return cursor
+
+    def _update_metadata(self, conn, document_id):
+        rows = conn.execute(
+            "SELECT key, value FROM skemman_maps WHERE document_id = ?", (document_id,)
+        )
+        attr_map = {key: value for (key, value) in rows}
+        accepted = conn.execute(
+            "SELECT accepted FROM skemman_documents WHERE id = ?", (document_id,)
+        ).fetchone()
+        row = self._metadata_row(document_id, attr_map, accepted[0] if accepted else None)
+        conn.execute(self._SQL_REPLACE_METADATA, row)
+
+    def get_document_ids(self, language=None, degree=None, year=None, taxonomy=None):
+        """ Ids of documents matching all given metadata values.
+            language and degree are lower case, taxonomy matches any part of the breadcrumbs. """
+        clauses, params = [], []
+        for (column, value) in (("language", language), ("degree", degree), ("year", year)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if taxonomy is not None:
+            clauses.append("taxonomy LIKE ?")
+            params.append(f"%{taxonomy}%")
+        where = " AND ".join(clauses) if clauses else "1"
+        sql = f"""SELECT document_id FROM skemman_metadata WHERE {where}"""
+        with self._connection() as c:
+            cursor = c.execute(sql, params)
+            return [tup[0] for tup in cursor.fetchall()]
+
+    @staticmethod
+    def _classify(fname, size, access, descr):
         try:
-            with self.conn as c:
-                return c.executemany(sql, params)
-        except Exception as e:
-            print(e)
-            print(f"Could not insert map for {document_id}")
+            return file_classifier.classify_file(fname, size, access, descr)
+        except (IndexError, ValueError, AttributeError):
+            # Unparsable size, never picked as a main pdf
+            return None, False, file_classifier.BAD_SIZE
 
-    def insert_filelist(self, filelist, rel_dir, document_id):
+    def insert_filelist(self, filelist, rel_dir, document_id, replace=False):
+        """ replace: update files that are already stored, keeping is_local, language
+            and inserted, which do not come from the document page """
         sql = """INSERT INTO
             skemman_files (href, fname, size,
                            access, descr, ftype,
                            is_local, dir, inserted,
-                           document_id)
+                           document_id, size_bytes, is_main_pdf,
+                           class_reason)
             VALUES (?, ?, ?,
+                    ?, ?, ?,
                     ?, ?, ?,
                     ?, ?, ?,
                     ?)"""
+        if replace:
+            # Closed files have no href, so files are matched by name within the document
+            sql += """ ON CONFLICT (fname, document_id) DO UPDATE SET
+                href = excluded.href, size = excluded.size, access = excluded.access,
+                descr = excluded.descr, ftype = excluded.ftype, dir = excluded.dir,
+                size_bytes = excluded.size_bytes, is_main_pdf = excluded.is_main_pdf,
+                class_reason = excluded.class_reason"""
 
         date_inserted = str(datetime.date.today())
         params = [(
@@ -130,82 +383,59 @@ class SkemmanDb:
             rel_dir,
             date_inserted,
             document_id,
+            *self._classify(sfile.fname, sfile.size, sfile.access, sfile.descr),
         ) for sfile in filelist]
-        try:
-            with self.conn as c:
-                return c.executemany(sql, params)
-        except Exception as e:
-            print(e)
+        with self._connection() as c:
+            return c.executemany(sql, params)
 
     def get_document_id_by_href(self, href):
         sql = """SELECT id FROM skemman_documents WHERE href = ?"""
         params = (href,)
-        try:
-            with self.conn as c:
-                cursor = c.execute(sql, params)
-                res = cursor.fetchone()
-                return res[0] if res is not None else res
-        except Exception as e:
-            print(e)
+        with self._connection() as c:
+            cursor = c.execute(sql, params)
+            res = cursor.fetchone()
+            return res[0] if res is not None else res
 
     def insert_page(self, idx):
-        sql = """INSERT INTO skemman_pages (page) VALUES (?)"""
+        sql = """INSERT OR IGNORE INTO skemman_pages (page) VALUES (?)"""
         params = (idx,)
-        try:
-            with self.conn as c:
-                return c.execute(sql, params)
-        except Exception as e:
-            print(e)
+        with self._connection() as c:
+            return c.execute(sql, params)
 
     def get_pages(self):
         sql = """SELECT page FROM skemman_pages"""
-        try:
-            with self.conn as c:
-                cursor = c.execute(sql)
-                pages = set([tup[0] for tup in cursor.fetchall()])
-                return pages
-        except Exception as e:
-            print(e)
+        with self._connection() as c:
+            cursor = c.execute(sql)
+            pages = set([tup[0] for tup in cursor.fetchall()])
+            return pages
 
     def get_hrefs(self):
         sql = """SELECT href FROM skemman_documents"""
-        try:
-            with self.conn as c:
-                cursor = c.execute(sql)
-                pages = set([tup[0] for tup in cursor.fetchall()])
-                return pages
-        except Exception as e:
-            print(e)
+        with self._connection() as c:
+            cursor = c.execute(sql)
+            pages = set([tup[0] for tup in cursor.fetchall()])
+            return pages
 
     def get_documents(self):
         sql = """SELECT * FROM skemman_documents"""
-        try:
-            with self.conn as c:
-                cursor = c.execute(sql)
-                docs = cursor.fetchall()
-                return docs
-        except Exception as e:
-            print(e)
+        with self._connection() as c:
+            cursor = c.execute(sql)
+            docs = cursor.fetchall()
+            return docs
 
     def get_files(self):
         sql = """SELECT fname, size, access FROM skemman_files"""
-        try:
-            with self.conn as c:
-                cursor = c.execute(sql)
-                files = cursor.fetchall()
-                return files
-        except Exception as e:
-            print(e)
+        with self._connection() as c:
+            cursor = c.execute(sql)
+            files = cursor.fetchall()
+            return files
 
     def get_open_pdfs(self):
         sql = """SELECT fname, size, FROM open_access_pdfs"""
-        try:
-            with self.conn as c:
-                cursor = c.execute(sql)
-                files = cursor.fetchall()
-                return files
-        except Exception as e:
-            print(e)
+        with self._connection() as c:
+            cursor = c.execute(sql)
+            files = cursor.fetchall()
+            return files
 
     def get_filedocs(self):
         sql = """
@@ -224,30 +454,125 @@ class SkemmanDb:
             FROM skemman_files AS f
             INNER JOIN skemman_documents AS d ON f.document_id = d.id
         """
-        try:
-            with self.conn as c:
-                cursor = c.execute(sql)
-                files = cursor.fetchall()
-                return files
-        except Exception as e:
-            print(e)
+        with self._connection() as c:
+            cursor = c.execute(sql)
+            files = cursor.fetchall()
+            return files
+
+    @classmethod
+    def _classify_rows(cls, conn, only_missing=False):
+        sql = """SELECT id, fname, size, access, descr FROM skemman_files"""
+        if only_missing:
+            sql += " WHERE class_reason IS NULL"
+        update_sql = """UPDATE skemman_files
+            SET size_bytes = ?, is_main_pdf = ?, class_reason = ? WHERE id = ?"""
+        rows = conn.execute(sql).fetchall()
+        params = [
+            (*cls._classify(fname, size, access, descr), file_id)
+            for (file_id, fname, size, access, descr) in rows
+        ]
+        conn.executemany(update_sql, params)
+        return len(params)
+
+    def classify_files(self, only_missing=False):
+        """ Store size_bytes, is_main_pdf and class_reason for files,
+            e.g. after changing the lists in file_classifier """
+        with self._connection() as c:
+            num_files = self._classify_rows(c, only_missing)
+            if num_files and not only_missing:
+                print(f"Classified {num_files} files")
+            return num_files
+
+    def get_main_pdfs(self, max_size_bytes=None, language=None):
+        """ Same columns as get_filedocs, only main pdf files,
+            language is the label set by language_id.predict_all, e.g. 'icelandic' """
+        sql = """
+            SELECT
+                f.href AS file_href
+                , fname
+                , size
+                , descr
+                , access
+                , dir
+                , d.href AS document_href
+                , title
+                , is_local
+                , document_id
+                , language
+            FROM skemman_files AS f
+            INNER JOIN skemman_documents AS d ON f.document_id = d.id
+            WHERE is_main_pdf AND size_bytes <= ? {language_filter}
+            ORDER BY f.href
+        """
+        params = [max_size_bytes if max_size_bytes is not None else 2 ** 62]
+        if language is not None:
+            params.append(language)
+        sql = sql.format(language_filter="AND f.language = ?" if language is not None else "")
+        with self._connection() as c:
+            cursor = c.execute(sql, params)
+            return cursor.fetchall()
+
+    def get_file_metadata(self):
+        """ (file href, document href, taxonomy, language, year) for every file with an href,
+            closed files have none. The file language wins over the language on the document page """
+        sql = """
+            SELECT
+                f.href AS file_href
+                , d.href AS document_href
+                , m.taxonomy
+                , COALESCE(f.language, m.language)
+                , m.year
+            FROM skemman_files AS f
+            INNER JOIN skemman_documents AS d ON f.document_id = d.id
+            LEFT JOIN skemman_metadata AS m ON m.document_id = d.id
+            WHERE f.href IS NOT NULL
+        """
+        with self._connection() as c:
+            return c.execute(sql).fetchall()
+        return []
+
+    def update_file_languages(self, rows):
+        """ rows of (language, href) """
+        sql = """UPDATE skemman_files
+            SET language = ? WHERE href = ?"""
+        with self._connection() as c:
+            c.executemany(sql, rows)
 
     def update_file_status(self, href, status):
         sql = """UPDATE skemman_files
             SET is_local = ? WHERE href = ?"""
-        try:
-            with self.conn as c:
-                cursor = c.execute(sql, (status, href))
-                return cursor
-        except Exception as e:
-            print(e)
+        with self._connection() as c:
+            cursor = c.execute(sql, (status, href))
+            return cursor
 
     def update_file_language(self, href, language):
         sql = """UPDATE skemman_files
             SET language = ? WHERE href = ?"""
-        try:
-            with self.conn as c:
-                cursor = c.execute(sql, (language, href))
-                return cursor
-        except Exception as e:
-            print(e)
+        with self._connection() as c:
+            cursor = c.execute(sql, (language, href))
+            return cursor
+
+    def enqueue_downloads(self, hrefs):
+        sql = """INSERT OR IGNORE INTO
+            skemman_downloads (href, status, updated)
+            VALUES (?, 'pending', ?)"""
+        now = str(datetime.datetime.now())
+        params = [(href, now) for href in hrefs]
+        with self._connection() as c:
+            return c.executemany(sql, params)
+
+    def get_download_queue(self, max_attempts):
+        """ Hrefs of unfinished downloads in the order they were queued """
+        sql = """SELECT href FROM skemman_downloads
+            WHERE status != 'done' AND attempts < ?
+            ORDER BY id"""
+        with self._connection() as c:
+            cursor = c.execute(sql, (max_attempts,))
+            return [tup[0] for tup in cursor.fetchall()]
+
+    def update_download_status(self, href, status, failed=False):
+        sql = """UPDATE skemman_downloads
+            SET status = ?, attempts = attempts + ?, updated = ? WHERE href = ?"""
+        params = (status, 1 if failed else 0, str(datetime.datetime.now()), href)
+        with self._connection() as c:
+            return c.execute(sql, params)
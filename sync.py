@@ -1,7 +1,8 @@
 import os
-import time
 from pathlib import Path
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 try:
     from icecream import ic
@@ -10,40 +11,81 @@ try:
 except ImportError:  # Silently ignore if IceCream isn't installed.
     ic = lambda *a: None if not a else (a[0] if len(a) == 1 else a)  # noqa
 
+from fetcher import DownloadStopped
+from rate_limit import HostRateLimiter, TokenBucket
 from skemman_db import SkemmanDb
 from utils import get_open_access_article_pdfs
 import config
 
+# A file that failed this many times is skipped until its attempts are reset
+MAX_ATTEMPTS = 5
 
 
 def clean_dirty_state(skemman_file):
     pass
 
 
-def download_files():
+def download_files(workers=None, bandwidth_limit=None, download_dir=None):
+    """ Download remaining files with a pool of worker threads.
+        The queue is kept in the db and partial downloads are resumed,
+        so an interrupted sync continues where it left off. """
+    workers = config.download_workers if workers is None else workers
+    bandwidth_limit = config.bandwidth_limit if bandwidth_limit is None else bandwidth_limit
     fetch_status()
-    print(f"Downloading files to: {config.pdf_dir()}")
     files_out = get_open_access_article_pdfs()
-    db = SkemmanDb()
+    if download_dir is not None:
+        for item in files_out:
+            item.base_dir = download_dir
+    print(f"Downloading files to: {files_out[0].base_dir if files_out else config.pdf_dir()}")
+    db = SkemmanDb.shared()
     remaining_files = [item for item in files_out if not item.is_local]
+
+    # Files already on disk only need to be marked in the db
+    for item in remaining_files:
+        if item.is_on_disk:
+            item.sync_to_disk(db, verbose=True)
+    by_href = {item.href: item for item in remaining_files if not item.is_on_disk}
+    db.enqueue_downloads(by_href.keys())
+    queue = [by_href[href] for href in db.get_download_queue(MAX_ATTEMPTS) if href in by_href]
+    print(f"Download queue: {len(queue)} files, {workers} workers")
+
+    bandwidth = None
+    if bandwidth_limit:
+        # Allow a second worth of bytes as burst
+        bandwidth = TokenBucket(bandwidth_limit, capacity=bandwidth_limit)
+    limiter = HostRateLimiter(config.request_rate())
+    stop = threading.Event()
+
+    def download(item):
+        limiter.acquire(item.url)
+        return item.download(resume=True, bandwidth=bandwidth, stop=stop, verbose=True)
+
+    executor = ThreadPoolExecutor(workers)
+    futures = {executor.submit(download, item): item for item in queue}
     try:
-        for item in remaining_files:
+        for future in as_completed(futures):
+            item = futures[future]
             try:
-                item.sync_to_disk(db, verbose=True)
-            except KeyboardInterrupt as e:
-                return
-                print("Exiting")
+                future.result()
+            except DownloadStopped:
+                continue
             except Exception as e:
                 traceback.print_exc()
-                pass
-            time.sleep(config.scrape_delay)
+                db.update_download_status(item.href, "failed", failed=True)
+                continue
+            db.update_file_status(item.href, True)
+            db.update_download_status(item.href, "done")
     except KeyboardInterrupt as e:
-        print("Exiting")
-        return
+        print("Exiting, partial downloads will be resumed on the next sync")
+        stop.set()
+        for future in futures:
+            future.cancel()
+    finally:
+        executor.shutdown(wait=True)
 
 
 def fetch_status():
-    db = SkemmanDb()
+    db = SkemmanDb.shared()
     files_out = get_open_access_article_pdfs()
     local_files = [item for item in files_out if item.is_local]
     rem_files = [item for item in files_out if not item.is_local]
@@ -84,6 +126,22 @@ def main():
         required=False,
         help="Do a sync",
     )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        required=False,
+        default=None,
+        help="Number of concurrent downloads",
+    )
+    parser.add_argument(
+        "--bandwidth-limit",
+        dest="bandwidth_limit",
+        type=float,
+        required=False,
+        default=None,
+        help="Maximum total download speed in MB/s",
+    )
     parser.add_argument(
         "--dir",
         dest="dir",
@@ -97,7 +155,12 @@ def main():
     if args.status:
         fetch_status()
     elif args.sync:
-        download_files(download_dir=args.dir)
+        bandwidth_limit = args.bandwidth_limit * 10 ** 6 if args.bandwidth_limit else None
+        download_files(
+            workers=args.workers,
+            bandwidth_limit=bandwidth_limit,
+            download_dir=args.dir or None,
+        )
     else:
         print("No argument supplied, type -h for help.")
 
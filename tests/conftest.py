@@ -0,0 +1,42 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# The modules live at the top of the repo, not in a package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import config  # noqa: E402
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """ An empty data dir for the databases and caches of one test """
+    monkeypatch.setattr(config, "data_dir", tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def skemman_db(data_dir):
+    """ skemman.db with the saved document pages in tests/fixtures/skemman stored,
+        as the scraper stores them """
+    import skemman
+    from skemman_db import SkemmanDb
+
+    db = SkemmanDb()
+    for path in sorted((FIXTURES / "skemman").glob("document_*.html")):
+        doc = skemman.SkemmanDocument(f"/handle/fixture/{path.stem}", title=path.stem, accepted="2019-06-01")
+        doc.html = path.read_bytes()
+        doc.parse()
+        doc.store_all(db)
+    yield db
+    db.conn.close()
+
+
+@pytest.fixture
+def abstracts_db(data_dir):
+    """ An empty abstracts.db, skips where extract_abstracts cannot be imported """
+    extract_abstracts = pytest.importorskip("extract_abstracts")
+    return extract_abstracts.AbstractsDb()
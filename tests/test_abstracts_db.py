@@ -0,0 +1,17 @@
+""" AbstractsDb checkpoints, so abstract extraction and alignment do not redo documents """
+
+import pytest
+
+extract_abstracts = pytest.importorskip("extract_abstracts")
+
+
+def test_insert_extracted(abstracts_db):
+    statuses = abstracts_db.insert_extracted([
+        ("a.txt", ("An abstract.", "Ágrip.")),
+        ("b.txt", None),
+        # The same abstracts as a.txt, e.g. a thesis stored twice
+        ("c.txt", ("An abstract.", "Ágrip.")),
+    ])
+    assert statuses == [extract_abstracts.INSERTED, extract_abstracts.NO_ABSTRACT, extract_abstracts.DUPLICATE]
+    assert abstracts_db.get_paths() == {"a.txt"}
+    assert abstracts_db.get_extracted_paths() == {"a.txt", "b.txt", "c.txt"}
@@ -0,0 +1,75 @@
+""" Gale-Church sentence alignment of the abstracts, and where AbstractsDb keeps the pairs """
+
+import sqlite3
+
+import pytest
+
+import config
+
+align = pytest.importorskip("align")
+extract_abstracts = pytest.importorskip("extract_abstracts")
+
+ENG = ["This is short.", "This one is a good deal longer than the first.", "Tiny.", "Last one here."]
+ISL = ["Þetta er stutt.", "Þessi er talsvert lengri en sú fyrsta.", "Pínu.", "Og hér er sú síðasta."]
+
+
+def test_one_to_one():
+    alignment = align.align(ENG, ISL)
+    assert [(len(eng), len(isl)) for (eng, isl, _) in alignment] == [(1, 1)] * 4
+    pairs = align.align_pairs(ENG, ISL)
+    assert [(eng, isl) for (eng, isl, _) in pairs] == list(zip(ENG, ISL))
+    assert all(0 < score <= 1 for (_, _, score) in pairs)
+
+
+def test_one_to_two():
+    # The second english sentence is split in two in the icelandic one
+    isl = [ISL[0], "Þessi er talsvert lengri", "en sú fyrsta sem var stutt.", ISL[3]]
+    eng = ENG[:2] + ENG[3:]
+    assert [(len(e), len(i)) for (e, i, _) in align.align(eng, isl)] == [(1, 1), (1, 2), (1, 1)]
+
+
+def test_empty():
+    assert align.align([], []) == []
+    assert align.align_pairs(ENG[:1], []) == []
+
+
+def test_length_cost():
+    assert align.length_cost(0, 0) == 0.0
+    assert align.length_cost(100, 100) < align.length_cost(100, 150) < align.length_cost(100, 300)
+
+
+def test_aligned_without_pairs(abstracts_db):
+    inserted = abstracts_db.insert_aligned([
+        ("a.txt", [("One.", "Eitt.", 0.9), ("Two.", "Tvö.", 0.8)]),
+        # No sentence pairs, e.g. only one side could be split into sentences
+        ("b.txt", []),
+    ])
+    assert inserted == 2
+    assert abstracts_db.get_segmented_paths() == {"a.txt", "b.txt"}
+    # Aligning again replaces the pairs of a document
+    assert abstracts_db.insert_aligned([("a.txt", [("One.", "Eitt.", 0.9)])]) == 1
+    with abstracts_db.engine.begin() as conn:
+        assert conn.execute("SELECT path, num_pairs FROM aligned ORDER BY path").fetchall() == [
+            ("a.txt", 1),
+            ("b.txt", 0),
+        ]
+        assert conn.execute("SELECT COUNT(*) FROM segmented").fetchone()[0] == 1
+
+
+def test_migrate_legacy_segmented(data_dir):
+    # segmented as it was before align.py, one row per document
+    conn = sqlite3.connect(config.db_dir() / "abstracts.db")
+    with conn:
+        conn.execute("CREATE TABLE segmented (path TEXT PRIMARY KEY, eng TEXT, isl TEXT)")
+        conn.execute("INSERT INTO segmented VALUES ('a.txt', 'One. Two.', 'Eitt. Tvö.')")
+    conn.close()
+
+    db = extract_abstracts.AbstractsDb()
+    with db.engine.begin() as conn:
+        assert conn.execute("SELECT path FROM segmented_legacy").fetchall() == [("a.txt",)]
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(segmented)")]
+    assert "pair_index" in columns
+    assert db.get_segmented_paths() == set()
+    # Opening it again leaves the tables as they are
+    extract_abstracts.AbstractsDb()
+    assert db.get_segmented_paths() == set()
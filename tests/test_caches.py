@@ -0,0 +1,47 @@
+""" Size bounded eviction of HttpCache and RuleCache, least recently used first """
+
+import time
+
+from http_cache import HttpCache
+from rule_cache import RuleCache
+
+
+def test_http_cache_eviction(tmp_path):
+    cache = HttpCache(cache_dir=tmp_path, max_bytes=250)
+    cache.store("https://a", b"a" * 100)
+    # Same body as a, stored once
+    cache.store("https://a2", b"a" * 100)
+    cache.store("https://b", b"b" * 100)
+    assert cache._total_bytes == 200
+    cache.read(cache.lookup("https://a"))
+    cache.store("https://c", b"c" * 100)
+    # a2 and then b are the least recently used, a2 shares its body with a so only b frees space
+    assert [url for url in ("https://a", "https://a2", "https://b", "https://c") if cache.lookup(url)] == [
+        "https://a",
+        "https://c",
+    ]
+    assert cache._total_bytes == 200
+    assert sorted(path.name for path in tmp_path.glob("*/*")) == sorted(
+        cache.lookup(url).digest for url in ("https://a", "https://c")
+    )
+
+
+def test_rule_cache_eviction(tmp_path):
+    cache = RuleCache(cache_dir=tmp_path, max_bytes=10 ** 6)
+    for i in range(10):
+        cache.put(f"key {i}".encode(), "x" * 100)
+    cache.flush()
+    time.sleep(0.01)
+    # Read, but fewer than FLUSH_SIZE reads, so only the final flush writes their last use
+    assert cache.get_many([b"key 0", b"key 1"]) == {b"key 0": "x" * 100, b"key 1": "x" * 100}
+    cache.close()
+
+    # Room for three results after eviction
+    cache = RuleCache(cache_dir=tmp_path, max_bytes=400)
+    cache.put(b"new", "y" * 100)
+    cache.flush()
+    kept = sorted(key for (key,) in cache.conn.execute("SELECT key FROM results"))
+    assert kept == [b"key 0", b"key 1", b"new"]
+    total = cache.conn.execute("SELECT total_bytes FROM meta").fetchone()[0]
+    assert total == cache.conn.execute("SELECT SUM(size) FROM results").fetchone()[0] <= 400 * 0.9
+    cache.close()
@@ -0,0 +1,29 @@
+""" Document labels written back to skemman.db """
+
+import pytest
+
+from skemman import Skemman
+
+language_id = pytest.importorskip("language_id")
+segment_skemman = pytest.importorskip("segment_skemman")
+
+
+def test_update_skemman_languages(skemman_db):
+    seg_db = segment_skemman.SegmentDb()
+    labelled = Skemman.make_url("/bitstream/1946/33512/1/AnnaJonsdottir_MSritgerd.pdf")
+    empty = Skemman.make_url("/bitstream/1946/38811/1/BS_Jon_Petursson.pdf")
+    seg_db.insert_segments([], labelled)
+    labelled_id = seg_db.get_max_docid()
+    seg_db.insert_segments([], empty)
+    empty_id = seg_db.get_max_docid()
+    # The second document has no segments, it only has the placeholder label from predict_all
+    seg_db.insert_languages("test", [], [(labelled_id, "is", 0.9, 10), (empty_id, None, 0.0, 0)])
+    skemman_db.update_file_language("/bitstream/1946/38811/1/BS_Jon_Petursson.pdf", "english")
+
+    language_id.update_skemman_languages(seg_db, "test")
+
+    languages = dict(skemman_db.conn.execute("SELECT fname, language FROM skemman_files"))
+    assert languages["AnnaJonsdottir_MSritgerd.pdf"] == "icelandic"
+    assert languages["BS_Jon_Petursson.pdf"] == "english"
+    # Closed files are not looked up
+    assert languages["yfirlysing.pdf"] is None
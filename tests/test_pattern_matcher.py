@@ -0,0 +1,111 @@
+""" The single scan PatternMatcher must find the same abstract start and end lines as the
+    per line substring loops that PdfBoxOutput used before it. """
+
+import random
+
+import pytest
+
+from pattern_matcher import PatternMatcher
+
+
+def test_scan_lines_and_pages():
+    matcher = PatternMatcher(
+        [("Abstract", "eng", False), ("Ágrip", "isl", False), ("keywords", "end", True), ("key", "end", True)]
+    )
+    text = "Efni\nÁgrip\nbla\x0cAbstract ABSTRACT\nKeywords: x\n"
+    assert [(h.label, h.pattern, h.line, h.page) for h in matcher.scan(text)] == [
+        ("isl", "Ágrip", 1, 0),
+        ("eng", "Abstract", 2, 1),
+        # keywords and its prefix key both match at the same offset
+        ("end", "keywords", 3, 1),
+        ("end", "key", 3, 1),
+    ]
+
+
+def test_scan_overlapping():
+    matcher = PatternMatcher([("aa", "a", True), ("ab", "b", False)])
+    assert [(h.pattern, h.offset) for h in matcher.scan("aaab AB")] == [("aa", 0), ("aa", 1), ("ab", 2)]
+
+
+# The rest needs the abstract patterns, which live in extract_abstracts
+
+
+def old_starts(lines, patterns):
+    """ PdfBoxOutput.find_abstracts_starts before the matcher: case sensitive,
+        lines with ..... are the table of contents """
+    idxs = []
+    for line_idx, line in enumerate(lines):
+        for substring in patterns:
+            if substring in line and "....." not in line:
+                idxs.append(line_idx)
+    return idxs
+
+
+def old_line_has_pat(line, pats):
+    return any(substring.lower() in line.lower() for substring in pats)
+
+
+def old_end(lines, start, end_pats, max_abstract_len=100, max_num_empty=2):
+    """ PdfBoxOutput.find_abstract_end_isl/_eng before the matcher, with the end bound
+        fixed to the number of lines """
+    num_empty = 0
+    end = min(start + max_abstract_len, len(lines))
+    for line_idx, line in enumerate(lines[start + 1: end], start + 1):
+        num_empty = num_empty + 1 if line.strip() == "" else 0
+        if num_empty >= max_num_empty or old_line_has_pat(line, end_pats):
+            return line_idx
+    return end
+
+
+def check_parity(ea, text):
+    output = ea.PdfBoxOutput(text)
+    lines = output.lines
+    eng, isl = old_starts(lines, ea.ENG_START_PATS), old_starts(lines, ea.ISL_START_PATS)
+    starts = output.find_abstracts_starts()
+    if not eng or not isl:
+        assert starts is None
+        return
+    # The old loop listed a line once per pattern on it
+    assert starts == (sorted(set(eng)), sorted(set(isl)))
+    assert output.find_abstract_end_eng() == old_end(lines, eng[0], ea.ENG_END_PATS)
+    assert output.find_abstract_end_isl() == old_end(lines, isl[0], ea.ISL_END_PATS)
+
+
+THESIS = """Háskóli Íslands, an abstract title page
+\x0cEfnisyfirlit
+Ágrip ........................ 3
+Abstract ..................... 4
+\x0cÁgrip
+Í þessari ritgerð er fjallað um fiskistofna.
+Niðurstöður benda til breytinga.
+LYKILORÐ: fiskur, loftslag
+\x0cABSTRACT
+This thesis is about fish stocks.
+the results point to changes
+KEY WORDS: fish, climate
+Formáli
+"""
+
+
+def test_abstract_lines():
+    ea = pytest.importorskip("extract_abstracts")
+    output = ea.PdfBoxOutput(THESIS)
+    # The table of contents lines are left out, "abstract" in lower case does not start one
+    assert output.find_abstracts_starts() == ([8], [4])
+    assert output.find_abstract_end_isl() == 7
+    # At Formáli, ENG_END_PATS are the start and icelandic end patterns
+    assert output.find_abstract_end_eng() == 12
+    check_parity(ea, THESIS)
+
+
+def test_abstract_lines_parity():
+    ea = pytest.importorskip("extract_abstracts")
+    words = (
+        list(ea.ENG_START_PATS + ea.ISL_START_PATS + ea.ISL_END_KWORDS + ea.ENG_END_KWORDS)
+        + ["abstract", "ágrip", "KEYWORDS", "key Words", "lykilorð", "....", "Abstrakt.....", "texti", "text", ""]
+    )
+    rng = random.Random(1234)
+    for _ in range(300):
+        lines = [" ".join(rng.choice(words) for _ in range(rng.randint(0, 3))) for _ in range(rng.randint(0, 40))]
+        text = "\n".join(line if rng.random() > 0.1 else "\x0c" + line for line in lines)
+        check_parity(ea, text)
@@ -0,0 +1,79 @@
+""" skemman.db queries on the saved document pages """
+
+import sqlite3
+
+import pytest
+
+from skemman import Skemman, SkemmanDocument
+
+
+def test_file_metadata_skips_closed_files(skemman_db):
+    rows = skemman_db.get_file_metadata()
+    fnames = {fname for (fname,) in skemman_db.conn.execute("SELECT fname FROM skemman_files WHERE href IS NULL")}
+    # yfirlysing.pdf and Yfirlysing_JP.pdf are closed and have no href
+    assert fnames == {"yfirlysing.pdf", "Yfirlysing_JP.pdf"}
+    assert rows and all(file_href is not None for (file_href, *_) in rows)
+    assert len(rows) == skemman_db.conn.execute("SELECT COUNT(*) FROM skemman_files").fetchone()[0] - 2
+    # As export_corpus and language_id key them
+    assert all(Skemman.make_url(file_href) for (file_href, *_) in rows)
+
+
+def test_export_metadata_with_closed_files(skemman_db):
+    export_corpus = pytest.importorskip("export_corpus")
+    metadata = export_corpus.get_skemman_metadata()
+    assert Skemman.make_url("/bitstream/1946/33512/1/AnnaJonsdottir_MSritgerd.pdf") in metadata
+    assert len(metadata) == 3
+
+
+def _metadata(db, href):
+    return db.conn.execute(
+        """SELECT m.language, m.degree, m.year, m.taxonomy FROM skemman_metadata AS m
+        INNER JOIN skemman_documents AS d ON d.id = m.document_id WHERE d.href = ?""",
+        (href,),
+    ).fetchone()
+
+
+def test_metadata_row(skemman_db):
+    (language, degree, year, taxonomy) = _metadata(skemman_db, "/handle/fixture/document_msc")
+    assert (language, degree, year) == ("íslenska", "meistara", 2019)
+    assert "Meistaraprófsritgerðir - Líffræði" in taxonomy
+    assert _metadata(skemman_db, "/handle/fixture/document_bsc_en")[:3] == ("english", "bachelor's", 2021)
+    msc_id = skemman_db.get_document_id_by_href("/handle/fixture/document_msc")
+    assert skemman_db.get_document_ids(language="íslenska") == [msc_id]
+    assert skemman_db.get_document_ids(degree="meistara", year=2019) == [msc_id]
+
+
+def test_metadata_migration(skemman_db):
+    from skemman_db import SkemmanDb
+
+    # A version 2 database, filled while the labels were looked up without their colon
+    with skemman_db.conn as c:
+        c.execute("UPDATE skemman_metadata SET language = NULL, degree = NULL")
+        c.execute("PRAGMA user_version = 2")
+    skemman_db.conn.close()
+    db = SkemmanDb()
+    assert _metadata(db, "/handle/fixture/document_msc")[:3] == ("íslenska", "meistara", 2019)
+    assert db.conn.execute("PRAGMA user_version").fetchone()[0] == SkemmanDb._SCHEMA_VERSION
+    db.conn.close()
+
+
+def test_write_errors(skemman_db, capsys):
+    doc = SkemmanDocument("/handle/fixture/document_msc", title="again")
+    # Outside a transaction a failed write is printed and skipped
+    assert skemman_db.insert_document(doc) is None
+    assert "Could not insert document /handle/fixture/document_msc" in capsys.readouterr().out
+    # Inside one it raises, and only the failed nested block is rolled back
+    with skemman_db.transaction():
+        skemman_db.insert_page(1)
+        with pytest.raises(sqlite3.IntegrityError):
+            with skemman_db.transaction():
+                skemman_db.insert_page(2)
+                skemman_db.insert_document(doc)
+    assert skemman_db.get_pages() == {1}
+
+
+def test_file_classes(skemman_db):
+    rows = skemman_db.conn.execute("SELECT fname, size_bytes, is_main_pdf, class_reason FROM skemman_files")
+    classes = {fname: (size_bytes, bool(is_main), reason) for (fname, size_bytes, is_main, reason) in rows}
+    assert classes["AnnaJonsdottir_MSritgerd.pdf"] == (3410000, True, "main")
+    assert classes["Yfirlysing_JP.pdf"] == (95300, False, "closed")
@@ -0,0 +1,104 @@
+""" Targeted parsing of Skemman pages must give the same metadata and hrefs as parsing
+    the whole page with html.parser, which is how pages were parsed before. """
+
+from pathlib import Path
+
+import pytest
+from bs4 import BeautifulSoup as bs
+
+import skemman
+from file_classifier import size_to_bytes
+
+FIXTURES = Path(__file__).parent / "fixtures" / "skemman"
+DOCUMENT_PAGES = sorted(FIXTURES.glob("document_*.html"))
+RESULTS_PAGES = sorted(FIXTURES.glob("results_*.html"))
+PARSERS = sorted(set(["html.parser", skemman.DEFAULT_HTML_PARSER]))
+
+
+def parse_results_page_unstrained(html):
+    """ Results page parsing as it was before targeted parsing: the whole page with
+        html.parser, looking through every table for the results caption """
+    soup = bs(html, "html.parser")
+    results = []
+    for table in soup.find_all("table"):
+        caption = table.find("caption")
+        if not caption or caption.text != skemman.RESULTS_CAPTION:
+            continue
+        for row in table.find_all("tr"):
+            data = []
+            for col in row.find_all("td"):
+                data.append(col)
+            if not data:
+                # skip header
+                continue
+            date_accepted, title, author = data
+            href = title.find("a").attrs["href"]
+            results.append(
+                skemman.SkemmanDocument(href, title=title.text, author=author.text, accepted=date_accepted.text)
+            )
+    return results
+
+
+def document_summary(html, parser=None, strain=True):
+    """ Attributes and file list of a document page, or the parse error """
+    doc = skemman.SkemmanDocument("fixture", title="fixture")
+    doc.html = html
+    try:
+        doc.parse(parser=parser, strain=strain)
+    except AttributeError as e:
+        return repr(e)
+    files = [(f.fname, f.href, f.size, f.access, f.descr, f.ftype) for f in doc.filelist]
+    return doc.attrs, files
+
+
+def results_summary(html, parser=None, strain=True):
+    """ (href, title, author, accepted) of each result on a results page """
+    if strain:
+        docs = skemman.Skemman.parse_results_page(html, parser=parser)
+    else:
+        docs = parse_results_page_unstrained(html)
+    return [(doc.href, doc.title, doc.author, doc.accepted) for doc in docs]
+
+
+@pytest.mark.parametrize("parser", PARSERS)
+@pytest.mark.parametrize("path", DOCUMENT_PAGES, ids=lambda path: path.name)
+def test_document_page_parity(path, parser):
+    html = path.read_bytes()
+    expected = document_summary(html, "html.parser", strain=False)
+    assert not isinstance(expected, str), expected
+    assert document_summary(html, parser) == expected
+
+
+@pytest.mark.parametrize("parser", PARSERS)
+@pytest.mark.parametrize("path", RESULTS_PAGES, ids=lambda path: path.name)
+def test_results_page_parity(path, parser):
+    html = path.read_bytes()
+    expected = results_summary(html, "html.parser", strain=False)
+    assert results_summary(html, parser) == expected
+
+
+def test_document_page_metadata():
+    attrs, files = document_summary((FIXTURES / "document_msc.html").read_bytes())
+    assert attrs["Tungumál:"] == "Íslenska"
+    assert attrs["taxonomy"] == (
+        '["Háskóli Íslands", "Verkfræði- og náttúruvísindasvið", "Meistaraprófsritgerðir - Líffræði"]'
+    )
+    assert [(fname, href) for (fname, href, *_) in files] == [
+        ("AnnaJonsdottir_MSritgerd.pdf", "/bitstream/1946/33512/1/AnnaJonsdottir_MSritgerd.pdf"),
+        ("yfirlysing.pdf", None),
+    ]
+
+
+def test_results_page_hrefs():
+    results = results_summary((FIXTURES / "results_page_1.html").read_bytes())
+    assert [href for (href, *_) in results] == ["/handle/1946/33512", "/handle/1946/38811", "/handle/1946/10771"]
+    assert results_summary((FIXTURES / "results_page_empty.html").read_bytes()) == []
+
+
+def test_file_sizes():
+    attrs, files = document_summary((FIXTURES / "document_bsc_en.html").read_bytes())
+    # As the site shows them, with a decimal comma
+    assert [size for (_, _, size, *_) in files] == ["1,02 MB", "48,5 kB", "95,3 kB"]
+    assert [size_to_bytes(size) for (_, _, size, *_) in files] == pytest.approx([1.02e6, 48.5e3, 95.3e3])
+    assert size_to_bytes("214 kB") == 214e3
+    assert size_to_bytes("3.41 MB") == 3.41e6
@@ -0,0 +1,68 @@
+""" Pages and lines of TextDocument must be those of splitting the whole text """
+
+import pytest
+
+from text_document import FORM_FEED, TextDocument
+
+TEXTS = ["a\nb\x0cc\nd\n\x0ce", "", "x\x0c", "\x0c\x0c\n", "þ\nó\x0cð"]
+
+
+@pytest.fixture(params=["str", "bytes", "file"])
+def open_doc(request, tmp_path):
+    """ TextDocument of a text, as given, as utf-8 bytes or memory mapped from a file """
+    docs = []
+
+    def open_doc(text):
+        if request.param == "str":
+            doc = TextDocument(text)
+        elif request.param == "bytes":
+            doc = TextDocument(text.encode())
+        else:
+            path = tmp_path / "text.txt"
+            path.write_bytes(text.encode())
+            doc = TextDocument.open(path)
+        docs.append(doc)
+        return doc
+
+    yield open_doc
+    for doc in docs:
+        doc.close()
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_pages_and_lines(open_doc, text):
+    doc = open_doc(text)
+    assert list(doc.pages()) == text.split(FORM_FEED)
+    assert doc.num_pages == len(text.split(FORM_FEED))
+    assert doc.lines() == text.split("\n")
+    assert doc.lines(1, 3) == text.split("\n")[1:3]
+    assert doc.num_lines == len(text.split("\n"))
+    for n in range(4):
+        assert doc.head(n) == FORM_FEED.join(text.split(FORM_FEED)[:n])
+
+
+def test_page(open_doc):
+    doc = open_doc("a\nb\x0cc\nd\n\x0ce")
+    assert doc.page(1) == "c\nd\n"
+    assert doc.page(-1) == "e"
+    assert doc.page_span(1) == (4, 8)
+    with pytest.raises(IndexError):
+        doc.page(3)
+
+
+def test_head_reads_only_the_pages_asked_for():
+    doc = TextDocument("one\x0ctwo\x0cthree\x0cfour")
+    assert doc.head(2) == "one\x0ctwo"
+    # The page index stops after the start of the page following the head
+    assert doc._page_starts == [0, 4, 8]
+
+
+def test_document_close(tmp_path):
+    ea = pytest.importorskip("extract_abstracts")
+    path = tmp_path / "thesis.txt"
+    path.write_text("Ágrip\nbla\x0cAbstract\nbla", encoding="utf-8")
+    with ea.Document(path) as doc:
+        assert doc.find_abstracts() == ([1], [0])
+        text = doc.text
+    assert text.buffer.closed and text._fp is None
+    assert doc._text is None
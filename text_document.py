@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""
+Page and line access to pdfbox text output without splitting the whole text.
+
+Pages are separated by form feeds, page n starts after the n-th form feed and line n
+after the n-th newline (as in pattern_matcher). Text files are memory mapped, the page
+index is built up only as far as the pages that are asked for and the line index on
+the first line lookup, so looking at the first pages of a thesis never reads the rest.
+"""
+
+import mmap
+import re
+
+FORM_FEED = "\x0c"
+
+
+class TextDocument:
+    def __init__(self, buffer):
+        """ buffer is a str, or utf-8 bytes such as an mmap, see TextDocument.open """
+        self.buffer = buffer
+        self._is_text = isinstance(buffer, str)
+        self._form_feed = FORM_FEED if self._is_text else FORM_FEED.encode()
+        self._newline = "\n" if self._is_text else b"\n"
+        # Start offsets of the pages indexed so far
+        self._page_starts = [0]
+        self._pages_done = False
+        self._line_starts = None
+        self._fp = None
+
+    @classmethod
+    def open(cls, path):
+        fp = open(path, "rb")
+        try:
+            buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            buffer = b""
+        doc = cls(buffer)
+        doc._fp = fp
+        return doc
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def _decode(self, start, end):
+        if self._is_text:
+            return self.buffer[start:end]
+        # Form feeds and newlines are single bytes in utf-8, so these never split a character
+        return str(memoryview(self.buffer)[start:end], "utf-8", errors="replace")
+
+    def _index_pages(self, num_pages):
+        """ Find page starts until num_pages are known or the text ends """
+        while not self._pages_done and len(self._page_starts) < num_pages:
+            idx = self.buffer.find(self._form_feed, self._page_starts[-1])
+            if idx == -1:
+                self._pages_done = True
+            else:
+                self._page_starts.append(idx + 1)
+
+    @property
+    def num_pages(self):
+        self._index_pages(len(self.buffer) + 1)
+        return len(self._page_starts)
+
+    def page_span(self, page_idx):
+        """ (start, end) offsets of page page_idx, without its form feeds """
+        if page_idx < 0:
+            page_idx += self.num_pages
+        self._index_pages(page_idx + 2)
+        if page_idx < 0 or page_idx >= len(self._page_starts):
+            raise IndexError(f"page {page_idx} out of range")
+        start = self._page_starts[page_idx]
+        end = self._page_starts[page_idx + 1] - 1 if page_idx + 1 < len(self._page_starts) else len(self.buffer)
+        return start, end
+
+    def page(self, page_idx):
+        return self._decode(*self.page_span(page_idx))
+
+    def pages(self):
+        page_idx = 0
+        while True:
+            self._index_pages(page_idx + 1)
+            if page_idx >= len(self._page_starts):
+                return
+            yield self.page(page_idx)
+            page_idx += 1
+
+    def head(self, num_pages):
+        """ Text of the first num_pages pages, with the form feeds between them, so offsets,
+            lines and pages in it are the same as in the whole text """
+        if num_pages <= 0:
+            return self._decode(0, 0)
+        self._index_pages(num_pages + 1)
+        if num_pages < len(self._page_starts):
+            return self._decode(0, self._page_starts[num_pages] - 1)
+        return self._decode(0, len(self.buffer))
+
+    def _index_lines(self):
+        if self._line_starts is None:
+            newline = re.escape(self._newline)
+            self._line_starts = [0] + [m.end() for m in re.finditer(newline, self.buffer)]
+
+    @property
+    def num_lines(self):
+        self._index_lines()
+        return len(self._line_starts)
+
+    def lines(self, start=0, stop=None):
+        """ Lines start up to stop, without newlines """
+        self._index_lines()
+        num_lines = len(self._line_starts)
+        stop = num_lines if stop is None else min(stop, num_lines)
+        if start >= stop:
+            return []
+        end = self._line_starts[stop] - 1 if stop < num_lines else len(self.buffer)
+        return self._decode(self._line_starts[start], end).split("\n")
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+Extracted text of pdf files, gzip compressed and stored by the sha256 of the pdf,
+so each pdf only goes through pdfbox once no matter which pipeline asks for its text
+(segmentation, abstract mining, hirslan) or where the file lives.
+"""
+
+import gzip
+import hashlib
+import os
+import uuid
+from pathlib import Path
+
+import config
+
+
+class TextStore:
+
+    # One instance per process and store dir, see TextStore.shared
+    _shared = {}
+
+    def __init__(self, store_dir=None):
+        self.store_dir = Path(store_dir) if store_dir is not None else config.text_store_dir()
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def shared(cls):
+        """ The store in the current data dir """
+        key = (os.getpid(), str(config.text_store_dir()))
+        store = cls._shared.get(key)
+        if store is None:
+            store = cls()
+            cls._shared[key] = store
+        return store
+
+    @staticmethod
+    def digest(pdf_path):
+        h = hashlib.sha256()
+        with open(pdf_path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(2 ** 20), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _text_path(self, digest):
+        return self.store_dir / digest[:2] / f"{digest}.txt.gz"
+
+    def get(self, digest):
+        """ Stored text or None """
+        try:
+            with open(self._text_path(digest), "rb") as fh:
+                return gzip.decompress(fh.read()).decode("utf-8")
+        except FileNotFoundError:
+            return None
+
+    def put(self, digest, text):
+        path = self._text_path(digest)
+        os.makedirs(path.parent, exist_ok=True)
+        tmp_path = path.with_name(f"{digest}.{uuid.uuid4()}.tmp")
+        with open(tmp_path, "wb") as fh:
+            fh.write(gzip.compress(text.encode("utf-8"), compresslevel=6))
+        os.replace(tmp_path, path)
+
+    def get_or_extract(self, pdf_path, extract):
+        """ Text of pdf_path, extract(pdf_path) -> text or None is only called the first
+            time a pdf with this content is seen. Failed extractions are not stored. """
+        digest = self.digest(pdf_path)
+        text = self.get(digest)
+        if text is not None:
+            self.hits += 1
+            return text
+        self.misses += 1
+        text = extract(pdf_path)
+        if text is not None:
+            self.put(digest, text)
+        return text
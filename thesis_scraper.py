@@ -1,55 +1,202 @@
-
+import asyncio
+import sqlite3
 import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from skemman_db import SkemmanDb
 from skemman import Skemman
+from fetcher import Fetcher
+from http_cache import CacheMiss
+from rate_limit import HostRateLimiter
 import config
 import utils
 
 MAX_PAGE_IDX = 1441 # TODO: Get rid of this
 
+# How many results pages may be in progress at the same time in async mode
+MAX_PAGES_AHEAD = 2
+
+
+def scrape_skemman(max_documents: int, concurrency: int = 1, reparse: bool = False):
+    """ reparse: parse every results and document page again, also those already in the db,
+        and overwrite what was stored from them. Meant for the offline http cache, to pick
+        up parser changes without touching the network. """
+    if reparse:
+        remaining_count = max_documents if max_documents > 0 else float("inf")
+        print("documents to re-parse:", remaining_count)
+    else:
+        current_documents = utils.get_open_access_article_pdfs()
 
-def scrape_skemman(max_documents: int):
-    current_documents = utils.get_open_access_article_pdfs()
+        remaining_count = max_documents - len(current_documents)
+        if max_documents < 0:
+            # fetch all found documents
+            remaining_count = float("inf")
+        print("remaining documents to scrape:", remaining_count)
+        if remaining_count <= 0 and max_documents > 0:
+            print("already know enough docs")
+            return
 
-    remaining_count = max_documents - len(current_documents)
-    print("remaining documents to scrape:", remaining_count)
-    if remaining_count <= 0 and max_documents > 0:
-        print("already know enough docs")
+    if concurrency > 1:
+        asyncio.run(_scrape_skemman_async(remaining_count, concurrency, reparse))
         return
 
-    db = SkemmanDb()
-    finished_pages = db.get_pages()
-    finished_hrefs = db.get_hrefs()
+    db = SkemmanDb.shared()
+    finished_pages = db.get_pages() if not reparse else set()
+    finished_hrefs = db.get_hrefs() if not reparse else set()
 
     docs = []
     for page_idx in range(1, MAX_PAGE_IDX):
         if page_idx in finished_pages:
             continue
-        docs = Skemman.get_results_from_page_idx(page_idx)
+        try:
+            docs = Skemman.get_results_from_page_idx(page_idx)
+        except CacheMiss:
+            print(f"Results page {page_idx} not in cache")
+            continue
         for doc in docs:
-            if doc.href not in finished_hrefs:
+            if doc.href in finished_hrefs:
+                continue
+            finished_hrefs.add(doc.href)
+            requests_made = Fetcher.requests_made
+            try:
+                doc.fetch()
+                doc.parse()
+                # One commit per document instead of one per insert
+                with db.transaction():
+                    doc.store_all(db, replace=reparse)
+
+                # TODO: Not accurate due to some documents not
+                # being open access. Good enough for testing though.
+                remaining_count -= 1
+                if remaining_count <= 0:
+                    break
+            except AttributeError as e:
+                print(f"Could not parse {doc.href}")
                 doc.get_id_or_store_document(db)
-                finished_hrefs.add(doc.href)
-                try:
-                    doc.fetch()
-                    doc.parse()
-                    doc.store_all(db)
+            except CacheMiss:
+                print(f"Not in cache {doc.href}")
+                doc.get_id_or_store_document(db)
+            except sqlite3.Error:
+                # The transaction is rolled back, nothing of the document is stored
+                print(f"Could not store {doc.href}")
+            finally:
+                # Only wait between requests that reached the server
+                if Fetcher.requests_made > requests_made:
+                    time.sleep(config.scrape_delay)
 
-                    # TODO: Not accurate due to some documents not
-                    # being open access. Good enough for testing though.
-                    remaining_count -= 1
-                    if remaining_count <= 0:
-                        break
-                except AttributeError as e:
-                    print(f"Could not parse {doc.href}")
-
-            time.sleep(config.scrape_delay)
-                    
         if remaining_count <= 0:
             break
         db.insert_page(page_idx)
 
 
+def _parse_document(doc):
+    """ Runs in a worker process, keeps html parsing off the event loop """
+    doc.parse()
+    doc.html = None
+    return doc
+
+
+async def _scrape_skemman_async(remaining_count: int, concurrency: int, reparse: bool = False):
+    """ Keep up to `concurrency` document pages in flight, rate limited per host.
+        Parsing happens in a process pool and a single writer task does all db writes. """
+    loop = asyncio.get_event_loop()
+    db = SkemmanDb.shared()
+    finished_pages = db.get_pages() if not reparse else set()
+    finished_hrefs = db.get_hrefs() if not reparse else set()
+
+    limiter = HostRateLimiter(config.request_rate(), capacity=concurrency)
+    fetch_pool = ThreadPoolExecutor(concurrency)
+    parse_pool = ProcessPoolExecutor()
+    in_flight = asyncio.Semaphore(concurrency)
+    write_queue = asyncio.Queue()
+    state = {"remaining": remaining_count}
+
+    async def fetch(url):
+        # Reads from the offline cache need no rate limit
+        if not Fetcher.is_offline():
+            await limiter.acquire_async(url)
+        return await loop.run_in_executor(fetch_pool, Fetcher.fetch_with_retry, url)
+
+    async def scrape_document(doc):
+        async with in_flight:
+            try:
+                doc.html = await fetch(doc.url)
+                doc = await loop.run_in_executor(parse_pool, _parse_document, doc)
+                await write_queue.put(("document", doc, True))
+            except AttributeError:
+                print(f"Could not parse {doc.href}")
+                await write_queue.put(("document", doc, False))
+            except Exception:
+                traceback.print_exc()
+                print(f"Could not fetch {doc.href}")
+                await write_queue.put(("document", doc, False))
+
+    async def scrape_page(page_idx, docs):
+        await asyncio.gather(*(scrape_document(doc) for doc in docs))
+        await write_queue.put(("page", page_idx, None))
+
+    writer = asyncio.ensure_future(_write_results(write_queue, db, state, reparse))
+    pending_pages = set()
+    try:
+        for page_idx in range(1, MAX_PAGE_IDX):
+            if state["remaining"] <= 0:
+                break
+            if page_idx in finished_pages:
+                continue
+            while len(pending_pages) >= MAX_PAGES_AHEAD:
+                _done, pending_pages = await asyncio.wait(
+                    pending_pages, return_when=asyncio.FIRST_COMPLETED
+                )
+            try:
+                html = await fetch(Skemman.get_page_url(page_idx))
+            except CacheMiss:
+                print(f"Results page {page_idx} not in cache")
+                continue
+            docs = await loop.run_in_executor(parse_pool, Skemman.parse_results_page, html)
+            docs = [doc for doc in docs if doc.href not in finished_hrefs]
+            finished_hrefs.update(doc.href for doc in docs)
+            pending_pages.add(asyncio.ensure_future(scrape_page(page_idx, docs)))
+        if pending_pages:
+            await asyncio.wait(pending_pages)
+    finally:
+        await write_queue.put(None)
+        await writer
+        fetch_pool.shutdown()
+        parse_pool.shutdown()
+
+
+async def _write_results(write_queue, db, state, reparse=False):
+    """ The only coroutine touching the db, commits whatever is queued in one transaction """
+    while True:
+        items = [await write_queue.get()]
+        while not write_queue.empty():
+            items.append(write_queue.get_nowait())
+        with db.transaction():
+            for item in items:
+                if item is None:
+                    continue
+                kind, payload, parsed = item
+                if kind == "page":
+                    db.insert_page(payload)
+                    continue
+                doc = payload
+                try:
+                    # A savepoint, a failed document is rolled back without the rest of the batch
+                    with db.transaction():
+                        doc.get_id_or_store_document(db)
+                        if parsed:
+                            doc.store_all(db, replace=reparse)
+                except sqlite3.Error:
+                    print(f"Could not store {doc.href}")
+                    continue
+                if parsed:
+                    # TODO: Not accurate due to some documents not
+                    # being open access. Good enough for testing though.
+                    state["remaining"] -= 1
+        if None in items:
+            return
+
+
 if __name__ == "__main__":
     scrape_skemman(10)
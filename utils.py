@@ -1,8 +1,10 @@
 from pprint import pprint
 from collections import namedtuple
+import glob
 import os
+import queue
 from pathlib import Path
-import re
+import time
 
 try:
     from icecream import ic
@@ -11,6 +13,15 @@ try:
 except ImportError:  # Graceful fallback if IceCream isn't installed.
     ic = lambda *a: None if not a else (a[0] if len(a) == 1 else a)  # noqa
 
+from file_classifier import (
+    B_IN_MB,
+    MAX_SIZE_IN_MB,
+    MAIN,
+    NO_DESCR,
+    UNFILTERED,
+    size_to_bytes,
+    classify_file,
+)
 from skemman import SkemmanFile
 from skemman_db import SkemmanDb
 
@@ -42,21 +53,73 @@ _SUBS = {
 }
 SUBS = tuple(_SUBS.items())
 
-B_IN_KB = 10 ** 3
-B_IN_MB = 10 ** 6
-B_IN_GB = 10 ** 9
 
-UNITS = {" B": 1, "kB": B_IN_KB, "MB": B_IN_MB, "GB": B_IN_GB}
-UNIT_NAMES = list(UNITS.keys())
+def size_to_mb(size_str):
+    size_in_b = size_to_bytes(size_str)
+    return round(size_in_b / B_IN_MB, 3)
+
 
-MAX_SIZE_IN_MB = 75
+def cpu_temperature():
+    """ Highest temperature reported by the kernel thermal zones, in celsius """
+    temps = []
+    for path in glob.glob("/sys/class/thermal/thermal_zone*/temp"):
+        try:
+            with open(path) as fh:
+                temps.append(int(fh.read().strip()) / 1000)
+        except (OSError, ValueError):
+            continue
+    return max(temps) if temps else None
 
 
-def size_to_mb(size_str):
-    unit = list(filter(lambda key: key in size_str, UNIT_NAMES)).pop()
-    factor = UNITS[unit]
-    size_in_b = float(size_str.replace(unit, "").strip()) * factor
-    return round(size_in_b / B_IN_MB, 3)
+def wait_for_cool_down(max_load=None, max_temp=None, poll_interval=5.0, verbose=True):
+    """ Block while the load average or cpu temperature is above the given limits.
+        Limits default to config.max_load and config.max_cpu_temp. """
+    max_load = config.max_load if max_load is None else max_load
+    max_temp = config.max_cpu_temp if max_temp is None else max_temp
+    waited = False
+    while True:
+        load = os.getloadavg()[0] if max_load is not None else None
+        temp = cpu_temperature() if max_temp is not None else None
+        too_busy = load is not None and load > max_load
+        too_hot = temp is not None and temp > max_temp
+        if not too_busy and not too_hot:
+            return waited
+        if verbose and not waited:
+            print(f"Throttling (load {load}, temperature {temp})", flush=True)
+        waited = True
+        time.sleep(poll_interval)
+
+
+def imap_bounded(pool, func, iterable, max_pending):
+    """ Like pool.imap_unordered, but reads at most max_pending items of iterable ahead, so
+        a lazy iterable is not pulled into memory. A new item is sent to the pool as soon as
+        any result comes back, so workers do not wait for the slowest item of a group. """
+    results = queue.Queue()
+    items = iter(iterable)
+    pending = 0
+
+    def submit():
+        nonlocal pending
+        for item in items:
+            pool.apply_async(
+                func,
+                (item,),
+                callback=lambda result: results.put((True, result)),
+                error_callback=lambda error: results.put((False, error)),
+            )
+            pending += 1
+            return True
+        return False
+
+    while pending < max_pending and submit():
+        pass
+    while pending:
+        (ok, result) = results.get()
+        pending -= 1
+        if not ok:
+            raise result
+        submit()
+        yield result
 
 
 def transliterate_path(text):
@@ -74,65 +137,6 @@ def filter_open_access_main_pdfs(
     files_out = []
     files_blocked = []
     investigate = []
-    descr_blacklist = [
-        "forsíða",
-        "forsida",
-        "útdráttur",
-        "úrdráttur",
-        "ágrip",
-        "efnisyfirlit",
-        "efnisskrá",
-        "heimildaskrá",
-        "heimildarskrá",
-        "heimildir",
-        # "samantekt",
-        "yfirlýsing",
-        "viðtal",
-        "kápa",
-        "titilsíða",
-        "abstract",
-        "beiðni um lokun",
-        "samþykki",
-        "leyfisbr",
-        "teikning",
-        # handle maybe
-        "þakkir",
-        "þakkar",
-        "thakkir",
-        "thakkar",
-        # handle later
-        "fylgiskjal",
-        "fylgiskjöl",
-        "fylgirit",
-        "viðauki",
-        "viðaukar",
-        "lokun",
-    ]
-    whitelist = [
-        "heild",
-        "ritgerð",
-        "ritgerd",
-        "greinagerð",
-        "greinargerð",
-        "lokaverkefni",
-        "handrit",
-        "handbok",
-        "handbók",
-        "lokaverkefni",
-        "bækling",
-        "skýrsla",
-        "skyrsla",
-        "meginmál",
-        "meginmal",
-    ]
-    lname_pat = re.compile(  # lower name pattern
-        r"""
-        (\b|_)
-        (ba|b\.a|bs|b\.s|bsc|b\.sc|b\.ed|ma|m\.a|ms|m\.s|msc|m\.sc)
-        (\b|_)
-    """,
-        re.VERBOSE,
-    )
 
     for (
         file_href,
@@ -147,7 +151,6 @@ def filter_open_access_main_pdfs(
         doc_id,
         language,
     ) in item_list:
-        lname = fname.lower()
         ldescr = descr.lower().strip()
         size_in_mb = size_to_mb(size)
         file_tup = (doc_href, size_in_mb, ldescr, fname, title)
@@ -169,29 +172,18 @@ def filter_open_access_main_pdfs(
             files_blocked.append(file_tup)
             continue
 
-        if (
-            ".pdf" in lname
-            and "Opinn" in access
-            and (
-                any(word in ldescr for word in whitelist)
-                or any(word in lname for word in whitelist)
-                or lname_pat.search(lname)
-            )
-        ):
+        _size_in_b, _is_main, reason = classify_file(fname, size, access, descr)
+        if reason == MAIN:
             # whitelist
             accum += size_in_mb
             files_out.append(item_tup)
-        elif (
-            "Opinn" not in access
-            or ".pdf" not in lname
-            or any(word in ldescr for word in descr_blacklist)
-        ):
-            # blacklist
-            files_blocked.append(file_tup)
-        elif not ldescr:
+        elif reason == NO_DESCR:
             investigate.append(file_tup)
-        else:
+        elif reason == UNFILTERED:
             unfiltered.append(file_tup)
+        else:
+            # blacklist
+            files_blocked.append(file_tup)
 
     del item_list
     files_out = sorted(files_out)
@@ -227,15 +219,18 @@ def filter_open_access_main_pdfs(
     return files_out
 
 
-def get_open_access_article_pdfs():
-    db = SkemmanDb()
-    files = db.get_filedocs()
+def get_open_access_article_pdfs(limit_file_size=True, language=None):
+    """ Main pdf files of open access documents, classified in the db when they were inserted,
+        optionally only those language_id labelled as language, e.g. 'icelandic' """
+    db = SkemmanDb.shared()
+    max_size = MAX_SIZE_IN_MB * B_IN_MB if limit_file_size else None
+    files = db.get_main_pdfs(max_size_bytes=max_size, language=language)
     files_out = [
         SkemmanFile(
             doc_href,
             file_href,
             fname=fname,
-            size=size,
+            size=size_to_mb(size),
             access=access,
             descr=descr,
             is_local=is_local,
@@ -257,13 +252,13 @@ def get_open_access_article_pdfs():
             is_local,
             doc_id,
             language,
-        ) in filter_open_access_main_pdfs(files)
+        ) in files
     ]
     return files_out
 
 
 def stats_open_access_article_pdfs():
-    db = SkemmanDb()
+    db = SkemmanDb.shared()
     files = db.get_filedocs()
     files_out = filter_open_access_main_pdfs(files, verbose=True, dump=True)
 